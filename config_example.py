@@ -9,16 +9,88 @@ BOT_TOKEN = "YOUR_BOT_TOKEN_HERE"
 # ID адміністратора (отримати у @userinfobot)
 ADMIN_ID = 123456789
 
-# Вайтліст користувачів (початковий)
+# Вайтліст користувачів (початковий): при старті нові ID отримують постійний доступ,
+# далі ним керують /addwhite і /removewhite
 WHITELIST = []
 
 # Контакти та ціни
 PAYMENT_CONTACT = "@your_username" #Ваш тг-юзернейм (для звернення про оплату)
 MONTHLY_PRICE = 800 # Оплата за місяць в гривнях
 FULL_CODE_PRICE = 150 # Оплата за код в доларах
+SUBSCRIPTION_DAYS = 0 # Термін для /addwhite без суфікса Nd (днів); 0 -- безстроково, як раніше
+SUBSCRIPTION_CHECK_INTERVAL = 3600 # Як часто (максимум) перевіряти закінчення підписок (секунди)
+
+# Як часто (секунди) надсилати адміну зведення активності користувачів
+ADMIN_DIGEST_INTERVAL = 60
 
 # Налаштування бази даних
 DB_NAME = "quiz_bot.db"
+# Шардування: історія, календар, слабкі місця й лічильники розкладаються по N файлах
+# (quiz_bot.shard0.db ...) за user_id; DB_NAME лишається каталогом. 0 -- одна БД.
+# Змінити N після увімкнення не можна (повторне шардування не підтримується).
+DB_SHARDS = 0
+CATALOG_SYNC_INTERVAL = 30 # Як часто (секунди) переносити лічильники з шардів у каталог (рейтинг, сегменти)
+# Де зберігати користувачів, відповіді, календар, слабкі місця, вайтліст і адмін-сповіщення:
+# "sqlite" -- файли вище, "memory" -- пам'ять процесу (навантажувальні тести, без WORKERS)
+STORAGE_BACKEND = "sqlite"
+
+# Webhook замість long polling (порожній WEBHOOK_URL -- polling, зручно для розробки)
+WEBHOOK_URL = "" # Публічна адреса reverse proxy, напр. "https://bot.example.com"
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = "" # Секрет для заголовка X-Telegram-Bot-Api-Secret-Token (A-Z, a-z, 0-9, _ і -); порожній -- випадковий на кожен запуск
+WEBHOOK_HOST = "127.0.0.1" # Де слухає вбудований aiohttp-сервер
+WEBHOOK_PORT = 8080
+WEBHOOK_DRAIN_TIMEOUT = 30 # Скільки секунд дочікувати оновлення в обробці при зупинці
+
+# Кількість процесів-воркерів (0 або 1 -- все в одному процесі).
+# Фронт-процес приймає оновлення й роздає їх воркерам за user_id
+WORKERS = 0
+
+# Локальний HTTP /metrics для Prometheus (0 -- вимкнено). Воркери слухають METRICS_PORT + 1 + номер.
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+
+# Логи: файл з ротацією за розміром (LOG_BACKUP_COUNT старих копій; воркери пишуть у bot.workerN.log)
+LOG_FILE = "bot.log"
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+LOG_JSON = False # True -- файл у JSON (рядок на запис, з tenant/user_id/handler/latency_ms); консоль лишається текстом
+# Частка INFO-записів, що потрапляють у лог, для гучних логерів (WARNING і вище -- завжди)
+LOG_SAMPLING = {
+    "aiogram.event": 0.05, # "Update id=... is handled" на кожне оновлення
+}
+LOG_SLOW_HANDLER = 1.0 # Обробник довше (секунди) -- WARNING з latency_ms
+
+# Кілька ботів (шкіл) в одному процесі. Порожній список -- один бот з налаштувань вище.
+# Кожен бот має власну БД і вайтліст; обробники, черга відправки та воркери спільні.
+BOTS = [
+    # {
+    #     "name": "school1",                # латиницею: шлях webhook та тека журналу
+    #     "token": "YOUR_BOT_TOKEN_HERE",
+    #     "admin_id": 123456789,
+    #     "db_name": "school1.db",
+    #     "payment_contact": "@school1_admin",
+    #     "monthly_price": 800,
+    #     "full_code_price": 150,
+    #     "whitelist": [],
+    #     "db_shards": 0,
+    #     "storage": "sqlite",
+    # },
+]
+
+# Скільки днів зберігати сирі відповіді (старіші згортаються в щоденні агрегати)
+ANSWER_RETENTION_DAYS = 90
+# Скільки рядків видаляти за одну транзакцію під час згортання
+RETENTION_BATCH_SIZE = 500
+# Один запуск з True перемикає велику (понад 32 МБ) стару БД на
+# auto_vacuum=INCREMENTAL повним VACUUM, старт затримається на хвилини. Без
+# цього згортання не повертає місце ОС; менші БД перемикаються самі
+VACUUM_ON_STARTUP = False
+
+# Журнал подій відповідей (бінарні сегменти поруч з БД) та розмір сегмента в байтах
+ANSWER_LOG_DIR = "quiz_bot_events"
+ANSWER_LOG_SEGMENT_SIZE = 64 * 1024 * 1024
+# Старі сегменти видаляються разом зі згортанням сирих відповідей (ANSWER_RETENTION_DAYS)
 
 # Налаштування часу на відповідь (секунди)
 ANSWER_TIME_LIMITS = {
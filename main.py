@@ -5,39 +5,209 @@ Telegram бот для вивчення таблиці множення
 """
 
 import asyncio
+import atexit
+import contextvars
+import copy
+import csv
+import functools
+import io
+import json
 import logging
+import logging.handlers
+import math
+import mmap
+import multiprocessing
+import os
+import queue
+import re
+import secrets
+import signal
+import struct
+import sys
+import threading
 import time
+import traceback
 import sqlite3
+from abc import ABC, abstractmethod
+from array import array
 from datetime import datetime, timedelta
 from typing import Optional, List, Dict
 from contextlib import contextmanager
-from collections import Counter
-from aiogram import Bot, Dispatcher, F, Router
-from aiogram.filters import Command, StateFilter
+from collections import Counter, OrderedDict, deque
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, Router
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.filters import KICKED, MEMBER, ChatMemberUpdatedFilter, Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import BufferedInputFile, Message, CallbackQuery, ChatMemberUpdated, InlineKeyboardMarkup, Update
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
 import random
 
+import config
 from config import (
     BOT_TOKEN, ADMIN_ID, WHITELIST, PAYMENT_CONTACT,
     MONTHLY_PRICE, FULL_CODE_PRICE, DB_NAME,
     ANSWER_TIME_LIMITS, REMINDER_HOURS, REMINDER_MESSAGES
 )
 
+# Налаштування, яких може не бути у старому config.py: значення за
+# замовчуванням ті самі, що в config_example.py
+ANSWER_RETENTION_DAYS = getattr(config, "ANSWER_RETENTION_DAYS", 90)
+RETENTION_BATCH_SIZE = getattr(config, "RETENTION_BATCH_SIZE", 500)
+VACUUM_ON_STARTUP = getattr(config, "VACUUM_ON_STARTUP", False)
+ANSWER_LOG_DIR = getattr(config, "ANSWER_LOG_DIR", "quiz_bot_events")
+ANSWER_LOG_SEGMENT_SIZE = getattr(config, "ANSWER_LOG_SEGMENT_SIZE", 64 * 1024 * 1024)
+ADMIN_DIGEST_INTERVAL = getattr(config, "ADMIN_DIGEST_INTERVAL", 60)
+SUBSCRIPTION_DAYS = getattr(config, "SUBSCRIPTION_DAYS", 0)
+SUBSCRIPTION_CHECK_INTERVAL = getattr(config, "SUBSCRIPTION_CHECK_INTERVAL", 3600)
+WEBHOOK_URL = getattr(config, "WEBHOOK_URL", "")
+WEBHOOK_PATH = getattr(config, "WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = getattr(config, "WEBHOOK_SECRET", "")
+WEBHOOK_HOST = getattr(config, "WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = getattr(config, "WEBHOOK_PORT", 8080)
+WEBHOOK_DRAIN_TIMEOUT = getattr(config, "WEBHOOK_DRAIN_TIMEOUT", 30)
+WORKERS = getattr(config, "WORKERS", 0)
+BOTS = getattr(config, "BOTS", [])
+DB_SHARDS = getattr(config, "DB_SHARDS", 0)
+CATALOG_SYNC_INTERVAL = getattr(config, "CATALOG_SYNC_INTERVAL", 30)
+STORAGE_BACKEND = getattr(config, "STORAGE_BACKEND", "sqlite")
+METRICS_HOST = getattr(config, "METRICS_HOST", "127.0.0.1")
+METRICS_PORT = getattr(config, "METRICS_PORT", 9108)
+LOG_FILE = getattr(config, "LOG_FILE", "bot.log")
+LOG_MAX_BYTES = getattr(config, "LOG_MAX_BYTES", 10 * 1024 * 1024)
+LOG_BACKUP_COUNT = getattr(config, "LOG_BACKUP_COUNT", 5)
+LOG_JSON = getattr(config, "LOG_JSON", False)
+LOG_SAMPLING = getattr(config, "LOG_SAMPLING", {"aiogram.event": 0.05})
+LOG_SLOW_HANDLER = getattr(config, "LOG_SLOW_HANDLER", 1.0)
+
 # ═══════════════════════════════════════════════════════════
 # ЛОГУВАННЯ
 # ═══════════════════════════════════════════════════════════
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+# Обробник, що зараз працює, і користувач оновлення -- для структурованих записів.
+# Виставляє HandlerMetricsMiddleware
+log_context = contextvars.ContextVar("log_context", default=(None, None))
+
+LOG_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_FIELDS = ("tenant", "user_id", "handler", "latency_ms")
+
+
+class LogContextFilter(logging.Filter):
+    """Семплювання гучних логерів і поля контексту -- ще в потоці, що логує
+
+    Записи WARNING і вище не семплюються ніколи.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = LOG_SAMPLING.get(record.name)
+        if rate is not None and record.levelno < logging.WARNING and random.random() >= rate:
+            return False
+        user_id, handler = log_context.get()
+        if not hasattr(record, "user_id"):
+            record.user_id = user_id
+        if not hasattr(record, "handler"):
+            record.handler = handler
+        if not hasattr(record, "tenant"):
+            t = current_tenant.get(None)
+            record.tenant = t.name if t is not None else None
+        return True
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler без форматування на гарячому шляху
+
+    Стандартний prepare() форматує запис цілком; тут лише підставляємо
+    аргументи в повідомлення, а час, рівень і JSON збирає потік слухача.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # Traceback не можна передати іншому потоку -- лише текстом
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Один JSON-об'єкт на рядок: час, рівень, логер, повідомлення і поля контексту"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+log_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging(path: str = LOG_FILE):
+    """Логи через чергу: логування -- це put() у чергу, диск і консоль -- у потоці слухача
+
+    Повторний виклик (воркер після імпорту) зупиняє попереднього слухача й
+    перемикає запис в інший файл.
+    """
+    global log_listener
+    stop_logging()
+    file_handler = logging.handlers.RotatingFileHandler(
+        path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8', delay=True)
+    file_handler.setFormatter(JsonLogFormatter() if LOG_JSON else logging.Formatter(LOG_TEXT_FORMAT))
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(LOG_TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(logging.INFO)
+    log_listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler)
+    log_listener.start()
+
+
+def stop_logging():
+    """Дописати чергу логів і закрити файл"""
+    global log_listener
+    if log_listener is None:
+        return
+    log_listener.stop()
+    for handler in log_listener.handlers:
+        handler.close()
+    log_listener = None
+
+
+def worker_log_file(index: int) -> str:
+    """bot.log -> bot.worker0.log: ротація одного файлу з кількох процесів ламається"""
+    root, ext = os.path.splitext(LOG_FILE)
+    return f"{root}.worker{index}{ext}"
+
+
+# Файл/рядок/процес у формати не входять, а findCaller() -- найдорожча частина запису
+logging._srcfile = None
+logging.logProcesses = False
+logging.logMultiprocessing = False
+# Воркер (spawn) імпортує модуль заново і сам викликає setup_logging зі своїм
+# файлом -- без цієї перевірки кожен воркер відкривав би ще й спільний bot.log
+if multiprocessing.current_process().name == "MainProcess":
+    setup_logging()
+atexit.register(stop_logging)
 logger = logging.getLogger(__name__)
 
 # ═══════════════════════════════════════════════════════════
@@ -53,19 +223,607 @@ class QuizStates(StatesGroup):
     admin_broadcast_message = State()
     admin_broadcast_confirm = State()
 
+# ═══════════════════════════════════════════════════════════
+# ТЕНАНТИ
+# ═══════════════════════════════════════════════════════════
+
+# Бот (школа), від імені якого зараз працює код: для оновлень його виставляє
+# TenantMiddleware, для фонових задач -- tenant_scope під час їх створення
+current_tenant = contextvars.ContextVar("current_tenant")
+
+
+def tenant() -> "Tenant":
+    return current_tenant.get()
+
+
+@contextmanager
+def tenant_scope(t: "Tenant"):
+    token = current_tenant.set(t)
+    try:
+        yield t
+    finally:
+        current_tenant.reset(token)
+
+
+class TenantLocal:
+    """Модульний синглтон, що належить поточному тенанту
+
+    access_control.grant(...) -> tenant().access_control.grant(...)
+    """
+
+    def __init__(self, name: str):
+        object.__setattr__(self, "_name", name)
+
+    def __getattr__(self, attr):
+        return getattr(getattr(current_tenant.get(), self._name), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(getattr(current_tenant.get(), self._name), attr, value)
+
+    def __repr__(self) -> str:
+        return f"<TenantLocal {self._name}>"
+
+
+# ═══════════════════════════════════════════════════════════
+# МЕТРИКИ
+# ═══════════════════════════════════════════════════════════
+
+# Межі бакетів гістограм (секунди): від запиту до SQLite до довгого циклу
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                  0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """Гістограма у форматі Prometheus: кумулятивні бакети, сума і кількість
+
+    Серія на кожен набір значень міток -- масив лічильників по бакетах
+    (останній -- +Inf) і сума, тож observe -- це пошук бакета і два додавання.
+    """
+
+    def __init__(self, name: str, help_text: str, labels: tuple, buckets: tuple = METRIC_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series: Dict[tuple, list] = {}  # мітки -> [лічильники бакетів..., сума]
+
+    def observe(self, value: float, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        series[index] += 1
+        series[-1] += value
+
+    @staticmethod
+    def count(series: list) -> int:
+        return sum(series[:-1])
+
+    def quantile(self, q: float, series: list) -> Optional[float]:
+        """Оцінка квантиля лінійною інтерполяцією всередині бакета (як histogram_quantile)"""
+        total = self.count(series)
+        if total == 0:
+            return None
+        rank = q * total
+        seen = 0
+        for index, cnt in enumerate(series[:-1]):
+            if seen + cnt >= rank and cnt:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / cnt
+            seen += cnt
+        return self.buckets[-1]
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, series in sorted(self.series.items()):
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.labels, label_values))
+            prefix = f"{labels}," if labels else ""
+            cumulative = 0
+            for bound, cnt in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += cnt
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Усі гістограми процесу (у кожного воркера -- свій реєстр)"""
+
+    def __init__(self):
+        self.histograms: Dict[str, Histogram] = {}
+
+    def histogram(self, name: str, help_text: str, labels: tuple) -> Histogram:
+        histogram = self.histograms[name] = Histogram(name, help_text, labels)
+        return histogram
+
+    def expose(self) -> str:
+        lines = []
+        for histogram in self.histograms.values():
+            lines += histogram.expose()
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+HANDLER_SECONDS = metrics.histogram(
+    "quizbot_handler_seconds", "Час обробника оновлення", ("handler", "outcome"))
+QUERY_SECONDS = metrics.histogram(
+    "quizbot_db_query_seconds", "Час запиту до сховища", ("query", "outcome"))
+API_SECONDS = metrics.histogram(
+    "quizbot_telegram_request_seconds", "Час запиту до Telegram Bot API", ("method", "priority", "outcome"))
+LOOP_SECONDS = metrics.histogram(
+    "quizbot_loop_iteration_seconds", "Час одного проходу фонового циклу", ("loop", "outcome"))
+ANSWER_SECONDS = metrics.histogram(
+    "quizbot_answer_seconds", "Час відповіді користувача за режимом", ("mode", "outcome"))
+
+
+@contextmanager
+def timed(histogram: Histogram, *label_values):
+    """Виміряти блок; остання мітка -- outcome (ok / error)"""
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        histogram.observe(time.perf_counter() - start, *label_values, outcome)
+
+
+def observe_query(func):
+    """Декоратор синхронного хелпера БД: мітка query = Клас.метод або функція"""
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with timed(QUERY_SECONDS, name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def observe_queries(cls):
+    """Декоратор класу: observe_query для кожного публічного методу"""
+    for attr, value in list(vars(cls).items()):
+        if callable(value) and not attr.startswith("_"):
+            setattr(cls, attr, observe_query(value))
+    return cls
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner middleware роутера: час кожного обробника за назвою функції"""
+
+    async def __call__(self, handler, event, data: dict):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+        user = data.get("event_from_user")
+        token = log_context.set((user.id if user else None, name))
+        start = time.perf_counter()
+        try:
+            with timed(HANDLER_SECONDS, name):
+                return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - start
+            if elapsed > LOG_SLOW_HANDLER:
+                logger.warning(f"🐌 Повільний обробник {name}: {elapsed * 1000:.0f} мс",
+                               extra={"latency_ms": round(elapsed * 1000, 1)})
+            log_context.reset(token)
+
+
+def format_metrics_summary(limit: int = 8) -> str:
+    """p50/p99 найнавантаженіших серій для адмін-команди /metrics"""
+    def section(title: str, histogram: Histogram) -> str:
+        rows = sorted(histogram.series.items(), key=lambda item: -item[1][-1])[:limit]
+        if not rows:
+            return f"{title}\n• даних ще немає\n"
+        text = f"{title}\n"
+        for label_values, series in rows:
+            p50 = histogram.quantile(0.5, series) * 1000
+            p99 = histogram.quantile(0.99, series) * 1000
+            text += (f"• {'/'.join(map(str, label_values))}: {histogram.count(series)} "
+                     f"| p50 {p50:.1f} | p99 {p99:.1f} мс\n")
+        return text
+
+    return "\n".join([
+        "📈 МЕТРИКИ (цей процес, від запуску)\n",
+        section("⚙️ Обробники:", HANDLER_SECONDS),
+        section("💾 Запити до сховища:", QUERY_SECONDS),
+        section("📤 Telegram API:", API_SECONDS),
+        section("🔁 Фонові цикли:", LOOP_SECONDS),
+    ])
+
+
+async def start_metrics_server(port: int) -> Optional[web.AppRunner]:
+    """Локальний HTTP: /metrics для Prometheus, /health і /ready (METRICS_PORT = 0 -- вимкнено)"""
+    if not port:
+        return None
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(body=metrics.expose().encode(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def handle_health(request: web.Request) -> web.Response:
+        return web.json_response(health_snapshot())
+
+    async def handle_ready(request: web.Request) -> web.Response:
+        ready = watchdog.is_ready()
+        return web.Response(text="ready\n" if ready else "not ready\n", status=200 if ready else 503)
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_get("/health", handle_health)
+    app.router.add_get("/ready", handle_ready)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, port).start()
+    except OSError as e:
+        logger.error(f"Не вдалося відкрити /metrics на {METRICS_HOST}:{port}: {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"📈 Метрики: http://{METRICS_HOST}:{port}/metrics (/health, /ready)")
+    return runner
+
+
+# ═══════════════════════════════════════════════════════════
+# ЗДОРОВ'Я EVENT LOOP
+# ═══════════════════════════════════════════════════════════
+
+LOOP_LAG_INTERVAL = 0.1     # як часто міряти затримку циклу (секунди)
+LOOP_STALL_THRESHOLD = 0.5  # цикл мовчить довше -- знімаємо стек винуватця
+LOOP_STALL_HISTORY = 10
+READY_MAX_LAG = 2.0         # /ready віддає 503, якщо затримка циклу більша
+STALL_STACK_DEPTH = 12
+
+LOOP_LAG_SECONDS = metrics.histogram(
+    "quizbot_event_loop_lag_seconds", "Запізнення event loop відносно запланованого пробудження", ())
+
+
+class LoopWatchdog:
+    """Сторож event loop: затримка циклу і стек коду, що його блокує
+
+    Корутина кожні LOOP_LAG_INTERVAL оновлює heartbeat і міряє, наскільки
+    пізніше запланованого прокинулась. Окремий потік стежить за heartbeat:
+    якщо цикл мовчить довше LOOP_STALL_THRESHOLD, він знімає стек потоку
+    циклу через sys._current_frames() -- поки блокування ще триває.
+    """
+
+    def __init__(self):
+        self.heartbeat = time.monotonic()
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.stall_count = 0
+        self.stalls = deque(maxlen=LOOP_STALL_HISTORY)
+        self.started_at: Optional[float] = None
+        self._loop_thread_id: Optional[int] = None
+        self._current_stall: Optional[dict] = None
+
+    def start(self):
+        """Запустити у потоці event loop (повторний виклик нічого не робить)"""
+        if self._loop_thread_id is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self.started_at = time.time()
+        self.heartbeat = time.monotonic()
+        asyncio.create_task(self._tick())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    async def _tick(self):
+        while True:
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            now = time.monotonic()
+            silent = now - self.heartbeat
+            lag = max(0.0, silent - LOOP_LAG_INTERVAL)
+            self.heartbeat = now
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            LOOP_LAG_SECONDS.observe(lag)
+
+            stall = self._current_stall
+            if stall is not None:
+                # Цикл ожив -- фіксуємо повну тривалість блокування
+                stall["duration"] = silent
+                self._current_stall = None
+                logger.warning(f"🐢 Event loop стояв {silent:.2f}с:\n{stall['stack']}")
+
+    def _watch(self):
+        while True:
+            time.sleep(LOOP_STALL_THRESHOLD / 2)
+            silent = time.monotonic() - self.heartbeat
+            if silent < LOOP_STALL_THRESHOLD + LOOP_LAG_INTERVAL or self._current_stall is not None:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = format_loop_stack(frame) if frame else ""
+            stall = {"at": time.time(), "duration": silent, "stack": stack}
+            self.stalls.append(stall)
+            self.stall_count += 1
+            self._current_stall = stall
+
+    def is_ready(self) -> bool:
+        return (self.started_at is not None
+                and time.monotonic() - self.heartbeat < READY_MAX_LAG
+                and self.last_lag < READY_MAX_LAG)
+
+
+watchdog = LoopWatchdog()
+
+
+def format_loop_stack(frame) -> str:
+    """Стек потоку циклу без кадрів самого asyncio -- лише код бота і бібліотек"""
+    asyncio_dir = os.path.dirname(asyncio.__file__)
+    frames = [entry for entry in traceback.extract_stack(frame)
+              if not entry.filename.startswith(asyncio_dir)]
+    return "".join(traceback.format_list(frames[-STALL_STACK_DEPTH:]))
+
+
+def health_snapshot() -> dict:
+    """Стан процесу: затримка циклу, блокування, задачі й черги"""
+    lag_series = LOOP_LAG_SECONDS.series.get(())
+    # Лише кеш відправника outbox: /health не робить запитів до БД у циклі.
+    # Відправник живе в головному воркері, у решти лічильників немає (None)
+    counts = [t.outbox.counts for t in tenants if t.outbox.counts is not None]
+    outbox_due = sum(due for due, _ in counts) if counts else None
+    outbox_delayed = sum(delayed for _, delayed in counts) if counts else None
+    last_stall = watchdog.stalls[-1] if watchdog.stalls else None
+    return {
+        "ready": watchdog.is_ready(),
+        "worker": worker.index if worker.conn is not None else None,
+        "uptime": int(time.time() - watchdog.started_at) if watchdog.started_at else 0,
+        "loop_lag_ms": round(watchdog.last_lag * 1000, 1),
+        # Квантиль з бакетів грубий, тому не більший за реальний максимум
+        "loop_lag_p99_ms": round(min(LOOP_LAG_SECONDS.quantile(0.99, lag_series), watchdog.max_lag) * 1000, 1)
+        if lag_series else None,
+        "loop_lag_max_ms": round(watchdog.max_lag * 1000, 1),
+        "stalls": watchdog.stall_count,
+        "last_stall": last_stall,
+        "tasks": len(asyncio.all_tasks()),
+        "answer_timers": len(active_timers),
+        "outbound_queue": {PRIORITY_NAMES[priority]: depth for priority, depth in outbound.depth().items()},
+        "outbound_paused_s": round(outbound.paused_for(), 1),  # пауза бота після RetryAfter
+        "outbox_due": outbox_due,
+        "outbox_delayed": outbox_delayed,  # відкладені нагадування та повтори
+    }
+
+
+def _or_dash(value) -> str:
+    return "—" if value is None else str(value)
+
+
+def format_health_report() -> str:
+    """Звіт для адмін-команди /health"""
+    health = health_snapshot()
+    worker_note = f" (воркер {health['worker']})" if health["worker"] is not None else ""
+    outbound_depths = ", ".join(f"{name} {depth}" for name, depth in health["outbound_queue"].items())
+    if health["outbound_paused_s"]:
+        outbound_depths += f", пауза після RetryAfter {health['outbound_paused_s']}с"
+    p99 = f"{health['loop_lag_p99_ms']} мс" if health["loop_lag_p99_ms"] is not None else "—"
+    text = (
+        f"🩺 ЗДОРОВ'Я{worker_note}: {'✅ готовий' if health['ready'] else '⚠️ не готовий'}\n\n"
+        f"⏱️ Затримка циклу: {health['loop_lag_ms']} мс (p99 {p99}, макс {health['loop_lag_max_ms']} мс)\n"
+        f"🐢 Блокувань > {LOOP_STALL_THRESHOLD:g}с: {health['stalls']}\n"
+        f"🧵 Задач asyncio: {health['tasks']}, таймерів питань: {health['answer_timers']}\n"
+        f"📤 Черга outbound: {outbound_depths}\n"
+        f"📮 Outbox: до відправки {_or_dash(health['outbox_due'])}, відкладено {_or_dash(health['outbox_delayed'])}\n"
+        f"🕐 Працює: {timedelta(seconds=health['uptime'])}"
+    )
+    stall = health["last_stall"]
+    if stall:
+        at = datetime.fromtimestamp(stall["at"]).strftime("%H:%M:%S")
+        # Останні кадри стеку -- саме там код, що тримав цикл
+        text += f"\n\n🔍 Останнє блокування {at}, {stall['duration']:.2f}с:\n{stall['stack'][-1500:]}"
+    return text
+
+
+# ═══════════════════════════════════════════════════════════
+# ПРОФІЛЮВАННЯ
+# ═══════════════════════════════════════════════════════════
+
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 300
+PROFILE_INTERVAL = 0.01  # 100 знімків стеку на секунду
+PROFILE_TOP_STACKS = 5
+
+
+class StackProfiler:
+    """Семплювальний профайлер потоку event loop
+
+    Окремий потік кожні PROFILE_INTERVAL бере стек циклу через
+    sys._current_frames() -- як сторож циклу, тільки безперервно. Без хуків
+    sys.setprofile на кожен виклик і без сигналів, які до того ж не перервуть
+    блокуючий C-виклик. Безкоштовним для циклу це не є: кожен знімок бере
+    GIL, тож цикл на час обходу стеку (десятки мікросекунд) стоїть, а під
+    CPU-навантаженням потік чекає перемикання GIL (sys.getswitchinterval(),
+    5 мс), і реальна частота падає до ~100 знімків на секунду. На 100 Гц
+    сповільнення циклу в наших замірах у межах шуму (1-2%). Результат --
+    collapsed stacks (``кадр;кадр;кадр N``) для flamegraph.pl / speedscope.
+    """
+
+    def __init__(self):
+        self.running = False
+        self._task: Optional[asyncio.Task] = None
+        self._labels: Dict[object, str] = {}
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self._labels[code] = label
+        return label
+
+    def sample(self, thread_id: int, seconds: float) -> Counter:
+        """Блокуючий збір знімків (виконується у власному потоці)"""
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                stacks[tuple(reversed(stack))] += 1
+            del frame
+            time.sleep(PROFILE_INTERVAL)
+        return stacks
+
+    def start(self, seconds: float, report):
+        """Профілювати потік поточного циклу у фоні, результат -- у await report(stacks)
+
+        Одночасно -- лише один запуск; running стає True одразу, ще до старту задачі.
+        """
+        if self.running:
+            raise RuntimeError("профілювання вже триває")
+        self.running = True
+        self._task = asyncio.create_task(self._run(threading.get_ident(), seconds, report))
+
+    async def _run(self, thread_id: int, seconds: float, report):
+        try:
+            stacks = await asyncio.to_thread(self.sample, thread_id, seconds)
+        finally:
+            self.running = False
+        try:
+            await report(stacks)
+        except Exception as e:
+            logger.error(f"Помилка надсилання профілю: {e}")
+
+
+profiler = StackProfiler()
+
+
+def collapse_stacks(stacks: Counter) -> str:
+    """Формат collapsed stacks: по рядку на унікальний стек, від кореня до листа"""
+    return "".join(f"{';'.join(stack)} {count}\n" for stack, count in stacks.most_common())
+
+
+def is_idle_stack(stack: tuple) -> bool:
+    """Цикл чекає на select() -- вільний, а не зайнятий роботою"""
+    return "(selectors.py:" in stack[-1]
+
+
+def format_profile_report(stacks: Counter, seconds: float) -> str:
+    """Короткий підсумок до файлу: простій циклу і найгарячіші листові кадри"""
+    total = sum(stacks.values())
+    if not total:
+        return "🔥 Профіль порожній"
+    idle = sum(count for stack, count in stacks.items() if is_idle_stack(stack))
+    leaves = Counter()
+    for stack, count in stacks.items():
+        if not is_idle_stack(stack):
+            leaves[stack[-1]] += count
+    worker_note = f" (воркер {worker.index})" if worker.conn is not None else ""
+    lines = [
+        f"🔥 ПРОФІЛЬ{worker_note} за {seconds:g}с",
+        f"Знімків: {total}, унікальних стеків: {len(stacks)}",
+        f"💤 Цикл вільний: {idle * 100 // total}%",
+    ]
+    if leaves:
+        lines.append("\nГарячі кадри:")
+        lines.extend(f"{count * 100 / total:.1f}% {label}"
+                     for label, count in leaves.most_common(PROFILE_TOP_STACKS))
+    return "\n".join(lines)
+
+
 # ═══════════════════════════════════════════════════════════
 # БАЗА ДАНИХ
 # ═══════════════════════════════════════════════════════════
 
+DB_POOL_MAX_IDLE = 4  # скільки вільних з'єднань тримати на один файл БД
+
+
+class ConnectionPool:
+    """Пул з'єднань SQLite за шляхом до файлу, спільний для всіх тенантів
+
+    Кожен тенант має власні файли, тож дані не змішуються, а з'єднання
+    (і їхній кеш сторінок) переживають окремий запит. Повертається
+    з'єднання без відкритої транзакції: незакомічене відкочується, як і при
+    close(). ATTACH і temp-таблиці прибирає той, хто їх створив. З'єднанням
+    водночас користується один виклик, тому check_same_thread=False
+    безпечний і для asyncio.to_thread.
+    """
+
+    def __init__(self, max_idle: int = DB_POOL_MAX_IDLE):
+        self.max_idle = max_idle
+        self._idle: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, path: str) -> sqlite3.Connection:
+        with self._lock:
+            idle = self._idle.get(path)
+            if idle:
+                return idle.pop()
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def release(self, path: str, conn: sqlite3.Connection):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            return
+        with self._lock:
+            idle = self._idle.setdefault(path, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+db_pool = ConnectionPool()
+atexit.register(db_pool.close_all)
+
+
 @contextmanager
-def get_db():
-    """Контекстний менеджер для роботи з БД"""
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+def connect_db(path: str):
+    """Контекстний менеджер для роботи з файлом БД (з'єднання з db_pool)"""
+    conn = db_pool.acquire(path)
     try:
         yield conn
     finally:
-        conn.close()
+        db_pool.release(path, conn)
+
+
+def get_db():
+    """Каталог тенанта: користувачі, вайтліст, outbox, налаштування"""
+    return connect_db(tenant().db_name)
+
+
+def get_user_db(user_id: int):
+    """БД з даними одного користувача (шард або каталог без шардування)"""
+    return connect_db(tenant().user_db_name(user_id))
+
+
+# Колонки answer_history, додані вже після переходу на компактну схему
+ANSWER_HISTORY_EXTRA_COLUMNS = {
+    "equation": "TEXT",  # рівняння "Знайди X": з множника й x його не відновити
+    "legacy_id": "INTEGER",  # rowid в answer_history_legacy -- повторний backfill не дублює
+}
+
+
+def ensure_answer_history_columns(conn):
+    """Додати в answer_history (каталогу або шарду) колонки, яких там ще немає"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(answer_history)")}
+    for name, sql_type in ANSWER_HISTORY_EXTRA_COLUMNS.items():
+        if name not in columns:
+            logger.info(f"Додаємо колонку answer_history.{name}...")
+            conn.execute(f"ALTER TABLE answer_history ADD COLUMN {name} {sql_type}")
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_answer_history_legacy
+        ON answer_history (legacy_id) WHERE legacy_id IS NOT NULL
+    ''')
 
 
 def migrate_database():
@@ -78,13 +836,85 @@ def migrate_database():
             cursor.execute("PRAGMA table_info(answer_history)")
             columns = [row[1] for row in cursor.fetchall()]
 
-            if 'question_type' not in columns:
-                logger.info("Додаємо колонку question_type...")
-                cursor.execute('ALTER TABLE answer_history ADD COLUMN question_type TEXT DEFAULT "standard"')
+            # Стара (текстова) схема: доповнюємо колонки і відкладаємо її
+            # як answer_history_legacy -- далі її перенесе backfill_answer_history
+            if 'question' in columns:
+                if 'question_type' not in columns:
+                    logger.info("Додаємо колонку question_type...")
+                    cursor.execute('ALTER TABLE answer_history ADD COLUMN question_type TEXT DEFAULT "standard"')
+
+                if 'mode' not in columns:
+                    logger.info("Додаємо колонку mode...")
+                    cursor.execute('ALTER TABLE answer_history ADD COLUMN mode TEXT DEFAULT "normal"')
+
+                logger.info("Переносимо answer_history у answer_history_legacy...")
+                cursor.execute('ALTER TABLE answer_history RENAME TO answer_history_legacy')
+
+            # Компактна схема: цілі операнди, коди режиму/типу, мс та epoch
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS answer_history (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    answered_at INTEGER NOT NULL,
+                    num1 INTEGER NOT NULL,
+                    num2 INTEGER NOT NULL,
+                    user_answer INTEGER NOT NULL,
+                    correct_answer INTEGER NOT NULL,
+                    is_correct INTEGER NOT NULL,
+                    response_ms INTEGER NOT NULL,
+                    level INTEGER NOT NULL,
+                    mode INTEGER NOT NULL,
+                    question_type INTEGER NOT NULL,
+                    equation TEXT,
+                    legacy_id INTEGER
+                )
+            ''')
+            ensure_answer_history_columns(cursor)
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_answer_history_user_time
+                ON answer_history (user_id, answered_at)
+            ''')
+
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_answer_history_time
+                ON answer_history (answered_at)
+            ''')
+
+            # Згорнуті старі відповіді: користувач / день / приклад
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS answer_rollups (
+                    user_id INTEGER NOT NULL,
+                    day INTEGER NOT NULL,
+                    question_type INTEGER NOT NULL,
+                    num1 INTEGER NOT NULL,
+                    num2 INTEGER NOT NULL,
+                    mode INTEGER NOT NULL,
+                    level INTEGER NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    correct INTEGER NOT NULL,
+                    total_ms INTEGER NOT NULL,
+                    PRIMARY KEY (user_id, day, question_type, num1, num2, mode, level)
+                ) WITHOUT ROWID
+            ''')
 
-            if 'mode' not in columns:
-                logger.info("Додаємо колонку mode...")
-                cursor.execute('ALTER TABLE answer_history ADD COLUMN mode TEXT DEFAULT "normal"')
+            # Календар активності: один рядок (бітова мапа + лічильники) на користувача
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS activity_bitmaps (
+                    user_id INTEGER PRIMARY KEY,
+                    base_day INTEGER NOT NULL,
+                    days BLOB NOT NULL,
+                    counts BLOB NOT NULL
+                )
+            ''')
+            convert_legacy_activity_calendar(cursor)
+
+            # Прогрес фонових міграцій (backfill тощо)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS migration_state (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                )
+            ''')
 
             # Перевіряємо таблицю users
             cursor.execute("PRAGMA table_info(users)")
@@ -115,217 +945,1820 @@ def migrate_database():
                 )
             ''')
 
+            if 'subscription_expires' not in user_columns:
+                logger.info("Додаємо колонку subscription_expires...")
+                cursor.execute('ALTER TABLE users ADD COLUMN subscription_expires INTEGER')
+
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_users_subscription_expires
+                ON users (subscription_expires)
+                WHERE subscription_expires IS NOT NULL
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_users_whitelisted
+                ON users (is_whitelisted, user_id)
+            ''')
+
+            if 'is_blocked' not in user_columns:
+                logger.info("Додаємо колонку is_blocked...")
+                cursor.execute('ALTER TABLE users ADD COLUMN is_blocked BOOLEAN DEFAULT 0')
+
+            if 'delivery_status' not in user_columns:
+                logger.info("Додаємо колонку delivery_status...")
+                cursor.execute('ALTER TABLE users ADD COLUMN delivery_status TEXT')
+
+            # Живі чати: розсилки й нагадування йдуть тільки по цьому індексу
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_users_reachable
+                ON users (is_whitelisted, user_id)
+                WHERE is_blocked = 0
+            ''')
+
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_users_last_activity
+                ON users (last_activity)
+            ''')
+
+            # Повнотекстовий довідник користувачів (rowid = user_id)
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'user_directory'")
+            directory_exists = cursor.fetchone() is not None
+            cursor.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS user_directory USING fts5(
+                    username, first_name, custom_name,
+                    tokenize = 'unicode61 remove_diacritics 2',
+                    prefix = '1 2 3'
+                )
+            ''')
+            cursor.executescript('''
+                CREATE TRIGGER IF NOT EXISTS users_directory_ai AFTER INSERT ON users BEGIN
+                    INSERT INTO user_directory (rowid, username, first_name, custom_name)
+                    VALUES (new.user_id, new.username, new.first_name, new.custom_name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS users_directory_au
+                AFTER UPDATE OF username, first_name, custom_name ON users
+                WHEN old.username IS NOT new.username
+                  OR old.first_name IS NOT new.first_name
+                  OR old.custom_name IS NOT new.custom_name
+                BEGIN
+                    DELETE FROM user_directory WHERE rowid = old.user_id;
+                    INSERT INTO user_directory (rowid, username, first_name, custom_name)
+                    VALUES (new.user_id, new.username, new.first_name, new.custom_name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS users_directory_ad AFTER DELETE ON users BEGIN
+                    DELETE FROM user_directory WHERE rowid = old.user_id;
+                END;
+            ''')
+            if not directory_exists:
+                logger.info("Будуємо довідник користувачів (FTS5)...")
+                cursor.execute('''
+                    INSERT INTO user_directory (rowid, username, first_name, custom_name)
+                    SELECT user_id, username, first_name, custom_name FROM users
+                ''')
+
+            # Загальні налаштування бота (ключ -> число)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS bot_settings (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                )
+            ''')
+
+            # Скетчі розподілу часу відповіді (user / mode / level / global)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS response_time_sketches (
+                    scope TEXT NOT NULL,
+                    scope_key TEXT NOT NULL,
+                    part INTEGER NOT NULL DEFAULT 0,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (scope, scope_key, part)
+                ) WITHOUT ROWID
+            ''')
+
+            # Транзакційний outbox: повідомлення пишуться разом зі зміною стану
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER NOT NULL,
+                    payload TEXT NOT NULL,
+                    priority INTEGER NOT NULL,
+                    batch_id INTEGER,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at INTEGER NOT NULL,
+                    last_error TEXT
+                )
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_outbox_due
+                ON outbox (priority, next_attempt_at)
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_outbox_batch
+                ON outbox (batch_id)
+                WHERE batch_id IS NOT NULL
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS outbox_batches (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    title TEXT NOT NULL,
+                    report_chat_id INTEGER,
+                    created_at INTEGER NOT NULL,
+                    finished_at INTEGER,
+                    total INTEGER NOT NULL DEFAULT 0,
+                    sent INTEGER NOT NULL DEFAULT 0,
+                    blocked INTEGER NOT NULL DEFAULT 0,
+                    deactivated INTEGER NOT NULL DEFAULT 0,
+                    chat_not_found INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+
             conn.commit()
             logger.info("✅ Міграція завершена")
         except Exception as e:
             logger.error(f"Помилка міграції: {e}")
 
+    enable_incremental_vacuum()
 
+    if WORKERS > 1:
+        # Кілька процесів пишуть в одну БД: WAL дозволяє читати під час запису
+        with get_db() as conn:
+            conn.execute("PRAGMA journal_mode = WAL")
 
-def get_or_create_user(user_id: int, username: str, first_name: str) -> dict:
-    """Отримати або створити користувача"""
+    migrate_shards()
+
+
+VACUUM_AUTO_MAX_BYTES = 32 * 1024 * 1024  # меншу БД VACUUM переписує за лічені секунди
+
+
+def enable_incremental_vacuum():
+    """Увімкнути auto_vacuum=INCREMENTAL (одноразовий повний VACUUM)
+
+    VACUUM переписує весь файл і на великій БД затримує старт на хвилини, а
+    на ходу його робити не можна -- він тримає блокування запису до кінця.
+    Тому сам він запускається лише для малої БД (до VACUUM_AUTO_MAX_BYTES),
+    велика чекає явного VACUUM_ON_STARTUP = True; до перемикання згортання
+    не повертає місце ОС.
+    """
     with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
-        
-        if user is None:
+        try:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                return
+            size = conn.execute("PRAGMA page_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+            if size > VACUUM_AUTO_MAX_BYTES and not VACUUM_ON_STARTUP:
+                logger.info("auto_vacuum не INCREMENTAL: місце після згортання не повертається ОС "
+                            "(один запуск з VACUUM_ON_STARTUP = True це виправить)")
+                return
+            logger.info("Вмикаємо інкрементальний vacuum (одноразовий VACUUM, запуск зачекає)...")
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        except Exception as e:
+            logger.error(f"Помилка налаштування auto_vacuum: {e}")
+
+
+# ═══════════════════════════════════════════════════════════
+# ШАРДИ
+# ═══════════════════════════════════════════════════════════
+
+# Дані одного користувача: з DB_SHARDS > 0 живуть у шарді user_id % N,
+# каталог (DB_NAME) лишається для users, вайтліста, outbox і налаштувань
+SHARD_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS answer_history (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        answered_at INTEGER NOT NULL,
+        num1 INTEGER NOT NULL,
+        num2 INTEGER NOT NULL,
+        user_answer INTEGER NOT NULL,
+        correct_answer INTEGER NOT NULL,
+        is_correct INTEGER NOT NULL,
+        response_ms INTEGER NOT NULL,
+        level INTEGER NOT NULL,
+        mode INTEGER NOT NULL,
+        question_type INTEGER NOT NULL,
+        equation TEXT,
+        legacy_id INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS idx_answer_history_user_time ON answer_history (user_id, answered_at);
+    CREATE INDEX IF NOT EXISTS idx_answer_history_time ON answer_history (answered_at);
+    CREATE TABLE IF NOT EXISTS answer_rollups (
+        user_id INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        question_type INTEGER NOT NULL,
+        num1 INTEGER NOT NULL,
+        num2 INTEGER NOT NULL,
+        mode INTEGER NOT NULL,
+        level INTEGER NOT NULL,
+        attempts INTEGER NOT NULL,
+        correct INTEGER NOT NULL,
+        total_ms INTEGER NOT NULL,
+        PRIMARY KEY (user_id, day, question_type, num1, num2, mode, level)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS activity_bitmaps (
+        user_id INTEGER PRIMARY KEY,
+        base_day INTEGER NOT NULL,
+        days BLOB NOT NULL,
+        counts BLOB NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS weak_spots (
+        user_id INTEGER,
+        number1 INTEGER,
+        number2 INTEGER,
+        error_count INTEGER DEFAULT 0,
+        last_error TIMESTAMP,
+        PRIMARY KEY (user_id, number1, number2)
+    );
+    CREATE TABLE IF NOT EXISTS response_time_sketches (
+        scope TEXT NOT NULL,
+        scope_key TEXT NOT NULL,
+        part INTEGER NOT NULL DEFAULT 0,
+        data BLOB NOT NULL,
+        PRIMARY KEY (scope, scope_key, part)
+    ) WITHOUT ROWID;
+    -- Лічильники користувача; version > synced_version -- ще не перенесено в каталог
+    CREATE TABLE IF NOT EXISTS user_counters (
+        user_id INTEGER PRIMARY KEY,
+        total_questions INTEGER NOT NULL DEFAULT 0,
+        correct_answers INTEGER NOT NULL DEFAULT 0,
+        wrong_answers INTEGER NOT NULL DEFAULT 0,
+        current_streak INTEGER NOT NULL DEFAULT 0,
+        best_streak INTEGER NOT NULL DEFAULT 0,
+        last_activity TIMESTAMP,
+        levels INTEGER NOT NULL DEFAULT 0,
+        version INTEGER NOT NULL DEFAULT 0,
+        synced_version INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS idx_user_counters_dirty ON user_counters (user_id)
+    WHERE version > synced_version;
+'''
+
+# Таблиці, що переносяться з каталогу в шарди: назва -> колонки
+SHARD_TABLES = {
+    "answer_history": "id, user_id, answered_at, num1, num2, user_answer, correct_answer, "
+                      "is_correct, response_ms, level, mode, question_type, equation, legacy_id",
+    "answer_rollups": "user_id, day, question_type, num1, num2, mode, level, attempts, correct, total_ms",
+    "activity_bitmaps": "user_id, base_day, days, counts",
+    "weak_spots": "user_id, number1, number2, error_count, last_error",
+}
+
+# Позначити в шарді рівні, на яких грав користувач (бітова маска); version
+# росте лише коли з'явився новий рівень -- тоді синхронізація перенесе його в каталог
+MARK_LEVELS_SQL = '''
+    INSERT INTO user_counters (user_id, levels, version) VALUES (?, ?, 1)
+    ON CONFLICT(user_id) DO UPDATE SET
+        levels = levels | excluded.levels,
+        version = version + 1
+    WHERE levels & excluded.levels != excluded.levels
+'''
+
+USER_COUNTER_COLUMNS = ("total_questions", "correct_answers", "wrong_answers",
+                        "current_streak", "best_streak", "last_activity", "levels")
+
+CATALOG_SYNC_BATCH_SIZE = 1000
+
+
+def shard_db_name(db_name: str, index: int) -> str:
+    """quiz_bot.db -> quiz_bot.shard0.db"""
+    root, ext = os.path.splitext(db_name)
+    return f"{root}.shard{index}{ext or '.db'}"
+
+
+def migrate_shards():
+    """Створити шарди поточного тенанта і один раз перенести в них дані з каталогу"""
+    t = tenant()
+    with get_db() as conn:
+        row = conn.execute("SELECT value FROM bot_settings WHERE name = 'db_shards'").fetchone()
+    stored = row[0] if row else 0
+    if stored and stored != t.db_shards:
+        logger.error(f"DB_SHARDS={t.db_shards}, але дані вже розкладено на {stored} шардів: "
+                     f"повторне шардування не підтримується, працюємо з {stored}")
+        t.db_shards = stored
+    if not t.db_shards:
+        return
+
+    for name in t.user_db_names():
+        with connect_db(name) as shard:
+            # На порожньому файлі auto_vacuum вмикається без VACUUM
+            shard.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            shard.executescript(SHARD_SCHEMA)
+            ensure_answer_history_columns(shard)
+            if WORKERS > 1:
+                shard.execute("PRAGMA journal_mode = WAL")
+
+    with get_db() as conn:
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(users)")]
+        if 'levels' not in columns:
+            logger.info("Додаємо колонку levels...")
+            conn.execute("ALTER TABLE users ADD COLUMN levels INTEGER NOT NULL DEFAULT 0")
+        if not stored:
+            move_catalog_to_shards(conn, t.db_shards)
+
+
+def move_catalog_to_shards(conn, count: int):
+    """Одноразово розкласти дані користувачів з каталогу по шардах
+
+    Копіювання через ATTACH і INSERT OR IGNORE: якщо процес впаде посередині,
+    наступний запуск просто повторить перенесення. Каталог очищується
+    і db_shards записується тільки після того, як заповнено всі шарди.
+    """
+    logger.info(f"Розкладаємо дані користувачів на {count} шардів...")
+    cursor = conn.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    existing = {row[0] for row in cursor.fetchall()}
+    tables = [table for table in SHARD_TABLES if table in existing]
+
+    # Рівні, на яких грав користувач, -- бітова маска для сегментів за рівнем
+    cursor.execute('''
+        UPDATE users SET levels = COALESCE((
+            SELECT SUM(bit) FROM (
+                SELECT 1 << level AS bit FROM answer_history h WHERE h.user_id = users.user_id
+                UNION
+                SELECT 1 << level FROM answer_rollups r WHERE r.user_id = users.user_id
+            )
+        ), 0)
+    ''')
+    conn.commit()
+
+    for index in range(count):
+        cursor.execute("ATTACH DATABASE ? AS shard", (shard_db_name(tenant().db_name, index),))
+        try:
+            for table in tables:
+                columns = SHARD_TABLES[table]
+                cursor.execute(f'''
+                    INSERT OR IGNORE INTO shard.{table} ({columns})
+                    SELECT {columns} FROM main.{table} WHERE user_id % ? = ?
+                ''', (count, index))
+            cursor.execute(f'''
+                INSERT OR IGNORE INTO shard.user_counters (user_id, {", ".join(USER_COUNTER_COLUMNS)})
+                SELECT user_id, COALESCE(total_questions, 0), COALESCE(correct_answers, 0),
+                       COALESCE(wrong_answers, 0), COALESCE(current_streak, 0),
+                       COALESCE(best_streak, 0), last_activity, levels
+                FROM main.users WHERE user_id % ? = ?
+            ''', (count, index))
+            # Скетч користувача -- у його шард, спільні когорти -- у шард 0 (get() зливає всі)
             cursor.execute('''
-                INSERT INTO users (user_id, username, first_name)
-                VALUES (?, ?, ?)
-            ''', (user_id, username, first_name))
+                INSERT OR IGNORE INTO shard.response_time_sketches (scope, scope_key, part, data)
+                SELECT scope, scope_key, part, data FROM main.response_time_sketches
+                WHERE CASE WHEN scope = 'user' THEN CAST(scope_key AS INTEGER) % ? = ? ELSE ? = 0 END
+            ''', (count, index, index))
             conn.commit()
+        finally:
+            cursor.execute("DETACH DATABASE shard")
+
+    for table in tables:
+        cursor.execute(f"DELETE FROM {table}")
+    cursor.execute("DELETE FROM response_time_sketches")
+    cursor.execute('''
+        INSERT INTO bot_settings (name, value) VALUES ('db_shards', ?)
+        ON CONFLICT(name) DO UPDATE SET value = excluded.value
+    ''', (count,))
+    conn.commit()
+    logger.info(f"✅ Дані користувачів розкладено на {count} шардів")
+
+
+def overlay_user_counters(user: dict) -> dict:
+    """Свіжі лічильники з шарда поверх копії в каталозі (вона відстає до CATALOG_SYNC_INTERVAL)"""
+    if user and tenant().db_shards:
+        with get_user_db(user['user_id']) as conn:
+            row = conn.execute(
+                f"SELECT {', '.join(USER_COUNTER_COLUMNS)} FROM user_counters WHERE user_id = ?",
+                (user['user_id'],)
+            ).fetchone()
+        if row:
+            user.update(dict(row))
+    return user
+
+
+@observe_query
+def sync_user_catalog() -> int:
+    """Перенести змінені лічильники з шардів у каталог (рейтинг, сегменти, пошук)"""
+    synced = 0
+    with get_db() as catalog:
+        for name in tenant().user_db_names():
+            with connect_db(name) as shard:
+                while True:
+                    rows = shard.execute(f'''
+                        SELECT user_id, version, {", ".join(USER_COUNTER_COLUMNS)}
+                        FROM user_counters
+                        WHERE version > synced_version
+                        LIMIT ?
+                    ''', (CATALOG_SYNC_BATCH_SIZE,)).fetchall()
+                    if not rows:
+                        break
+                    catalog.executemany(f'''
+                        UPDATE users SET {", ".join(f"{column} = ?" for column in USER_COUNTER_COLUMNS)}
+                        WHERE user_id = ?
+                    ''', [tuple(row[column] for column in USER_COUNTER_COLUMNS) + (row['user_id'],) for row in rows])
+                    catalog.commit()
+                    # Якщо користувач встиг відповісти ще раз, version уже більша -- рядок лишиться брудним
+                    shard.executemany(
+                        "UPDATE user_counters SET synced_version = ? WHERE user_id = ?",
+                        [(row['version'], row['user_id']) for row in rows]
+                    )
+                    shard.commit()
+                    synced += len(rows)
+    return synced
+
+
+async def catalog_sync_loop():
+    """Періодично оновлювати каталог лічильниками з шардів"""
+    while True:
+        await asyncio.sleep(CATALOG_SYNC_INTERVAL)
+        try:
+            with timed(LOOP_SECONDS, "catalog_sync"):
+                sync_user_catalog()
+        except Exception as e:
+            logger.error(f"Помилка синхронізації каталогу: {e}")
+
+
+# ═══════════════════════════════════════════════════════════
+# СХОВИЩЕ
+# ═══════════════════════════════════════════════════════════
+
+class Repository(ABC):
+    """Репозиторій даних: користувачі, відповіді, слабкі місця, календар,
+    адмін-сповіщення та вайтліст
+
+    Обробники ходять у дані лише через модульні функції-обгортки
+    (get_user_stats, save_answer_history, ...) і access_control, а ті --
+    через repository поточного тенанта. Outbox, пошук і сегменти розсилок
+    лишаються на SQLite-каталозі.
+
+    uses_catalog -- чи лежать користувачі в таблиці users каталогу: пошук,
+    сторінки вайтліста й сповіщень і сегменти розсилок читають її напряму.
+    """
+
+    uses_catalog = True
+
+    # Користувачі
+    @abstractmethod
+    def get_or_create_user(self, user_id: int, username: str, first_name: str) -> dict:
+        ...
+
+    @abstractmethod
+    def get_user(self, user_id: int) -> dict:
+        ...
+
+    @abstractmethod
+    def set_custom_name(self, user_id: int, custom_name: str):
+        ...
+
+    @abstractmethod
+    def set_reminders(self, user_id: int, enabled: bool):
+        ...
+
+    @abstractmethod
+    def set_delivery_status(self, user_id: int, status: Optional[str]):
+        ...
+
+    @abstractmethod
+    def reminder_candidates(self) -> List[dict]:
+        """Живі чати з увімкненими нагадуваннями: user_id, імена, last_activity"""
+
+    @abstractmethod
+    def leaderboard(self, limit: int) -> List[dict]:
+        ...
+
+    # Відповіді
+    @abstractmethod
+    def record_result(self, user_id: int, is_correct: bool):
+        """Лічильники і серії після відповіді"""
+
+    @abstractmethod
+    def save_answer(self, user_id: int, answer: tuple, sample: Optional[tuple] = None):
+        """answer -- рядок answer_history без user_id (answered_at ... equation),
+        sample -- (mode, level, response_time) для скетчів швидкості"""
+
+    # Слабкі місця
+    @abstractmethod
+    def track_weak_spot(self, user_id: int, num1: int, num2: int):
+        ...
+
+    @abstractmethod
+    def get_weak_spots(self, user_id: int, limit: int) -> List[Dict]:
+        ...
+
+    # Календар
+    @abstractmethod
+    def mark_activity(self, user_id: int, day: int):
+        ...
+
+    @abstractmethod
+    def get_calendar(self, user_id: int) -> Optional["ActivityBitmap"]:
+        ...
+
+    # Адмін-сповіщення: значення за замовчуванням + винятки з нього
+    @abstractmethod
+    def load_admin_notif(self) -> tuple:
+        """-> (default, множина винятків)"""
+
+    @abstractmethod
+    def set_admin_notif(self, user_id: int, value: bool, default: bool):
+        ...
+
+    @abstractmethod
+    def set_admin_notif_default(self, value: bool):
+        ...
+
+    # Вайтліст і підписки; announce -- повідомлення в outbox разом зі зміною
+    @abstractmethod
+    def whitelisted_ids(self) -> set:
+        ...
+
+    @abstractmethod
+    def seed_whitelist(self, user_ids: List[int]):
+        """Постійний доступ тим ID, яких сховище ще не знає (WHITELIST з конфігу)"""
+
+    @abstractmethod
+    def grant_access(self, user_ids: List[int], days: Optional[int], now: int,
+                     announce: Optional[dict] = None, announce_ids: List[int] = ()) -> Dict[int, Optional[int]]:
+        ...
+
+    @abstractmethod
+    def revoke_access(self, user_ids: List[int], announce: Optional[dict] = None):
+        ...
+
+    @abstractmethod
+    def next_expiry(self) -> Optional[int]:
+        ...
+
+    @abstractmethod
+    def expire_due(self, now: int, announce: Optional[dict] = None) -> List[int]:
+        ...
+
+    # Скетчі швидкості (пише save_answer з sample)
+    @abstractmethod
+    def speed_sketch(self, scope: str, scope_key) -> "ResponseTimeSketch":
+        """Злитий скетч однієї когорти: ("user", id), ("global", "all") тощо"""
+
+    @abstractmethod
+    def speed_sketches(self, scope: str) -> Dict[str, "ResponseTimeSketch"]:
+        """Усі когорти одного виміру (наприклад, усі режими)"""
+
+
+@observe_queries
+class SqliteRepository(Repository):
+    """Сховище в SQLite: каталог DB_NAME + шарди з даними користувачів"""
+
+    def get_or_create_user(self, user_id: int, username: str, first_name: str) -> dict:
+        """Спершу читання; upsert -- лише для нового користувача або змін
+
+        username/first_name оновлюються, щоб завжди були актуальними.
+        Користувач пише боту -- отже чат знову живий, is_blocked скидається.
+        Звичайне оновлення від відомого користувача не відкриває транзакцію
+        запису на каталозі.
+        """
+        with get_db() as conn:
+            cursor = conn.cursor()
             cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
             user = cursor.fetchone()
-        
-        return dict(user) if user else {}
+            if (user is None or user["username"] != username or user["first_name"] != first_name
+                    or user["is_blocked"] or user["delivery_status"] is not None):
+                cursor.execute('''
+                    INSERT INTO users (user_id, username, first_name)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        username = excluded.username,
+                        first_name = excluded.first_name,
+                        is_blocked = 0,
+                        delivery_status = NULL
+                    RETURNING *
+                ''', (user_id, username, first_name))
+                user = cursor.fetchone()
+                conn.commit()
+        return overlay_user_counters(dict(user)) if user else {}
+
+    def get_user(self, user_id: int) -> dict:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+            user = cursor.fetchone()
+        return overlay_user_counters(dict(user)) if user else {}
 
+    def set_custom_name(self, user_id: int, custom_name: str):
+        with get_db() as conn:
+            conn.execute('UPDATE users SET custom_name = ? WHERE user_id = ?', (custom_name, user_id))
+            conn.commit()
 
-def update_user_stats(user_id: int, is_correct: bool):
-    """Оновити статистику користувача"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        
-        if is_correct:
+    def set_reminders(self, user_id: int, enabled: bool):
+        with get_db() as conn:
+            conn.execute('UPDATE users SET reminder_enabled = ? WHERE user_id = ?', (int(enabled), user_id))
+            conn.commit()
+
+    def set_delivery_status(self, user_id: int, status: Optional[str]):
+        with get_db() as conn:
+            conn.execute(
+                'UPDATE users SET delivery_status = ?, is_blocked = ? WHERE user_id = ?',
+                (status, 1 if status in DEAD_DELIVERY_STATUSES else 0, user_id)
+            )
+            conn.commit()
+
+    def reminder_candidates(self) -> List[dict]:
+        with get_db() as conn:
+            cursor = conn.cursor()
             cursor.execute('''
-                UPDATE users 
-                SET total_questions = total_questions + 1,
-                    correct_answers = correct_answers + 1,
-                    current_streak = current_streak + 1,
-                    last_activity = CURRENT_TIMESTAMP
-                WHERE user_id = ?
-            ''', (user_id,))
-            
+                SELECT user_id, first_name, custom_name, last_activity
+                FROM users
+                WHERE reminder_enabled = 1 AND is_blocked = 0
+            ''')
+            return [dict(row) for row in cursor.fetchall()]
+
+    def leaderboard(self, limit: int) -> List[dict]:
+        with get_db() as conn:
+            cursor = conn.cursor()
             cursor.execute('''
-                UPDATE users 
-                SET best_streak = current_streak
-                WHERE user_id = ? AND current_streak > best_streak
-            ''', (user_id,))
-        else:
+                SELECT first_name, custom_name, correct_answers, total_questions, best_streak
+                FROM users WHERE total_questions > 0
+                ORDER BY correct_answers DESC, best_streak DESC LIMIT ?
+            ''', (limit,))
+            return [dict(row) for row in cursor.fetchall()]
+
+    def record_result(self, user_id: int, is_correct: bool):
+        if tenant().db_shards:
+            # Один upsert у шард: праві частини SET бачать старі значення рядка
+            with get_user_db(user_id) as conn:
+                conn.execute('''
+                    INSERT INTO user_counters
+                    (user_id, total_questions, correct_answers, wrong_answers,
+                     current_streak, best_streak, last_activity, version)
+                    VALUES (?, 1, ?, ?, ?, ?, CURRENT_TIMESTAMP, 1)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        total_questions = total_questions + 1,
+                        correct_answers = correct_answers + excluded.correct_answers,
+                        wrong_answers = wrong_answers + excluded.wrong_answers,
+                        current_streak = CASE WHEN excluded.correct_answers THEN current_streak + 1 ELSE 0 END,
+                        best_streak = MAX(best_streak, CASE WHEN excluded.correct_answers THEN current_streak + 1 ELSE 0 END),
+                        last_activity = excluded.last_activity,
+                        version = version + 1
+                ''', (user_id, int(is_correct), int(not is_correct), int(is_correct), int(is_correct)))
+                conn.commit()
+            return
+
+        with get_db() as conn:
+            cursor = conn.cursor()
+
+            if is_correct:
+                cursor.execute('''
+                    UPDATE users 
+                    SET total_questions = total_questions + 1,
+                        correct_answers = correct_answers + 1,
+                        current_streak = current_streak + 1,
+                        last_activity = CURRENT_TIMESTAMP
+                    WHERE user_id = ?
+                ''', (user_id,))
+
+                cursor.execute('''
+                    UPDATE users 
+                    SET best_streak = current_streak
+                    WHERE user_id = ? AND current_streak > best_streak
+                ''', (user_id,))
+            else:
+                cursor.execute('''
+                    UPDATE users 
+                    SET total_questions = total_questions + 1,
+                        wrong_answers = wrong_answers + 1,
+                        current_streak = 0,
+                        last_activity = CURRENT_TIMESTAMP
+                    WHERE user_id = ?
+                ''', (user_id,))
+
+            conn.commit()
+
+    def save_answer(self, user_id: int, answer: tuple, sample: Optional[tuple] = None):
+        with get_user_db(user_id) as conn:
+            cursor = conn.cursor()
             cursor.execute('''
-                UPDATE users 
-                SET total_questions = total_questions + 1,
-                    wrong_answers = wrong_answers + 1,
-                    current_streak = 0,
-                    last_activity = CURRENT_TIMESTAMP
+                INSERT INTO answer_history 
+                (user_id, answered_at, num1, num2, user_answer, correct_answer,
+                 is_correct, response_ms, level, mode, question_type, equation)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (user_id,) + answer)
+            if sample is not None:
+                response_sketches.record(conn, user_id, *sample)
+            if tenant().db_shards:
+                # Без шардування сегмент за рівнем дивиться прямо в answer_history
+                cursor.execute(MARK_LEVELS_SQL, (user_id, 1 << answer[7]))
+            conn.commit()
+
+    def track_weak_spot(self, user_id: int, num1: int, num2: int):
+        with get_user_db(user_id) as conn:
+            conn.execute('''
+                INSERT INTO weak_spots (user_id, number1, number2, error_count, last_error)
+                VALUES (?, ?, ?, 1, CURRENT_TIMESTAMP)
+                ON CONFLICT(user_id, number1, number2) 
+                DO UPDATE SET error_count = error_count + 1, last_error = CURRENT_TIMESTAMP
+            ''', (user_id, num1, num2))
+            conn.commit()
+
+    def get_weak_spots(self, user_id: int, limit: int) -> List[Dict]:
+        with get_user_db(user_id) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT number1, number2, error_count
+                FROM weak_spots
                 WHERE user_id = ?
-            ''', (user_id,))
-        
-        conn.commit()
+                ORDER BY error_count DESC, last_error DESC
+                LIMIT ?
+            ''', (user_id, limit))
+            return [dict(row) for row in cursor.fetchall()]
+
+    def mark_activity(self, user_id: int, day: int):
+        with get_user_db(user_id) as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT base_day, days, counts FROM activity_bitmaps WHERE user_id = ?', (user_id,))
+            row = cursor.fetchone()
+            bitmap = ActivityBitmap.from_row(row) if row else ActivityBitmap(day)
+            bitmap.mark(day)
+            _save_activity_bitmap(cursor, user_id, bitmap)
+            conn.commit()
+
+    def get_calendar(self, user_id: int) -> Optional["ActivityBitmap"]:
+        with get_user_db(user_id) as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT base_day, days, counts FROM activity_bitmaps WHERE user_id = ?', (user_id,))
+            row = cursor.fetchone()
+            return ActivityBitmap.from_row(row) if row else None
+
+    def load_admin_notif(self) -> tuple:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT value FROM bot_settings WHERE name = 'admin_notif_default'")
+            row = cursor.fetchone()
+            default = bool(row[0]) if row else True
+            cursor.execute("SELECT user_id FROM admin_notification_settings WHERE enabled != ?",
+                           (int(default),))
+            return default, {row[0] for row in cursor.fetchall()}
+
+    def set_admin_notif(self, user_id: int, value: bool, default: bool):
+        with get_db() as conn:
+            cursor = conn.cursor()
+            if value == default:
+                cursor.execute("DELETE FROM admin_notification_settings WHERE user_id = ?", (user_id,))
+            else:
+                cursor.execute('''
+                    INSERT INTO admin_notification_settings (user_id, enabled)
+                    VALUES (?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET enabled=excluded.enabled
+                ''', (user_id, int(value)))
+            conn.commit()
+
+    def set_admin_notif_default(self, value: bool):
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO bot_settings (name, value) VALUES ('admin_notif_default', ?)
+                ON CONFLICT(name) DO UPDATE SET value = excluded.value
+            ''', (int(value),))
+            cursor.execute("DELETE FROM admin_notification_settings")
+            conn.commit()
+
+    def whitelisted_ids(self) -> set:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT user_id FROM users WHERE is_whitelisted = 1")
+            return {row[0] for row in cursor.fetchall()}
+
+    def seed_whitelist(self, user_ids: List[int]):
+        # Наявний рядок не чіпаємо: адмін міг уже забрати доступ через /removewhite
+        with get_db() as conn:
+            conn.executemany("INSERT OR IGNORE INTO users (user_id, is_whitelisted) VALUES (?, 1)",
+                             [(uid,) for uid in user_ids])
+            conn.commit()
+
+    def grant_access(self, user_ids: List[int], days: Optional[int], now: int,
+                     announce: Optional[dict] = None, announce_ids: List[int] = ()) -> Dict[int, Optional[int]]:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            # Користувач міг ще не писати боту -- створюємо запис заздалегідь
+            cursor.executemany("INSERT OR IGNORE INTO users (user_id) VALUES (?)",
+                               [(uid,) for uid in user_ids])
+            if days:
+                # Активна підписка продовжується від дати закінчення, інакше -- від сьогодні;
+                # безстроковий доступ строком не обмежуємо
+                cursor.executemany('''
+                    UPDATE users SET
+                        subscription_expires = CASE
+                            WHEN is_whitelisted = 1 AND subscription_expires IS NULL THEN NULL
+                            WHEN is_whitelisted = 1 AND subscription_expires > ?1
+                            THEN subscription_expires + ?2
+                            ELSE ?1 + ?2
+                        END,
+                        is_whitelisted = 1
+                    WHERE user_id = ?3
+                ''', [(now, days * 86400, uid) for uid in user_ids])
+            else:
+                cursor.executemany('''
+                    UPDATE users SET is_whitelisted = 1, subscription_expires = NULL
+                    WHERE user_id = ?
+                ''', [(uid,) for uid in user_ids])
+            expires = {}
+            for chunk_start in range(0, len(user_ids), 500):
+                chunk = user_ids[chunk_start:chunk_start + 500]
+                cursor.execute(
+                    f"SELECT user_id, subscription_expires FROM users WHERE user_id IN ({','.join('?' * len(chunk))})",
+                    chunk
+                )
+                expires.update({row[0]: row[1] for row in cursor.fetchall()})
+            if announce:
+                outbox_enqueue(cursor, [(uid, announce) for uid in announce_ids])
+            conn.commit()
+        return expires
+
+    def revoke_access(self, user_ids: List[int], announce: Optional[dict] = None):
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                UPDATE users SET is_whitelisted = 0, subscription_expires = NULL
+                WHERE user_id = ?
+            ''', [(uid,) for uid in user_ids])
+            if announce:
+                outbox_enqueue(cursor, [(uid, announce) for uid in user_ids])
+            conn.commit()
+
+    def next_expiry(self) -> Optional[int]:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT MIN(subscription_expires) FROM users
+                WHERE subscription_expires IS NOT NULL
+            ''')
+            return cursor.fetchone()[0]
+
+    def expire_due(self, now: int, announce: Optional[dict] = None) -> List[int]:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT user_id FROM users
+                WHERE subscription_expires IS NOT NULL AND subscription_expires <= ?
+            ''', (now,))
+            expired = [row[0] for row in cursor.fetchall()]
+            if expired:
+                cursor.execute('''
+                    UPDATE users SET is_whitelisted = 0, subscription_expires = NULL
+                    WHERE subscription_expires IS NOT NULL AND subscription_expires <= ?
+                ''', (now,))
+                if announce:
+                    outbox_enqueue(cursor, [(uid, announce) for uid in expired])
+                conn.commit()
+        return expired
+
+    def speed_sketch(self, scope: str, scope_key) -> "ResponseTimeSketch":
+        return response_sketches.get(scope, scope_key)
+
+    def speed_sketches(self, scope: str) -> Dict[str, "ResponseTimeSketch"]:
+        return response_sketches.get_scope(scope)
+
+
+def _sql_timestamp() -> str:
+    """Те саме, що CURRENT_TIMESTAMP у SQLite (UTC, без мікросекунд)"""
+    return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+
+@observe_queries
+class MemoryRepository(Repository):
+    """Сховище в пам'яті процесу: для навантажувальних і швидких тестів
+
+    Дані живуть лише до перезапуску і не діляться між воркерами (WORKERS > 1).
+    Скетчі швидкості теж у пам'яті. Повідомлення announce все одно йдуть у
+    SQLite-outbox каталогу. Таблиця users каталогу порожня, тому пошук,
+    сторінки вайтліста й сповіщень і розсилки в цьому режимі вимкнені
+    (uses_catalog): це бекенд для тестів, а не повна заміна SQLite.
+    """
+
+    uses_catalog = False
+
+    USER_DEFAULTS = {
+        "username": None, "first_name": None, "custom_name": None,
+        "total_questions": 0, "correct_answers": 0, "wrong_answers": 0,
+        "current_streak": 0, "best_streak": 0,
+        "reminder_enabled": 1, "last_reminder_date": None,
+        "is_whitelisted": 0, "subscription_expires": None,
+        "is_blocked": 0, "delivery_status": None,
+    }
+
+    def __init__(self):
+        self.users: Dict[int, dict] = {}
+        self.answers: Dict[int, list] = {}
+        self.weak_spots: Dict[tuple, list] = {}  # (user_id, num1, num2) -> [кількість, last_error]
+        self.calendars: Dict[int, ActivityBitmap] = {}
+        self.sketches: Dict[tuple, ResponseTimeSketch] = {}  # (scope, scope_key) -> скетч
+        self.admin_notif_default = True
+        self.admin_notif_exceptions: set = set()
+
+    def _user(self, user_id: int) -> dict:
+        user = self.users.get(user_id)
+        if user is None:
+            now = _sql_timestamp()
+            user = self.users[user_id] = dict(self.USER_DEFAULTS, user_id=user_id,
+                                              start_date=now, last_activity=now)
+        return user
+
+    def get_or_create_user(self, user_id: int, username: str, first_name: str) -> dict:
+        user = self._user(user_id)
+        user.update(username=username, first_name=first_name, is_blocked=0, delivery_status=None)
+        return dict(user)
+
+    def get_user(self, user_id: int) -> dict:
+        user = self.users.get(user_id)
+        return dict(user) if user else {}
+
+    def set_custom_name(self, user_id: int, custom_name: str):
+        if user_id in self.users:
+            self.users[user_id]["custom_name"] = custom_name
+
+    def set_reminders(self, user_id: int, enabled: bool):
+        if user_id in self.users:
+            self.users[user_id]["reminder_enabled"] = int(enabled)
+
+    def set_delivery_status(self, user_id: int, status: Optional[str]):
+        if user_id in self.users:
+            self.users[user_id].update(delivery_status=status,
+                                       is_blocked=1 if status in DEAD_DELIVERY_STATUSES else 0)
+
+    def reminder_candidates(self) -> List[dict]:
+        return [
+            {key: user[key] for key in ("user_id", "first_name", "custom_name", "last_activity")}
+            for user in self.users.values()
+            if user["reminder_enabled"] == 1 and not user["is_blocked"]
+        ]
+
+    def leaderboard(self, limit: int) -> List[dict]:
+        players = [user for user in self.users.values() if user["total_questions"] > 0]
+        players.sort(key=lambda user: (user["correct_answers"], user["best_streak"]), reverse=True)
+        return [
+            {key: user[key] for key in ("first_name", "custom_name", "correct_answers",
+                                        "total_questions", "best_streak")}
+            for user in players[:limit]
+        ]
+
+    def record_result(self, user_id: int, is_correct: bool):
+        user = self.users.get(user_id)
+        if user is None:
+            return
+        apply_result(user, is_correct)
+        user["last_activity"] = _sql_timestamp()
+
+    def save_answer(self, user_id: int, answer: tuple, sample: Optional[tuple] = None):
+        self.answers.setdefault(user_id, []).append(answer)
+        if sample is not None:
+            mode, level, response_time = sample
+            for key in ResponseSketchStore.keys_for(user_id, mode, level):
+                self.sketches.setdefault(key, ResponseTimeSketch()).add(response_time)
+
+    def track_weak_spot(self, user_id: int, num1: int, num2: int):
+        spot = self.weak_spots.setdefault((user_id, num1, num2), [0, None])
+        spot[0] += 1
+        spot[1] = _sql_timestamp()
+
+    def get_weak_spots(self, user_id: int, limit: int) -> List[Dict]:
+        spots = [(key, spot) for key, spot in self.weak_spots.items() if key[0] == user_id]
+        spots.sort(key=lambda item: (item[1][0], item[1][1]), reverse=True)
+        return [{"number1": key[1], "number2": key[2], "error_count": spot[0]}
+                for key, spot in spots[:limit]]
+
+    def mark_activity(self, user_id: int, day: int):
+        bitmap = self.calendars.get(user_id)
+        if bitmap is None:
+            bitmap = self.calendars[user_id] = ActivityBitmap(day)
+        bitmap.mark(day)
+
+    def get_calendar(self, user_id: int) -> Optional["ActivityBitmap"]:
+        bitmap = self.calendars.get(user_id)
+        return ActivityBitmap(bitmap.base_day, bitmap.bits, array('H', bitmap.counts)) if bitmap else None
+
+    def load_admin_notif(self) -> tuple:
+        return self.admin_notif_default, set(self.admin_notif_exceptions)
+
+    def set_admin_notif(self, user_id: int, value: bool, default: bool):
+        if value == default:
+            self.admin_notif_exceptions.discard(user_id)
+        else:
+            self.admin_notif_exceptions.add(user_id)
+
+    def set_admin_notif_default(self, value: bool):
+        self.admin_notif_default = value
+        self.admin_notif_exceptions = set()
+
+    def whitelisted_ids(self) -> set:
+        return {user_id for user_id, user in self.users.items() if user["is_whitelisted"]}
+
+    def seed_whitelist(self, user_ids: List[int]):
+        for uid in user_ids:
+            if uid not in self.users:
+                self._user(uid)["is_whitelisted"] = 1
+
+    def _announce(self, user_ids: List[int], announce: Optional[dict]):
+        if announce and user_ids:
+            with get_db() as conn:
+                outbox_enqueue(conn.cursor(), [(uid, announce) for uid in user_ids])
+                conn.commit()
+
+    def grant_access(self, user_ids: List[int], days: Optional[int], now: int,
+                     announce: Optional[dict] = None, announce_ids: List[int] = ()) -> Dict[int, Optional[int]]:
+        expires = {}
+        for uid in user_ids:
+            user = self._user(uid)
+            if days and user["is_whitelisted"] and user["subscription_expires"] is None:
+                pass  # безстроковий доступ строком не обмежуємо
+            elif days:
+                active = user["is_whitelisted"] and (user["subscription_expires"] or 0) > now
+                user["subscription_expires"] = (user["subscription_expires"] if active else now) + days * 86400
+            else:
+                user["subscription_expires"] = None
+            user["is_whitelisted"] = 1
+            expires[uid] = user["subscription_expires"]
+        self._announce(list(announce_ids), announce)
+        return expires
+
+    def revoke_access(self, user_ids: List[int], announce: Optional[dict] = None):
+        for uid in user_ids:
+            if uid in self.users:
+                self.users[uid].update(is_whitelisted=0, subscription_expires=None)
+        self._announce(user_ids, announce)
+
+    def next_expiry(self) -> Optional[int]:
+        return min((user["subscription_expires"] for user in self.users.values()
+                    if user["subscription_expires"] is not None), default=None)
+
+    def expire_due(self, now: int, announce: Optional[dict] = None) -> List[int]:
+        expired = [uid for uid, user in self.users.items()
+                   if user["subscription_expires"] is not None and user["subscription_expires"] <= now]
+        self.revoke_access(expired, announce)
+        return expired
+
+    def speed_sketch(self, scope: str, scope_key) -> "ResponseTimeSketch":
+        merged = ResponseTimeSketch()
+        sketch = self.sketches.get((scope, str(scope_key)))
+        if sketch is not None:
+            merged.merge(sketch)
+        return merged
+
+    def speed_sketches(self, scope: str) -> Dict[str, "ResponseTimeSketch"]:
+        result = {}
+        for (sketch_scope, scope_key), sketch in self.sketches.items():
+            if sketch_scope == scope:
+                result[scope_key] = self.speed_sketch(scope, scope_key)
+        return result
+
+
+STORAGE_BACKENDS = {"sqlite": SqliteRepository, "memory": MemoryRepository}
+
+# Пошук, сторінки вайтліста й сповіщень і розсилки читають users каталогу напряму
+CATALOG_ONLY_TEXT = '❌ Недоступно зі STORAGE_BACKEND = "memory": команда читає користувачів з SQLite-каталогу'
+
+
+def create_repository(backend: str) -> Repository:
+    try:
+        return STORAGE_BACKENDS[backend]()
+    except KeyError:
+        raise ValueError(f"Невідоме сховище: {backend} (доступні: {', '.join(STORAGE_BACKENDS)})")
+
+
+repository = TenantLocal("repository")
+
+
+# ═══════════════════════════════════════════════════════════
+# КОРИСТУВАЧІ
+# ═══════════════════════════════════════════════════════════
+
+def get_or_create_user(user_id: int, username: str, first_name: str) -> dict:
+    """Отримати або створити користувача
+
+    username/first_name оновлюються, щоб завжди були актуальними.
+    Користувач пише боту -- отже чат знову живий, is_blocked скидається.
+    """
+    return repository.get_or_create_user(user_id, username, first_name)
+
+
+def update_user_stats(user_id: int, is_correct: bool):
+    """Оновити статистику користувача"""
+    repository.record_result(user_id, is_correct)
+
+
+def apply_result(stats: dict, is_correct: bool) -> dict:
+    """Ті самі зміни лічильників, що й record_result, -- над словником профілю
+
+    Обробник відповіді отримує профіль від UserContextMiddleware ще до запису
+    результату; так він показує нові значення без повторного читання з БД.
+    """
+    stats["total_questions"] += 1
+    if is_correct:
+        stats["correct_answers"] += 1
+        stats["current_streak"] += 1
+        stats["best_streak"] = max(stats["best_streak"], stats["current_streak"])
+    else:
+        stats["wrong_answers"] += 1
+        stats["current_streak"] = 0
+    return stats
+
+
+class AdminNotifPrefs:
+    """Налаштування адмін-сповіщень у пам'яті (write-through у БД)
+
+    Зберігається значення за замовчуванням і множина винятків з нього,
+    тому перевірка -- це пошук у множині, а "всі увімк./вимк." --
+    один DELETE без перебору користувачів.
+    """
+
+    def __init__(self):
+        self.default = True
+        self.exceptions = set()
+
+    def load(self):
+        self.default, self.exceptions = repository.load_admin_notif()
+        logger.info(f"🔔 Налаштування сповіщень: за замовчуванням {'увімк.' if self.default else 'вимк.'}, винятків {len(self.exceptions)}")
+
+    def is_enabled(self, user_id: int) -> bool:
+        return self.default != (user_id in self.exceptions)
+
+    def set_enabled(self, user_id: int, value: bool):
+        repository.set_admin_notif(user_id, value, self.default)
+        if value == self.default:
+            self.exceptions.discard(user_id)
+        else:
+            self.exceptions.add(user_id)
+        worker.publish("admin_notif")
+
+    def set_all(self, value: bool):
+        repository.set_admin_notif_default(value)
+        self.default = value
+        self.exceptions = set()
+        worker.publish("admin_notif")
+
+
+admin_notif_prefs = TenantLocal("admin_notif_prefs")
+
 
 def is_admin_notif_enabled(user_id: int) -> bool:
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT enabled FROM admin_notification_settings WHERE user_id = ?", (user_id,))
-        row = cursor.fetchone()
-        return bool(row["enabled"]) if row else True  # якщо нема запису -- вмикаємо за замовчуванням
+    return admin_notif_prefs.is_enabled(user_id)
 
 def set_admin_notif_enabled(user_id: int, value: bool = True):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO admin_notification_settings (user_id, enabled)
-            VALUES (?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET enabled=excluded.enabled
-        ''', (user_id, int(value)))
-        conn.commit()
+    admin_notif_prefs.set_enabled(user_id, value)
 
 def set_admin_notif_all(value: bool = True):
+    admin_notif_prefs.set_all(value)
+
+NOTIF_PAGE_SIZE = 24
+NOTIF_MENU_TEXT = "🔔 КЕРУВАННЯ СПОВІЩЕННЯМИ АДМІНУ\n\nОбирай від кого отримувати повідомлення:"
+
+
+class PageCache:
+    """Невеликий LRU-кеш сторінок з часом життя"""
+
+    def __init__(self, ttl: float = 60, max_size: int = 256):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+    def get(self, key: tuple):
+        item = self._items.get(key)
+        if item is None or time.monotonic() - item[0] > self.ttl:
+            self._items.pop(key, None)
+            return None
+        self._items.move_to_end(key)
+        return item[1]
+
+    def put(self, key: tuple, value):
+        self._items[key] = (time.monotonic(), value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+
+notif_page_cache = TenantLocal("notif_page_cache")
+
+
+def fts_query(query: str) -> str:
+    """Перетворити введений текст у безпечний префіксний запит FTS5"""
+    tokens = re.findall(r"\w+", query.lower())
+    return " ".join(f'"{token}"*' for token in tokens)
+
+
+def user_name_filter(query: str) -> tuple:
+    """SQL-умова пошуку користувачів за ім'ям (через user_directory)"""
+    match = fts_query(query)
+    if not match:
+        return "1", ()
+    return "user_id IN (SELECT rowid FROM user_directory WHERE user_directory MATCH ?)", (match,)
+
+
+@observe_query
+def search_users(query: str, limit: int = 10) -> List[dict]:
+    """Пошук користувачів: точний ID або ранжований збіг за іменами"""
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute("UPDATE admin_notification_settings SET enabled = ?", (int(value),))
-        # Також для нових користувачів без налаштувань:
-        cursor.execute("SELECT user_id FROM users")
-        user_list = [row[0] for row in cursor.fetchall()]
-        for user_id in user_list:
+        results = []
+        if query.strip().isdigit():
             cursor.execute('''
-                INSERT OR IGNORE INTO admin_notification_settings (user_id, enabled)
-                VALUES (?, ?)
-            ''', (user_id, int(value)))
-        conn.commit()
+                SELECT user_id, username, first_name, custom_name, is_whitelisted, total_questions
+                FROM users WHERE user_id = ?
+            ''', (int(query.strip()),))
+            results = [dict(row) for row in cursor.fetchall()]
 
-def get_admin_notif_overview() -> list:
+        match = fts_query(query)
+        if match:
+            cursor.execute('''
+                SELECT u.user_id, u.username, u.first_name, u.custom_name,
+                       u.is_whitelisted, u.total_questions
+                FROM user_directory d
+                JOIN users u ON u.user_id = d.rowid
+                WHERE user_directory MATCH ?
+                ORDER BY bm25(user_directory, 1.0, 2.0, 3.0)
+                LIMIT ?
+            ''', (match, limit))
+            seen = {r['user_id'] for r in results}
+            results += [dict(row) for row in cursor.fetchall() if row['user_id'] not in seen]
+        return results[:limit]
+
+
+WHITELIST_PAGE_SIZE = 30
+
+
+@observe_query
+def get_whitelist_page(after: int = 0) -> dict:
+    """Сторінка вайтліста (keyset по user_id) і загальна кількість -- раз на сторінку"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT user_id, custom_name, first_name, username, subscription_expires
+            FROM users
+            WHERE is_whitelisted = 1 AND user_id > ?
+            ORDER BY user_id
+            LIMIT ?
+        ''', (after, WHITELIST_PAGE_SIZE + 1))
+        rows = [dict(row) for row in cursor.fetchall()]
+        cursor.execute("SELECT COUNT(*) FROM users WHERE is_whitelisted = 1")
+        total = cursor.fetchone()[0]
+    return {
+        "users": rows[:WHITELIST_PAGE_SIZE],
+        "has_next": len(rows) > WHITELIST_PAGE_SIZE,
+        "total": total,
+    }
+
+
+@observe_query
+def get_notif_users_page(after: int = 0, query: str = "", backwards: bool = False) -> dict:
+    """Сторінка користувачів для меню сповіщень (keyset по user_id)
+
+    after -- сторінка містить user_id > after; backwards -- попередня
+    сторінка перед user_id = after + 1.
+    """
+    key = (query, after, backwards)
+    page = notif_page_cache.get(key)
+    if page is not None:
+        return page
+
+    where, params = user_name_filter(query)
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT user_id, enabled FROM admin_notification_settings")
-        res = {row[0]: bool(row[1]) for row in cursor.fetchall()}
-        # Оновлюємо/дозаповнюємо списком всіх користувачів
-        cursor.execute("SELECT user_id, custom_name, first_name FROM users")
-        users = []
-        for row in cursor.fetchall():
-            uid = row[0]
-            users.append({
-                "user_id": uid,
-                "name": row[1] if row[1] else row[2],
-                "enabled": res.get(uid, True)
-            })
-        return users
-
-def create_admin_notif_menu():
-    users = get_admin_notif_overview()
+        if backwards:
+            cursor.execute(f'''
+                SELECT user_id, custom_name, first_name FROM users
+                WHERE user_id <= ? AND {where}
+                ORDER BY user_id DESC LIMIT ?
+            ''', (after, *params, NOTIF_PAGE_SIZE))
+            rows = cursor.fetchall()[::-1]
+            after = rows[0][0] - 1 if rows else 0
+        else:
+            cursor.execute(f'''
+                SELECT user_id, custom_name, first_name FROM users
+                WHERE user_id > ? AND {where}
+                ORDER BY user_id LIMIT ?
+            ''', (after, *params, NOTIF_PAGE_SIZE + 1))
+            rows = cursor.fetchall()
+
+        has_next = len(rows) > NOTIF_PAGE_SIZE
+        rows = rows[:NOTIF_PAGE_SIZE]
+        if backwards and rows:
+            cursor.execute(f"SELECT 1 FROM users WHERE user_id > ? AND {where} LIMIT 1",
+                           (rows[-1][0], *params))
+            has_next = cursor.fetchone() is not None
+        cursor.execute(f"SELECT 1 FROM users WHERE user_id <= ? AND {where} LIMIT 1", (after, *params))
+        has_prev = cursor.fetchone() is not None
+
+    page = {
+        "after": after,
+        "users": [(row[0], row[1] or row[2] or str(row[0])) for row in rows],
+        "has_prev": has_prev,
+        "has_next": has_next,
+    }
+    notif_page_cache.put((query, after, False), page)
+    if backwards:
+        notif_page_cache.put(key, page)
+    return page
+
+
+def create_admin_notif_menu(after: int = 0, query: str = "", backwards: bool = False):
+    page = get_notif_users_page(after, query, backwards)
+    after = page["after"]
     builder = InlineKeyboardBuilder()
-    row = []
-    for idx, user in enumerate(users, 1):
-        mark = "✅" if user['enabled'] else "❌"
-        text = f"{mark} {user['name']}"
-        builder.button(text=text, callback_data=f"toggle_notif_{user['user_id']}")
-        if idx % 3 == 0:
-            builder.adjust(3)
+    for uid, name in page["users"]:
+        mark = "✅" if is_admin_notif_enabled(uid) else "❌"
+        builder.button(text=f"{mark} {name}", callback_data=f"toggle_notif_{uid}_{after}")
+    sizes = [3] * ((len(page["users"]) + 2) // 3)
+
+    nav = 0
+    if page["has_prev"]:
+        builder.button(text="⬅️ Назад", callback_data=f"notif_prev_{after}")
+        nav += 1
+    if page["has_next"]:
+        builder.button(text="➡️ Далі", callback_data=f"notif_next_{page['users'][-1][0]}")
+        nav += 1
+    if nav:
+        sizes.append(nav)
+
     # Завжди додаємо після всі юзери
     builder.button(text="🔔 Від усіх отримувати", callback_data="notif_all_enable")
     builder.button(text="🔕 Не отримувати", callback_data="notif_all_disable")
-    builder.adjust(3, 2)
+    sizes.append(2)
+    builder.adjust(*sizes)
     return builder
 
 
-def save_answer_history(user_id: int, question: str, question_type: str,
+# Коди режимів і типів питань для компактної answer_history
+MODE_CODES = {
+    "normal": 0,
+    "random": 1,
+    "specific": 2,
+    "weak_spots": 3,
+    "lightning": 4,
+    "sniper": 5,
+    "training": 6,
+    "find_x": 7,
+}
+MODE_NAMES = {code: name for name, code in MODE_CODES.items()}
+
+QUESTION_TYPE_CODES = {"standard": 0, "find_x": 1}
+QUESTION_TYPE_NAMES = {code: name for name, code in QUESTION_TYPE_CODES.items()}
+
+
+def save_answer_history(user_id: int, num1: int, num2: int, question_type: str,
                        user_answer: int, correct_answer: int, is_correct: bool, 
-                       response_time: float, level: int, mode: str = "normal"):
-    """Зберегти історію відповіді"""
-    with get_db() as conn:
+                       response_time: float, level: int, mode: str = "normal",
+                       timed_out: bool = False, equation: Optional[str] = None):
+    """Зберегти історію відповіді
+
+    Для "Знайди X" num1 -- відомий множник, num2 -- x, equation -- текст
+    рівняння (доданок і знак множника з них не відновити).
+    """
+    answer = (int(time.time()), num1, num2, user_answer, correct_answer,
+              int(is_correct), int(round(response_time * 1000)), level,
+              MODE_CODES.get(mode, 0), QUESTION_TYPE_CODES.get(question_type, 0), equation)
+    # Таймаути не є реальною швидкістю відповіді -- у скетчі не пишемо
+    repository.save_answer(user_id, answer, None if timed_out else (mode, level, response_time))
+    ANSWER_SECONDS.observe(response_time, mode, "timeout" if timed_out else "correct" if is_correct else "wrong")
+
+    # Дублюємо у журнал подій для аналітики поза живою БД
+    try:
+        answer_event_log.append(
+            user_id, num1, num2, user_answer, correct_answer,
+            int(round(response_time * 1000)),
+            pack_event_flags(level, mode, question_type, is_correct, timed_out)
+        )
+    except OSError as e:
+        logger.error(f"Помилка запису журналу подій: {e}")
+
+
+# ═══════════════════════════════════════════════════════════
+# ЗБЕРІГАННЯ ТА ЗГОРТАННЯ ІСТОРІЇ
+# ═══════════════════════════════════════════════════════════
+
+RETENTION_INTERVAL = 6 * 3600  # як часто запускати згортання (секунди)
+RETENTION_PAUSE = 0.1          # пауза між порціями
+VACUUM_PAGES_PER_STEP = 1000
+
+
+@observe_query
+def rollup_answer_batch(path: str, cutoff: int, batch_size: int = RETENTION_BATCH_SIZE) -> int:
+    """Згорнути одну порцію відповідей файлу path, старіших за cutoff (epoch)
+
+    Агрегати і видалення сирих рядків -- в одній короткій транзакції.
+    """
+    with connect_db(path) as conn:
         cursor = conn.cursor()
+        cursor.execute("DROP TABLE IF EXISTS temp.retention_batch")
         cursor.execute('''
-            INSERT INTO answer_history 
-            (user_id, question, question_type, user_answer, correct_answer, 
-             is_correct, response_time, level, mode)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (user_id, question, question_type, user_answer, correct_answer, 
-              is_correct, response_time, level, mode))
+            CREATE TEMP TABLE retention_batch AS
+            SELECT id FROM answer_history
+            WHERE answered_at < ?
+            ORDER BY answered_at
+            LIMIT ?
+        ''', (cutoff, batch_size))
+        cursor.execute("SELECT COUNT(*) FROM temp.retention_batch")
+        count = cursor.fetchone()[0]
+
+        if count:
+            cursor.execute('''
+                INSERT INTO answer_rollups
+                (user_id, day, question_type, num1, num2, mode, level, attempts, correct, total_ms)
+                SELECT user_id, answered_at / 86400, question_type, num1, num2, mode, level,
+                       COUNT(*), SUM(is_correct), SUM(response_ms)
+                FROM answer_history
+                WHERE id IN (SELECT id FROM temp.retention_batch)
+                GROUP BY user_id, answered_at / 86400, question_type, num1, num2, mode, level
+                ON CONFLICT(user_id, day, question_type, num1, num2, mode, level) DO UPDATE SET
+                    attempts = attempts + excluded.attempts,
+                    correct = correct + excluded.correct,
+                    total_ms = total_ms + excluded.total_ms
+            ''')
+            cursor.execute("DELETE FROM answer_history WHERE id IN (SELECT id FROM temp.retention_batch)")
+
+        cursor.execute("DROP TABLE temp.retention_batch")
         conn.commit()
+        return count
 
 
-def update_activity_calendar(user_id: int):
-    """Оновити календар активності"""
-    today = str(datetime.now().date())  # ← Перетворюємо на рядок
+@observe_query
+def incremental_vacuum_step(path: str, pages: int = VACUUM_PAGES_PER_STEP) -> Optional[int]:
+    """Повернути до pages вільних сторінок ОС, повертає залишок freelist
+
+    None -- файл не в режимі auto_vacuum=INCREMENTAL (одноразовий VACUUM
+    не вдався), і PRAGMA incremental_vacuum нічого не зробить.
+    """
+    with connect_db(path) as conn:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return None
+        conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        conn.commit()
+        return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+async def run_answer_retention() -> int:
+    """Згорнути всі відповіді, старіші за ANSWER_RETENTION_DAYS
+
+    Кожна пачка і крок vacuum -- в окремому потоці: це десятки мілісекунд
+    запису, які інакше тримали б усі обробники.
+    """
+    cutoff = int(time.time()) - ANSWER_RETENTION_DAYS * 86400
+    total = 0
+    # Журнал подій живе стільки ж, скільки сирі відповіді
+    pruned = await asyncio.to_thread(answer_event_log.prune, cutoff * 1000)
+    if pruned:
+        logger.info(f"🗑️ Видалено {pruned} старих сегментів журналу подій")
+    paths = tenant().user_db_names()
+    for path in paths:
+        while True:
+            moved = await asyncio.to_thread(rollup_answer_batch, path, cutoff)
+            total += moved
+            if moved < RETENTION_BATCH_SIZE:
+                break
+            await asyncio.sleep(RETENTION_PAUSE)
+
+    for path in dict.fromkeys([tenant().db_name] + paths):
+        previous = None
+        while True:
+            remaining = await asyncio.to_thread(incremental_vacuum_step, path)
+            # Зупиняємось і тоді, коли freelist перестав зменшуватись
+            if not remaining or (previous is not None and remaining >= previous):
+                break
+            previous = remaining
+            await asyncio.sleep(RETENTION_PAUSE)
+    return total
+
+
+async def answer_retention_loop():
+    """Періодичне згортання старих відповідей"""
+    while True:
+        try:
+            with timed(LOOP_SECONDS, "retention"):
+                total = await run_answer_retention()
+            if total:
+                logger.info(f"🗜️ Згорнуто {total} старих відповідей")
+        except Exception as e:
+            logger.error(f"Помилка згортання історії: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+
+# ═══════════════════════════════════════════════════════════
+# ПЕРЕНЕСЕННЯ СТАРОЇ ІСТОРІЇ ВІДПОВІДЕЙ
+# ═══════════════════════════════════════════════════════════
+
+BACKFILL_CHUNK_SIZE = 2000
+BACKFILL_PAUSE = 0.2  # секунди між порціями, щоб не тримати блокування запису
+
+_STANDARD_QUESTION_RE = re.compile(r'^\s*(-?\d+)\s*×\s*(-?\d+)\s*$')
+_FIND_X_FACTOR_RE = re.compile(r'(-?\d+)\s*[×·]\s*x|x\s*[×·]\s*(-?\d+)')
+
+
+def parse_legacy_question(question: str, correct_answer: int) -> tuple:
+    """Розібрати текст старого питання -> (num1, num2, question_type)"""
+    question = question or ""
+    if question.startswith("Find X:"):
+        match = _FIND_X_FACTOR_RE.search(question)
+        factor = int(match.group(1) or match.group(2)) if match else 0
+        return abs(factor), correct_answer, "find_x"
+
+    match = _STANDARD_QUESTION_RE.match(question)
+    if match:
+        return int(match.group(1)), int(match.group(2)), "standard"
+    return 0, 0, "standard"
+
+
+def _legacy_time_column(cursor) -> Optional[str]:
+    cursor.execute("PRAGMA table_info(answer_history_legacy)")
+    columns = [row[1] for row in cursor.fetchall()]
+    for name in ("timestamp", "answered_at", "created_at", "answer_date"):
+        if name in columns:
+            return name
+    return None
+
+
+@observe_query
+def backfill_answer_history_chunk(chunk_size: int = BACKFILL_CHUNK_SIZE) -> Optional[int]:
+    """Перенести одну порцію answer_history_legacy
+
+    Повертає кількість перенесених рядків або None, якщо переносити нічого.
+    """
     with get_db() as conn:
         cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'answer_history_legacy'")
+        if cursor.fetchone() is None:
+            return None
+
+        cursor.execute("SELECT value FROM migration_state WHERE name = 'answer_history_backfill'")
+        row = cursor.fetchone()
+        last_rowid = row[0] if row else 0
+
+        time_column = _legacy_time_column(cursor)
+        time_expr = f"CAST(strftime('%s', {time_column}) AS INTEGER)" if time_column else "NULL"
+        cursor.execute(f'''
+            SELECT rowid, user_id, question, user_answer, correct_answer, is_correct,
+                   response_time, level, mode, {time_expr}
+            FROM answer_history_legacy
+            WHERE rowid > ?
+            ORDER BY rowid
+            LIMIT ?
+        ''', (last_rowid, chunk_size))
+        rows = cursor.fetchall()
+
+        if not rows:
+            cursor.execute("DROP TABLE answer_history_legacy")
+            cursor.execute("DELETE FROM migration_state WHERE name = 'answer_history_backfill'")
+            conn.commit()
+            logger.info("✅ Перенесення answer_history завершено, стару таблицю видалено")
+            return None
+
+        now = int(time.time())
+        compact = []
+        for r in rows:
+            correct_answer = r[4] or 0
+            num1, num2, question_type = parse_legacy_question(r[2], correct_answer)
+            equation = r[2][len("Find X:"):].strip() if question_type == "find_x" else None
+            compact.append((
+                r[1], r[9] or now, num1, num2, r[3] or 0, correct_answer,
+                int(bool(r[5])), int(round((r[6] or 0) * 1000)), r[7] or 1,
+                MODE_CODES.get(r[8] or "normal", 0), QUESTION_TYPE_CODES[question_type], equation, r[0]
+            ))
+
+        # Із шардами рядки йдуть у файли своїх користувачів, прогрес пишеться
+        # після них; після збою порція повториться, але legacy_id не дасть дублів
+        by_path: Dict[str, list] = {}
+        for row in compact:
+            by_path.setdefault(tenant().user_db_name(row[0]), []).append(row)
+        insert_sql = '''
+            INSERT OR IGNORE INTO answer_history
+            (user_id, answered_at, num1, num2, user_answer, correct_answer,
+             is_correct, response_ms, level, mode, question_type, equation, legacy_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        '''
+        for path, path_rows in by_path.items():
+            if path == tenant().db_name:
+                cursor.executemany(insert_sql, path_rows)
+                continue
+            levels: Dict[int, int] = {}
+            for row in path_rows:
+                levels[row[0]] = levels.get(row[0], 0) | (1 << row[8])
+            with connect_db(path) as shard:
+                shard.executemany(insert_sql, path_rows)
+                # users.levels порахували під час шардування -- старі рівні доносимо тут
+                shard.executemany(MARK_LEVELS_SQL, list(levels.items()))
+                shard.commit()
         cursor.execute('''
-            INSERT INTO activity_calendar (user_id, activity_date, questions_count)
-            VALUES (?, ?, 1)
-            ON CONFLICT(user_id, activity_date) 
-            DO UPDATE SET questions_count = questions_count + 1
-        ''', (user_id, today))
+            INSERT INTO migration_state (name, value) VALUES ('answer_history_backfill', ?)
+            ON CONFLICT(name) DO UPDATE SET value = excluded.value
+        ''', (rows[-1][0],))
         conn.commit()
+        return len(rows)
 
 
+async def backfill_answer_history():
+    """Фоновий перенос старої історії порціями, паралельно з живими записами"""
+    total = 0
+    while True:
+        try:
+            moved = backfill_answer_history_chunk()
+        except Exception as e:
+            logger.error(f"Помилка перенесення answer_history: {e}")
+            await asyncio.sleep(60)
+            continue
+
+        if moved is None:
+            break
+        total += moved
+        if total % (BACKFILL_CHUNK_SIZE * 50) < moved:
+            logger.info(f"📦 Перенесено {total} рядків answer_history")
+        await asyncio.sleep(BACKFILL_PAUSE)
+
+    if total:
+        logger.info(f"📦 Всього перенесено {total} рядків answer_history")
+
+
+class ActivityBitmap:
+    """Компактний календар активності користувача
+
+    Біт i у days означає активність у день base_day + i (ordinal дати),
+    counts -- масив uint16 з кількістю питань за кожен день. Весь календар
+    зберігається одним рядком activity_bitmaps, а серії та суми рахуються
+    бітовими операціями.
+    """
+
+    __slots__ = ("base_day", "bits", "counts")
+
+    def __init__(self, base_day: int, bits: int = 0, counts: Optional[array] = None):
+        self.base_day = base_day
+        self.bits = bits
+        self.counts = counts if counts is not None else array('H')
+
+    @classmethod
+    def from_row(cls, row) -> "ActivityBitmap":
+        counts = array('H')
+        counts.frombytes(row['counts'])
+        return cls(row['base_day'], int.from_bytes(row['days'], 'little'), counts)
+
+    def days_blob(self) -> bytes:
+        return self.bits.to_bytes((len(self.counts) + 7) // 8, 'little')
+
+    def mark(self, day: int, questions: int = 1):
+        """Позначити активність у день (ordinal)"""
+        if day < self.base_day:
+            shift = self.base_day - day
+            self.bits <<= shift
+            self.counts = array('H', bytes(2 * shift)) + self.counts
+            self.base_day = day
+        pos = day - self.base_day
+        if pos >= len(self.counts):
+            self.counts.extend([0] * (pos + 1 - len(self.counts)))
+        self.bits |= 1 << pos
+        self.counts[pos] = min(self.counts[pos] + questions, 0xFFFF)
+
+    def count(self, day: int) -> int:
+        pos = day - self.base_day
+        if 0 <= pos < len(self.counts):
+            return self.counts[pos]
+        return 0
+
+    def _range_mask(self, start_day: int, end_day: int) -> int:
+        """Біти днів [start_day, end_day] у позиціях відносно base_day"""
+        lo = max(start_day - self.base_day, 0)
+        hi = end_day - self.base_day
+        if hi < lo:
+            return 0
+        return self.bits & (((1 << (hi - lo + 1)) - 1) << lo)
+
+    def active_days(self, start_day: int, end_day: int) -> int:
+        """Кількість активних днів у проміжку (popcount)"""
+        return self._range_mask(start_day, end_day).bit_count()
+
+    def questions(self, start_day: int, end_day: int) -> int:
+        lo = max(start_day - self.base_day, 0)
+        hi = min(end_day - self.base_day, len(self.counts) - 1)
+        return sum(self.counts[lo:hi + 1]) if hi >= lo else 0
+
+    def current_streak(self, today: int) -> int:
+        """Поточна серія днів (сьогоднішній день ще може бути не зіграний)"""
+        pos = today - self.base_day
+        if pos < 0:
+            return 0
+        if pos >= len(self.counts) or not (self.bits >> pos) & 1:
+            pos -= 1
+            if pos < 0 or pos >= len(self.counts) or not (self.bits >> pos) & 1:
+                return 0
+        mask = (1 << (pos + 1)) - 1
+        zeros = ~self.bits & mask
+        if not zeros:
+            return pos + 1
+        return pos - (zeros.bit_length() - 1)
+
+    def longest_streak(self) -> int:
+        """Найдовша серія: x &= x >> 1, доки не обнулиться"""
+        x, run = self.bits, 0
+        while x:
+            x &= x >> 1
+            run += 1
+        return run
+
+
+def _save_activity_bitmap(cursor, user_id: int, bitmap: ActivityBitmap):
+    cursor.execute('''
+        INSERT INTO activity_bitmaps (user_id, base_day, days, counts)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            base_day = excluded.base_day, days = excluded.days, counts = excluded.counts
+    ''', (user_id, bitmap.base_day, bitmap.days_blob(), bitmap.counts.tobytes()))
+
+
+def update_activity_calendar(user_id: int):
+    """Оновити календар активності"""
+    repository.mark_activity(user_id, datetime.now().date().toordinal())
+
+
+def convert_legacy_activity_calendar(cursor):
+    """Перенести activity_calendar (рядок на день) у activity_bitmaps"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'activity_calendar'")
+    if cursor.fetchone() is None:
+        return
+
+    logger.info("Переносимо activity_calendar у бітові календарі...")
+    read_cursor = cursor.connection.cursor()
+    read_cursor.execute('''
+        SELECT user_id, activity_date, questions_count
+        FROM activity_calendar
+        ORDER BY user_id, activity_date
+    ''')
+    current_user, bitmap, converted = None, None, 0
+    for row in read_cursor:
+        if row[0] != current_user:
+            if bitmap is not None:
+                _save_activity_bitmap(cursor, current_user, bitmap)
+                converted += 1
+            current_user, bitmap = row[0], None
+        try:
+            day = datetime.fromisoformat(str(row[1])[:10]).date().toordinal()
+        except ValueError:
+            continue
+        if bitmap is None:
+            bitmap = ActivityBitmap(day)
+        bitmap.mark(day, row[2] or 1)
+    if bitmap is not None:
+        _save_activity_bitmap(cursor, current_user, bitmap)
+        converted += 1
+
+    cursor.execute("DROP TABLE activity_calendar")
+    logger.info(f"📅 Перенесено календарі {converted} користувачів")
+
 
 def track_weak_spot(user_id: int, num1: int, num2: int):
     """Відстежити слабке місце"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO weak_spots (user_id, number1, number2, error_count, last_error)
-            VALUES (?, ?, ?, 1, CURRENT_TIMESTAMP)
-            ON CONFLICT(user_id, number1, number2) 
-            DO UPDATE SET error_count = error_count + 1, last_error = CURRENT_TIMESTAMP
-        ''', (user_id, num1, num2))
-        conn.commit()
+    repository.track_weak_spot(user_id, num1, num2)
 
 
 def get_weak_spots(user_id: int, limit: int = 5) -> List[Dict]:
     """Отримати топ слабких місць"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT number1, number2, error_count
-            FROM weak_spots
-            WHERE user_id = ?
-            ORDER BY error_count DESC, last_error DESC
-            LIMIT ?
-        ''', (user_id, limit))
-        return [dict(row) for row in cursor.fetchall()]
+    return repository.get_weak_spots(user_id, limit)
+
+
+def get_activity_calendar(user_id: int) -> Optional[ActivityBitmap]:
+    """Отримати календар активності (один рядок на користувача)"""
+    return repository.get_calendar(user_id)
+
+
+def get_user_stats(user_id: int) -> dict:
+    """Отримати статистику користувача"""
+    return repository.get_user(user_id)
+
+
+def set_custom_name(user_id: int, custom_name: str):
+    """Встановити кастомне ім'я користувачу"""
+    repository.set_custom_name(user_id, custom_name)
+
+
+# Статуси доставки (users.delivery_status); NULL -- помилок не було
+DELIVERY_BLOCKED = "blocked"
+DELIVERY_DEACTIVATED = "deactivated"
+DELIVERY_CHAT_NOT_FOUND = "chat_not_found"
+DELIVERY_RATE_LIMITED = "rate_limited"
+DELIVERY_ERROR = "error"
 
+# Після цих помилок чат вважається мертвим, доки користувач не напише знову
+DEAD_DELIVERY_STATUSES = {DELIVERY_BLOCKED, DELIVERY_DEACTIVATED, DELIVERY_CHAT_NOT_FOUND}
 
-def get_activity_calendar(user_id: int, days: int = 30) -> Dict[str, int]:
-    """Отримати календар активності"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        start_date = (datetime.now() - timedelta(days=days)).date()
-        cursor.execute('''
-            SELECT activity_date, questions_count
-            FROM activity_calendar
-            WHERE user_id = ? AND activity_date >= ?
-            ORDER BY activity_date
-        ''', (user_id, start_date))
-        return {str(row['activity_date']): row['questions_count'] 
-                for row in cursor.fetchall()}
 
+def classify_send_error(error: Exception) -> str:
+    """Помилка надсилання Telegram -> статус доставки"""
+    description = str(error).lower()
+    if isinstance(error, TelegramRetryAfter):
+        return DELIVERY_RATE_LIMITED
+    if isinstance(error, TelegramForbiddenError):
+        return DELIVERY_DEACTIVATED if "deactivated" in description else DELIVERY_BLOCKED
+    if isinstance(error, TelegramBadRequest) and "chat not found" in description:
+        return DELIVERY_CHAT_NOT_FOUND
+    return DELIVERY_ERROR
 
-def get_user_stats(user_id: int) -> dict:
-    """Отримати статистику користувача"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
-        return dict(user) if user else {}
 
+def set_delivery_status(user_id: int, status: Optional[str]):
+    """Зберегти статус доставки; мертві чати виключаються з розсилок і нагадувань"""
+    repository.set_delivery_status(user_id, status)
 
-def set_custom_name(user_id: int, custom_name: str):
-    """Встановити кастомне ім'я користувачу"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET custom_name = ? WHERE user_id = ?', (custom_name, user_id))
-        conn.commit()
+
+def handle_send_error(user_id: int, error: Exception) -> str:
+    """Класифікувати помилку надсилання і позначити мертвий чат -> статус"""
+    status = classify_send_error(error)
+    if status in DEAD_DELIVERY_STATUSES:
+        set_delivery_status(user_id, status)
+        logger.info(f"Чат {user_id} недоступний ({status}), виключено з розсилок")
+    return status
 
 
 def get_display_name(user_id: int) -> str:
@@ -334,11 +2767,126 @@ def get_display_name(user_id: int) -> str:
     return stats.get('custom_name') or stats.get('first_name') or 'User'
 
 
+class AccessControl:
+    """Доступ до бота: множина дозволених ID + строки підписок
+
+    Перевірка доступу -- пошук у множині. Строк підписки зберігається в
+    users.subscription_expires (частковий індекс), тому планувальник бере
+    лише ті записи, що вже закінчились. Самі записи -- через repository.
+    """
+
+    def __init__(self, seed_ids=()):
+        self.seed_ids = list(seed_ids)
+        self.ids = set()
+        self._changed: Optional[asyncio.Event] = None
+
+    def load(self):
+        """Завантажити вайтліст зі сховища при старті
+
+        WHITELIST з конфігу лише засіває сховище новими ID; далі доступом
+        керують /addwhite і /removewhite, як і всім іншим вайтлістом.
+        """
+        if self.seed_ids:
+            repository.seed_whitelist(self.seed_ids)
+        self.ids = repository.whitelisted_ids()
+        logger.info(f"📋 Завантажено {len(self.ids)} користувачів з вайтліста")
+
+    def is_allowed(self, user_id: int) -> bool:
+        return user_id == tenant().admin_id or user_id in self.ids
+
+    def _notify_changed(self):
+        if self._changed is not None:
+            self._changed.set()
+
+    def grant(self, user_id: int, days: Optional[int] = None,
+              announce: Optional[dict] = None) -> Optional[int]:
+        """Надати/продовжити доступ; повертає час закінчення (epoch) або None"""
+        return self.grant_many([user_id], days, announce)[user_id]
+
+    def grant_many(self, user_ids: List[int], days: Optional[int] = None,
+                   announce: Optional[dict] = None) -> Dict[int, Optional[int]]:
+        """Надати/продовжити доступ групі однією транзакцією -> {user_id: закінчення}
+
+        days = None або 0 -- безстроковий доступ, як і до появи підписок.
+        announce -- повідомлення для outbox, яке отримають лише нові користувачі.
+        """
+        now = int(time.time())
+        user_ids = list(dict.fromkeys(user_ids))
+        new_ids = [uid for uid in user_ids if uid not in self.ids]
+        expires = repository.grant_access(user_ids, days, now, announce, new_ids)
+        self.ids.update(user_ids)
+        self._notify_changed()
+        worker.publish("access")
+        if announce and new_ids:
+            outbox.wake()
+        return expires
+
+    def revoke(self, user_id: int, announce: Optional[dict] = None) -> bool:
+        """Забрати доступ; False, якщо його не було"""
+        return bool(self.revoke_many([user_id], announce))
+
+    def revoke_many(self, user_ids: List[int], announce: Optional[dict] = None) -> List[int]:
+        """Забрати доступ групі однією транзакцією -> список тих, у кого він був"""
+        revoked = [uid for uid in dict.fromkeys(user_ids) if uid in self.ids]
+        if not revoked:
+            return []
+        repository.revoke_access(revoked, announce)
+        self.ids.difference_update(revoked)
+        worker.publish("access")
+        if announce:
+            outbox.wake()
+        return revoked
+
+    def next_expiry(self) -> Optional[int]:
+        return repository.next_expiry()
+
+    def expire_due(self, now: Optional[int] = None, announce: Optional[dict] = None) -> List[int]:
+        """Закрити доступ усім, чия підписка вже закінчилась"""
+        now = int(time.time()) if now is None else now
+        expired = repository.expire_due(now, announce)
+        self.ids.difference_update(expired)
+        if expired:
+            worker.publish("access")
+        if announce and expired:
+            outbox.wake()
+        return expired
+
+    async def run_expiry_scheduler(self):
+        """Спить до найближчого закінчення підписки (або до зміни)"""
+        self._changed = asyncio.Event()
+        while True:
+            try:
+                with timed(LOOP_SECONDS, "subscriptions"):
+                    expired = self.expire_due(announce=access_revoked_payload())
+                for user_id in expired:
+                    logger.info(f"⌛ Підписка {user_id} закінчилась")
+                next_at = self.next_expiry()
+            except Exception as e:
+                logger.error(f"Помилка обробки підписок: {e}")
+                next_at = None
+
+            timeout = SUBSCRIPTION_CHECK_INTERVAL
+            if next_at is not None:
+                timeout = min(timeout, max(1, next_at - int(time.time())))
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+access_control = TenantLocal("access_control")
+
+
 def is_user_whitelisted(user_id: int) -> bool:
     """Перевірка, чи користувач у вайтлісті"""
-    if user_id == ADMIN_ID:
-        return True
-    return user_id in WHITELIST or user_id == ADMIN_ID
+    return access_control.is_allowed(user_id)
+
+
+def format_expiry(expires: Optional[int]) -> str:
+    if expires is None:
+        return "безстроково"
+    return f"до {datetime.fromtimestamp(expires).strftime('%d.%m.%Y')}"
 
 
 def get_payment_message(user_id: int) -> str:
@@ -353,7 +2901,7 @@ def get_payment_message(user_id: int) -> str:
 💎 **ВАРІАНТИ КОРИСТУВАННЯ:**
 
 **1️⃣ Місячна підписка**
-💰 Ціна: **{MONTHLY_PRICE} грн/місяць**
+💰 Ціна: **{tenant().monthly_price} грн/місяць**
 ✨ Повний доступ до всіх функцій бота
 ✨ AI-аналіз слабких місць
 ✨ Щоденні нагадування
@@ -361,7 +2909,7 @@ def get_payment_message(user_id: int) -> str:
 ✨ Календар активності
 
 **2️⃣ Повний вихідний код**
-💰 Ціна: **${FULL_CODE_PRICE} (одноразово)**
+💰 Ціна: **${tenant().full_code_price} (одноразово)**
 ✨ Весь код бота
 ✨ Можливість створити свого власного бота
 ✨ Повна документація
@@ -372,7 +2920,7 @@ def get_payment_message(user_id: int) -> str:
 
 📞 **ДЛЯ ОПЛАТИ ТА ОТРИМАННЯ ДОСТУПУ:**
 
-Напиши мені: {PAYMENT_CONTACT}
+Напиши мені: {tenant().payment_contact}
 
 📝 Вкажи:
 • Твій Telegram ID: `{user_id}`
@@ -382,21 +2930,435 @@ def get_payment_message(user_id: int) -> str:
 
 ━━━━━━━━━━━━━━━━━━━━
 
-❓ Питання? Звертайся: {PAYMENT_CONTACT}
+❓ Питання? Звертайся: {tenant().payment_contact}
 
 🚀 Дякую за інтерес до бота!
 """
 
 
-def load_whitelist_from_db():
-    """Завантажити вайтліст з БД при старті"""
-    global WHITELIST
-    with get_db() as conn:
+# ═══════════════════════════════════════════════════════════
+# СКЕТЧІ ШВИДКОСТІ ВІДПОВІДЕЙ
+# ═══════════════════════════════════════════════════════════
+
+class ResponseTimeSketch:
+    """Квантильний скетч з логарифмічними бакетами (відносна похибка ~2%)
+
+    Скетчі зливаються простим додаванням бакетів, тому розподіл для
+    будь-якої когорти збирається з готових скетчів без читання історії.
+    """
+
+    RELATIVE_ACCURACY = 0.02
+    GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+    LOG_GAMMA = math.log(GAMMA)
+    MIN_VALUE = 0.01  # секунди; все менше вважаємо нулем
+
+    __slots__ = ("bins", "zero_count", "count")
+
+    def __init__(self):
+        self.bins: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value: float, weight: int = 1):
+        """Додати значення (секунди)"""
+        if value <= self.MIN_VALUE:
+            self.zero_count += weight
+        else:
+            idx = math.ceil(math.log(value) / self.LOG_GAMMA)
+            self.bins[idx] = self.bins.get(idx, 0) + weight
+        self.count += weight
+
+    def merge(self, other: "ResponseTimeSketch") -> "ResponseTimeSketch":
+        """Злити інший скетч у цей"""
+        for idx, cnt in other.bins.items():
+            self.bins[idx] = self.bins.get(idx, 0) + cnt
+        self.zero_count += other.zero_count
+        self.count += other.count
+        return self
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Оцінка квантиля q (0..1) у секундах"""
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for idx in sorted(self.bins):
+            seen += self.bins[idx]
+            if seen > rank:
+                return 2 * self.GAMMA ** idx / (self.GAMMA + 1)
+        return 2 * self.GAMMA ** max(self.bins) / (self.GAMMA + 1)
+
+    def to_bytes(self) -> bytes:
+        """Компактна серіалізація: заголовок + щільний масив бакетів"""
+        header = array('q', [self.zero_count, 0])
+        if not self.bins:
+            return header.tobytes()
+        lo, hi = min(self.bins), max(self.bins)
+        header[1] = lo
+        counts = array('I', (self.bins.get(i, 0) for i in range(lo, hi + 1)))
+        return header.tobytes() + counts.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "ResponseTimeSketch":
+        sketch = cls()
+        header = array('q')
+        header.frombytes(data[:16])
+        sketch.zero_count, lo = header[0], header[1]
+        counts = array('I')
+        counts.frombytes(data[16:])
+        for offset, cnt in enumerate(counts):
+            if cnt:
+                sketch.bins[lo + offset] = cnt
+        sketch.count = sketch.zero_count + sum(counts)
+        return sketch
+
+
+class ResponseSketchStore:
+    """Скетчі часу відповіді: user / mode / level / global
+
+    Оновлюються на кожну відповідь (write-through у response_time_sketches),
+    читання -- це злиття кількох маленьких рядків, без сканування answer_history.
+    З шардуванням кожен шард має власні рядки, а читання зливає їх усі.
+    """
+
+    SCOPES = ("user", "mode", "level", "global")
+
+    def __init__(self, part: int = 0, cache_size: int = 5000):
+        self.part = part
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[tuple, ResponseTimeSketch]" = OrderedDict()
+
+    @staticmethod
+    def keys_for(user_id: int, mode: str, level: int) -> list:
+        return [("user", str(user_id)), ("mode", mode), ("level", str(level)), ("global", "all")]
+
+    def _own_sketch(self, cursor, key: tuple) -> ResponseTimeSketch:
+        """key = (файл БД, scope, scope_key)"""
+        sketch = self._cache.get(key)
+        if sketch is not None:
+            self._cache.move_to_end(key)
+            return sketch
+        cursor.execute('''
+            SELECT data FROM response_time_sketches
+            WHERE scope = ? AND scope_key = ? AND part = ?
+        ''', (key[1], key[2], self.part))
+        row = cursor.fetchone()
+        sketch = ResponseTimeSketch.from_bytes(row[0]) if row else ResponseTimeSketch()
+        self._cache[key] = sketch
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return sketch
+
+    def record(self, conn, user_id: int, mode: str, level: int, response_time: float):
+        """Додати відповідь у всі скетчі (в транзакції виклику)"""
         cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM users WHERE is_whitelisted = 1")
-        WHITELIST = [row[0] for row in cursor.fetchall()]
-    logger.info(f"📋 Завантажено {len(WHITELIST)} користувачів з вайтліста")
+        path = tenant().user_db_name(user_id)
+        rows = []
+        for key in self.keys_for(user_id, mode, level):
+            sketch = self._own_sketch(cursor, (path,) + key)
+            sketch.add(response_time)
+            rows.append((key[0], key[1], self.part, sketch.to_bytes()))
+        cursor.executemany('''
+            INSERT INTO response_time_sketches (scope, scope_key, part, data)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(scope, scope_key, part) DO UPDATE SET data = excluded.data
+        ''', rows)
+
+    @observe_query
+    def get(self, scope: str, scope_key: str) -> ResponseTimeSketch:
+        """Злитий скетч для когорти"""
+        if scope == "user":
+            paths = [tenant().user_db_name(int(scope_key))]
+        else:
+            paths = tenant().user_db_names()
+        merged = ResponseTimeSketch()
+        for path in paths:
+            with connect_db(path) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT data FROM response_time_sketches
+                    WHERE scope = ? AND scope_key = ?
+                ''', (scope, str(scope_key)))
+                for row in cursor.fetchall():
+                    merged.merge(ResponseTimeSketch.from_bytes(row[0]))
+        return merged
+
+    @observe_query
+    def get_scope(self, scope: str) -> Dict[str, ResponseTimeSketch]:
+        """Усі когорти одного виміру (наприклад, всі режими)"""
+        result: Dict[str, ResponseTimeSketch] = {}
+        for path in tenant().user_db_names():
+            with connect_db(path) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT scope_key, data FROM response_time_sketches
+                    WHERE scope = ?
+                ''', (scope,))
+                for row in cursor.fetchall():
+                    sketch = result.setdefault(row[0], ResponseTimeSketch())
+                    sketch.merge(ResponseTimeSketch.from_bytes(row[1]))
+        return result
+
+
+response_sketches = TenantLocal("response_sketches")
+
+
+def format_speed_line(label: str, sketch: ResponseTimeSketch) -> str:
+    """Рядок з p50/p90 для когорти"""
+    if sketch.count == 0:
+        return f"• {label}: немає даних"
+    p50 = sketch.quantile(0.5)
+    p90 = sketch.quantile(0.9)
+    return f"• {label}: p50 {p50:.1f}с | p90 {p90:.1f}с ({sketch.count})"
+
+
+
+# ═══════════════════════════════════════════════════════════
+# ЖУРНАЛ ПОДІЙ ВІДПОВІДЕЙ (append-only)
+# ═══════════════════════════════════════════════════════════
+
+# Кожен запис -- 8 полів int64 (64 байти), тому сегмент можна
+# переглядати як memoryview('q') і брати колонки зрізом з кроком
+EVENT_FIELDS = (
+    "answered_at_ms", "user_id", "num1", "num2",
+    "user_answer", "correct_answer", "response_ms", "flags",
+)
+EVENT_RECORD = struct.Struct("<" + "q" * len(EVENT_FIELDS))
+EVENT_WIDTH = len(EVENT_FIELDS)
+
+
+def pack_event_flags(level: int, mode: str, question_type: str,
+                     is_correct: bool, timed_out: bool) -> int:
+    """level | mode << 8 | question_type << 16 | is_correct << 24 | timed_out << 25"""
+    return (level & 0xFF) | (MODE_CODES.get(mode, 0) << 8) \
+        | (QUESTION_TYPE_CODES.get(question_type, 0) << 16) \
+        | (int(is_correct) << 24) | (int(timed_out) << 25)
+
+
+def unpack_event_flags(flags: int) -> dict:
+    return {
+        "level": flags & 0xFF,
+        "mode": MODE_NAMES.get((flags >> 8) & 0xFF, "normal"),
+        "question_type": QUESTION_TYPE_NAMES.get((flags >> 16) & 0xFF, "standard"),
+        "is_correct": bool((flags >> 24) & 1),
+        "timed_out": bool((flags >> 25) & 1),
+    }
+
+
+class AnswerEventLog:
+    """Записувач журналу: сегменти *.open дописуються, *.seg -- незмінні
+
+    Сегмент запечатується за розміром або зі зміною доби UTC: інакше на
+    звичайному навантаженні один *.open жив би місяцями, і ні читач, ні
+    prune його не бачили б.
+    """
+
+    def __init__(self, directory: str, segment_size: int, prefix: str = "segment"):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.prefix = prefix
+        self._file = None
+        self._path = None
+        self._size = 0
+        self._day = None  # доба UTC, коли відкрито поточний сегмент
+
+    def _segment_paths(self, suffix: str) -> list:
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.startswith(self.prefix + "-") and name.endswith(suffix)
+        )
+
+    def _next_seq(self) -> int:
+        seqs = []
+        for path in self._segment_paths(".seg") + self._segment_paths(".open"):
+            try:
+                seqs.append(int(os.path.basename(path).split("-")[-1].split(".")[0]))
+            except ValueError:
+                continue
+        return max(seqs, default=0) + 1
+
+    @staticmethod
+    def _seal(path: str):
+        """Обрізати неповний запис і перейменувати сегмент у .seg"""
+        size = os.path.getsize(path)
+        if size % EVENT_RECORD.size:
+            with open(path, "r+b") as f:
+                f.truncate(size - size % EVENT_RECORD.size)
+        if os.path.getsize(path) == 0:
+            os.remove(path)
+        else:
+            os.replace(path, path[:-len(".open")] + ".seg")
+
+    def _open_segment(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # Сегменти, що лишилися відкритими після падіння, запечатуємо
+        for path in self._segment_paths(".open"):
+            self._seal(path)
+        self._path = os.path.join(self.directory, f"{self.prefix}-{self._next_seq():08d}.open")
+        self._file = open(self._path, "ab", buffering=0)
+        self._size = 0
+        self._day = int(time.time() // 86400)
+
+    def rotate(self):
+        """Запечатати поточний сегмент"""
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        self._seal(self._path)
+
+    def rotate_if_stale(self) -> bool:
+        """Запечатати сегмент, відкритий у попередню добу UTC"""
+        if self._file is None or int(time.time() // 86400) == self._day:
+            return False
+        self.rotate()
+        return True
 
+    async def run(self):
+        """Фоновий цикл процесу: запечатати тихий сегмент одразу після півночі UTC"""
+        while True:
+            await asyncio.sleep(86400 - time.time() % 86400 + 1)
+            try:
+                self.rotate_if_stale()
+            except OSError as e:
+                logger.error(f"Помилка ротації журналу подій: {e}")
+
+    def append(self, user_id: int, num1: int, num2: int, user_answer: int,
+               correct_answer: int, response_ms: int, flags: int):
+        now_ms = int(time.time() * 1000)
+        if self._file is not None and now_ms // 86_400_000 != self._day:
+            self.rotate()
+        if self._file is None:
+            self._open_segment()
+        self._file.write(EVENT_RECORD.pack(
+            now_ms, user_id, num1, num2,
+            user_answer, correct_answer, response_ms, flags
+        ))
+        self._size += EVENT_RECORD.size
+        if self._size >= self.segment_size:
+            self.rotate()
+
+    def prune(self, cutoff_ms: int) -> int:
+        """Видалити запечатані сегменти, де всі записи старіші за cutoff_ms
+
+        Записи дописуються за часом, тож досить глянути на останній. Сегменти
+        всіх воркерів у теці (*.seg) -- відкриті не чіпаємо.
+        """
+        if not os.path.isdir(self.directory):
+            return 0
+        removed = 0
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".seg"):
+                continue
+            path = os.path.join(self.directory, name)
+            with open(path, "rb") as f:
+                f.seek(-EVENT_RECORD.size, os.SEEK_END)
+                newest = EVENT_RECORD.unpack(f.read(EVENT_RECORD.size))[0]
+            if newest < cutoff_ms:
+                os.remove(path)
+                removed += 1
+        return removed
+
+
+class AnswerLogReader:
+    """Читач сегментів через mmap: колонки -- memoryview без копіювання
+
+    with AnswerLogReader(ANSWER_LOG_DIR) as log:
+        times = log.column("response_ms")   # memoryview('q')
+    """
+
+    def __init__(self, directory: str, include_open: bool = False):
+        self.directory = directory
+        self.include_open = include_open
+        self._maps = []
+        self._views = []
+        self._columns = []
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self):
+        if not os.path.isdir(self.directory):
+            return
+        suffixes = (".seg", ".open") if self.include_open else (".seg",)
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(suffixes):
+                continue
+            path = os.path.join(self.directory, name)
+            records = os.path.getsize(path) // EVENT_RECORD.size
+            if records == 0:
+                continue
+            with open(path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), records * EVENT_RECORD.size, access=mmap.ACCESS_READ)
+            self._maps.append(mm)
+            self._views.append(memoryview(mm).cast("q"))
+
+    def close(self):
+        for view in self._columns + self._views:
+            view.release()
+        for mm in self._maps:
+            mm.close()
+        self._columns, self._views, self._maps = [], [], []
+
+    @property
+    def segments(self) -> int:
+        return len(self._views)
+
+    def __len__(self) -> int:
+        return sum(len(view) // EVENT_WIDTH for view in self._views)
+
+    def segment_columns(self, name: str) -> List[memoryview]:
+        """Колонка по кожному сегменту (strided memoryview, без копій)"""
+        idx = EVENT_FIELDS.index(name)
+        columns = [view[idx::EVENT_WIDTH] for view in self._views]
+        self._columns.extend(columns)
+        return columns
+
+    def column(self, name: str):
+        """Колонка через всі сегменти (ітератор без копіювання)"""
+        for part in self.segment_columns(name):
+            yield from part
+
+
+answer_event_log = TenantLocal("answer_event_log")
+
+
+def build_answer_log_report(directory: str) -> str:
+    """Звіт по журналу подій (виконується поза event loop)"""
+    modes: Dict[str, list] = {}
+    with AnswerLogReader(directory, include_open=True) as log:
+        if not len(log):
+            return "📼 ЖУРНАЛ ВІДПОВІДЕЙ\n\nПоки порожній."
+        total = len(log)
+        segments = log.segments
+        users = set()
+        for user_ids, flags_col, ms_col in zip(log.segment_columns("user_id"),
+                                               log.segment_columns("flags"),
+                                               log.segment_columns("response_ms")):
+            users.update(user_ids)
+            for flags, ms in zip(flags_col, ms_col):
+                mode = MODE_NAMES.get((flags >> 8) & 0xFF, "normal")
+                bucket = modes.setdefault(mode, [0, 0, 0, 0])
+                bucket[0] += 1
+                bucket[1] += (flags >> 24) & 1
+                if not (flags >> 25) & 1:
+                    bucket[2] += ms
+                    bucket[3] += 1
+
+    text = f"📼 ЖУРНАЛ ВІДПОВІДЕЙ\n\n📦 Сегментів: {segments}\n📝 Записів: {total}\n👥 Користувачів: {len(users)}\n\n🎮 Режими:\n"
+    for mode, (count, correct, ms_sum, answered) in sorted(modes.items(), key=lambda item: -item[1][0]):
+        avg = ms_sum / answered / 1000 if answered else 0
+        text += f"• {mode}: {count} | ✅ {correct / count * 100:.0f}% | ⏱️ {avg:.1f}с\n"
+    return text
 
 
 # ═══════════════════════════════════════════════════════════
@@ -725,91 +3687,896 @@ def create_after_wrong_answer_menu(num1: int, num2: int) -> InlineKeyboardBuilde
     return builder
 
 
-def create_broadcast_menu(current_filter: str) -> InlineKeyboardBuilder:
-    """Меню розсилки з фільтрами"""
-    builder = InlineKeyboardBuilder()
-    
-    filters = {
-        "whitelist": "🔒 Whitelist (Всі)",
-        "non_whitelist": "🔓 Не в Whitelist",
-        "active_1": "📅 Активні 1 день",
-        "active_3": "📅 Активні 3 дні",
-        "active_7": "📅 Активні 7 днів",
-        "active_30": "📅 Активні 30 днів"
-    }
-    
-    for code, label in filters.items():
-        prefix = "✅ " if code == current_filter else ""
-        builder.button(text=f"{prefix}{label}", callback_data=f"filter_{code}")
-        
-    builder.button(text="✍️ СТВОРИТИ ПОВІДОМЛЕННЯ", callback_data="create_broadcast")
-    builder.adjust(2, 2, 2, 1)
-    return builder
+# Умови сегмента: ключ -> варіанти (значення, підпис); перший варіант -- "без умови"
+SEGMENT_OPTIONS = {
+    "whitelist": [(None, "🔒 Доступ: всі"), (1, "🔒 Доступ: є"), (0, "🔓 Доступ: немає")],
+    "activity": [
+        (None, "📅 Активність: будь-яка"),
+        (1, "📅 Активні 1 день"), (3, "📅 Активні 3 дні"),
+        (7, "📅 Активні 7 днів"), (30, "📅 Активні 30 днів"),
+        (-7, "💤 Неактивні 7+ днів"), (-30, "💤 Неактивні 30+ днів"),
+    ],
+    "accuracy": [
+        (None, "🎯 Точність: будь-яка"),
+        ((0, 50), "🎯 Точність < 50%"), ((50, 80), "🎯 Точність 50-80%"), ((80, 101), "🎯 Точність ≥ 80%"),
+    ],
+    "level": [(None, "📊 Рівень: будь-який"), (1, "📊 Грали рівень 1"), (2, "📊 Грали рівень 2"), (3, "📊 Грали рівень 3")],
+    "reminders": [(None, "🔔 Нагадування: всі"), (1, "🔔 Нагадування увімк."), (0, "🔕 Нагадування вимк.")],
+    "blocked": [(0, "🚫 Без заблокованих"), (None, "🚫 Включно з заблокованими")],
+}
+
+DEFAULT_SEGMENT = {"whitelist": 1, "activity": None, "accuracy": None, "level": None, "reminders": None, "blocked": 0}
+
+
+def normalize_segment(segment: Optional[dict]) -> dict:
+    """Сегмент з FSM (JSON) -> словник з відомими значеннями"""
+    result = dict(DEFAULT_SEGMENT)
+    for key, value in (segment or {}).items():
+        if key in SEGMENT_OPTIONS:
+            result[key] = tuple(value) if isinstance(value, list) else value
+    return result
+
+
+def compile_segment(segment: dict) -> tuple:
+    """Сегмент -> (WHERE-умова, параметри) для запиту по users"""
+    segment = normalize_segment(segment)
+    clauses, params = [], []
+
+    if segment["whitelist"] is not None:
+        clauses.append("is_whitelisted = ?")
+        params.append(segment["whitelist"])
+
+    days = segment["activity"]
+    if days is not None:
+        # last_activity пишеться як CURRENT_TIMESTAMP (UTC), тому порівнюємо з datetime('now')
+        clauses.append("last_activity >= datetime('now', ?)" if days > 0 else "last_activity < datetime('now', ?)")
+        params.append(f"-{abs(days)} days")
+
+    if segment["accuracy"] is not None:
+        low, high = segment["accuracy"]
+        clauses.append("total_questions > 0 AND correct_answers * 100 >= ? * total_questions "
+                       "AND correct_answers * 100 < ? * total_questions")
+        params += [low, high]
+
+    if segment["level"] is not None and tenant().db_shards:
+        # Історія в шардах: каталог знає рівні користувача з бітової маски levels
+        clauses.append("levels & ? != 0")
+        params.append(1 << segment["level"])
+    elif segment["level"] is not None:
+        # Старі відповіді вже згорнуті в answer_rollups, свіжі -- ще в answer_history
+        clauses.append(
+            "(EXISTS (SELECT 1 FROM answer_rollups r WHERE r.user_id = users.user_id AND r.level = ?)"
+            " OR EXISTS (SELECT 1 FROM answer_history h WHERE h.user_id = users.user_id AND h.level = ?))"
+        )
+        params += [segment["level"], segment["level"]]
 
+    if segment["reminders"] is not None:
+        clauses.append("COALESCE(reminder_enabled, 1) = ?")
+        params.append(segment["reminders"])
 
-def get_audience_users(filter_type: str) -> list:
-    """Отримує список ID користувачів за фільтром"""
+    if segment["blocked"] is not None:
+        # Літерал, а не параметр: інакше SQLite не застосує частковий idx_users_reachable
+        clauses.append(f"is_blocked = {int(segment['blocked'])}")
+
+    return " AND ".join(clauses) or "1", params
+
+
+@observe_query
+def count_segment(segment: dict) -> int:
+    """Кількість отримувачів сегмента (COUNT(*) без вибірки ID)"""
+    where, params = compile_segment(segment)
     with get_db() as conn:
         cursor = conn.cursor()
-        
-        if filter_type == "whitelist":
-            cursor.execute("SELECT user_id FROM users WHERE is_whitelisted = 1")
-        elif filter_type == "non_whitelist":
-            cursor.execute("SELECT user_id FROM users WHERE is_whitelisted = 0")
-        elif filter_type.startswith("active_"):
-            days = int(filter_type.split("_")[1])
-            date_limit = (datetime.now() - timedelta(days=days)).isoformat()
-            cursor.execute("SELECT user_id FROM users WHERE last_activity >= ?", (date_limit,))
-        else:
-            return []
-            
-        return [row[0] for row in cursor.fetchall()]
+        cursor.execute(f"SELECT COUNT(*) FROM users WHERE {where}", params)
+        return cursor.fetchone()[0]
+
+
+def describe_segment(segment: dict) -> str:
+    """Людський опис умов сегмента"""
+    segment = normalize_segment(segment)
+    parts = []
+    for key, options in SEGMENT_OPTIONS.items():
+        value = segment[key]
+        if value is None and key != "blocked":
+            continue
+        parts.append(next((label for option, label in options if option == value), str(value)))
+    return "\n".join(f"• {part}" for part in parts)
+
+
+def create_broadcast_menu(segment: dict) -> InlineKeyboardBuilder:
+    """Меню розсилки: конструктор сегмента (кожна кнопка перемикає свою умову)"""
+    builder = InlineKeyboardBuilder()
+    segment = normalize_segment(segment)
+
+    for key, options in SEGMENT_OPTIONS.items():
+        label = next((label for option, label in options if option == segment[key]), options[0][1])
+        builder.button(text=label, callback_data=f"seg_{key}")
+
+    builder.button(text="♻️ Скинути умови", callback_data="seg_reset")
+    builder.button(text="✍️ СТВОРИТИ ПОВІДОМЛЕННЯ", callback_data="create_broadcast")
+    builder.adjust(2, 2, 2, 1, 1)
+    return builder
 
 
-def get_audience_count(filter_type: str) -> int:
-    """Отримує кількість користувачів за фільтром"""
-    return len(get_audience_users(filter_type))
+def broadcast_panel_text(segment: dict) -> str:
+    return (
+        "📢 **АДМІН-ПАНЕЛЬ: РОЗСИЛКА**\n\n"
+        "Налаштування аудиторії та створення повідомлень.\n\n"
+        f"🎯 Умови:\n{describe_segment(segment)}\n\n"
+        f"👥 Отримувачів: {count_segment(segment)}"
+    )
 
 
 # ═══════════════════════════════════════════════════════════
 # ІНІЦІАЛІЗАЦІЯ БОТА
 # ═══════════════════════════════════════════════════════════
-bot = Bot(token=BOT_TOKEN)
+bot = TenantLocal("bot")
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 router = Router()
 
 active_timers = {}
 
+# ═══════════════════════════════════════════════════════════
+# ВИХІДНІ ПОВІДОМЛЕННЯ
+# ═══════════════════════════════════════════════════════════
+
+# Класи пріоритету: менше число -- раніше в черзі
+PRIORITY_INTERACTIVE = 0
+PRIORITY_ADMIN = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_ADMIN: "admin", PRIORITY_BACKGROUND: "background"}
+
+OUTBOUND_GLOBAL_RATE = 25      # повідомлень/с на всього бота (ліміт Telegram ~30)
+OUTBOUND_CHAT_RATE = 1         # повідомлень/с в особистий чат
+OUTBOUND_GROUP_RATE = 20 / 60  # повідомлень/с у групу
+OUTBOUND_CHAT_BURST = 3
+OUTBOUND_RESERVE = 5           # токени, які фонові розсилки не можуть забрати
+OUTBOUND_MAX_RETRIES = 3
+OUTBOUND_MAX_CHATS = 10000
+
+# Пріоритет поточної задачі; фонові цикли виставляють його на старті
+outbound_priority = contextvars.ContextVar("outbound_priority", default=PRIORITY_INTERACTIVE)
+
+
+@contextmanager
+def outbound_scope(priority: int):
+    """Тимчасово змінити пріоритет вихідних запитів у поточному контексті"""
+    token = outbound_priority.set(priority)
+    try:
+        yield
+    finally:
+        outbound_priority.reset(token)
+
+
+class TokenBucket:
+    """Обмеження частоти: rate токенів/с з запасом capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, reserve: float = 0) -> float:
+        """Скільки чекати до наступного токена (0 -- можна зараз), лишаючи reserve токенів"""
+        self._refill()
+        need = 1 + reserve
+        return 0.0 if self.tokens >= need else (need - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        """Заборонити видачу токенів на seconds (після RetryAfter)
+
+        Паузи не сумуються: кілька одночасних RetryAfter дають найдовшу з них.
+        """
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def paused_for(self) -> float:
+        """Скільки ще триває пауза (0 -- токени знову видаються)"""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate) if self.tokens < 0 else 0.0
+
+    def is_idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class OutboundDispatcher(BaseRequestMiddleware):
+    """Єдина черга вихідних запитів до Telegram
+
+    Підключається до сесії бота, тому через неї йдуть усі виклики з chat_id:
+    message.answer, edit_text, send_message, copy_message тощо. Запити без
+    chat_id (getUpdates, answerCallbackQuery, getFile) проходять одразу.
+
+    Токени видаються строго за пріоритетом; фонові запити ще й лишають
+    OUTBOUND_RESERVE токенів, щоб відповідь у квізі не чекала на розсилку.
+    На RetryAfter на паузу стає і чат, і весь бот (flood control Telegram
+    рахує запити бота загалом), а запит повертається в чергу. Ліміти
+    Telegram діють на кожен токен окремо, тому бакети -- по bot.id.
+    """
+
+    def __init__(self, rate: float = OUTBOUND_GLOBAL_RATE, reserve: float = OUTBOUND_RESERVE):
+        self.rate = rate
+        self.reserve = reserve
+        self.buckets: Dict[int, TokenBucket] = {}
+        self.chats: "OrderedDict[tuple, TokenBucket]" = OrderedDict()
+        self.queues = {priority: deque() for priority in PRIORITY_NAMES}
+        self.sent = Counter()
+        self.retries = Counter()
+        self.bot_pauses = 0
+        self.max_wait = Counter()
+        self._wakeup = asyncio.Event()
+        self._pump_task = None
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await self._request(make_request, bot, method, "direct")
+
+        priority = outbound_priority.get()
+        key = (bot.id, chat_id)
+        for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+            await self._acquire(priority, key)
+            try:
+                result = await self._request(make_request, bot, method, PRIORITY_NAMES[priority])
+            except TelegramRetryAfter as e:
+                self.retries[priority] += 1
+                self._chat_bucket(key).pause(e.retry_after)
+                self._bot_bucket(bot.id).pause(e.retry_after)
+                self.bot_pauses += 1
+                logger.warning(f"RetryAfter {e.retry_after}с для {chat_id} ({PRIORITY_NAMES[priority]})")
+                if attempt == OUTBOUND_MAX_RETRIES:
+                    raise
+                continue
+            self.sent[priority] += 1
+            return result
+
+    @staticmethod
+    async def _request(make_request, bot, method, priority_name: str):
+        """Сам виклик API -- з гістограмою quizbot_telegram_request_seconds"""
+        start = time.perf_counter()
+        outcome = "ok"
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            outcome = "retry_after"
+            raise
+        except TelegramForbiddenError:
+            outcome = "forbidden"
+            raise
+        except TelegramBadRequest:
+            outcome = "bad_request"
+            raise
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - start, method.__api_method__, priority_name, outcome)
+
+    def _bot_bucket(self, bot_id: int) -> TokenBucket:
+        bucket = self.buckets.get(bot_id)
+        if bucket is None:
+            bucket = self.buckets[bot_id] = TokenBucket(self.rate, self.rate)
+        return bucket
+
+    def _chat_bucket(self, key: tuple) -> TokenBucket:
+        """Бакет чату; key = (bot_id, chat_id)"""
+        bucket = self.chats.get(key)
+        if bucket is None:
+            chat_id = key[1]
+            is_private = isinstance(chat_id, int) and chat_id > 0
+            bucket = TokenBucket(OUTBOUND_CHAT_RATE if is_private else OUTBOUND_GROUP_RATE, OUTBOUND_CHAT_BURST)
+            self.chats[key] = bucket
+            if len(self.chats) > OUTBOUND_MAX_CHATS:
+                # Повний бакет нічим не відрізняється від нового -- його можна забути
+                for idle in [k for k, b in self.chats.items() if b.is_idle()]:
+                    del self.chats[idle]
+        else:
+            self.chats.move_to_end(key)
+        return bucket
+
+    async def _acquire(self, priority: int, key: tuple):
+        future = asyncio.get_running_loop().create_future()
+        self.queues[priority].append((key, future, time.monotonic()))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        self._wakeup.set()
+        await future
+
+    def _grant_ready(self) -> Optional[float]:
+        """Видати токени всім, кому можна -> скільки чекати до наступного (None -- черга порожня)"""
+        next_wait = None
+        for priority, pending in self.queues.items():
+            reserve = 0 if priority == PRIORITY_INTERACTIVE else self.reserve
+            for entry in list(pending):
+                key, future, queued_at = entry
+                if future.done():  # запит скасовано, поки чекав
+                    pending.remove(entry)
+                    continue
+                bucket = self._bot_bucket(key[0])
+                chat = self._chat_bucket(key)
+                wait = max(bucket.delay(reserve), chat.delay())
+                if wait > 0:
+                    next_wait = wait if next_wait is None else min(next_wait, wait)
+                    continue
+                bucket.take()
+                chat.take()
+                pending.remove(entry)
+                self.max_wait[priority] = max(self.max_wait[priority], time.monotonic() - queued_at)
+                future.set_result(None)
+        return next_wait
+
+    async def _pump(self):
+        while True:
+            self._wakeup.clear()
+            wait = self._grant_ready()
+            if wait is None and not any(self.queues.values()):
+                await self._wakeup.wait()
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait or 0.01)
+            except asyncio.TimeoutError:
+                pass
+
+    def depth(self) -> Dict[int, int]:
+        return {priority: len(pending) for priority, pending in self.queues.items()}
+
+    def paused_for(self) -> float:
+        """Найдовша пауза бота після RetryAfter (секунди)"""
+        return max((bucket.paused_for() for bucket in self.buckets.values()), default=0.0)
+
+    def format_stats(self) -> str:
+        lines = ["📮 ЧЕРГА ВИХІДНИХ ПОВІДОМЛЕНЬ\n"]
+        for priority, name in PRIORITY_NAMES.items():
+            lines.append(
+                f"• {name}: в черзі {len(self.queues[priority])}, "
+                f"надіслано {self.sent[priority]}, RetryAfter {self.retries[priority]}, "
+                f"макс. очікування {self.max_wait[priority]:.2f}с"
+            )
+        bucket = self._bot_bucket(bot.id)
+        lines.append(f"\n🪣 Токени бота: {bucket.tokens:.1f}/{bucket.capacity:.0f}")
+        paused = bucket.paused_for()
+        lines.append(f"⏸️ Пауз бота після RetryAfter: {self.bot_pauses}"
+                     + (f", зараз ще {paused:.1f}с" if paused else ""))
+        lines.append(f"💬 Чатів з лімітом: {len(self.chats)}")
+        return "\n".join(lines)
+
+
+outbound = OutboundDispatcher()
+
+
+# ═══════════════════════════════════════════════════════════
+# OUTBOX
+# ═══════════════════════════════════════════════════════════
+
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_CONCURRENCY = 10
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BACKOFF_BASE = 5      # секунд; подвоюється з кожною спробою
+OUTBOX_BACKOFF_MAX = 3600
+OUTBOX_IDLE_INTERVAL = 60
+
+
+def text_payload(text: str, parse_mode: Optional[str] = None,
+                 reply_markup: Optional[InlineKeyboardMarkup] = None) -> dict:
+    """Текстове повідомлення для outbox"""
+    payload = {"kind": "text", "text": text}
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+    if reply_markup is not None:
+        payload["reply_markup"] = reply_markup.model_dump(exclude_none=True)
+    return payload
+
+
+def copy_payload(from_chat_id: int, message_id: int) -> dict:
+    """Копія існуючого повідомлення (розсилка) для outbox"""
+    return {"kind": "copy", "from_chat_id": from_chat_id, "message_id": message_id}
+
+
+def outbox_enqueue(cursor, messages, priority: int = PRIORITY_BACKGROUND,
+                   delay: int = 0, batch_id: Optional[int] = None) -> int:
+    """Записати повідомлення [(chat_id, payload)] у транзакції викликача
+
+    Комітить викликач -- разом зі зміною стану, про яку ці повідомлення.
+    Після коміту треба викликати outbox.wake().
+    """
+    due = int(time.time()) + delay
+    rows = [(chat_id, json.dumps(payload, ensure_ascii=False), priority, batch_id, due)
+            for chat_id, payload in messages]
+    cursor.executemany('''
+        INSERT INTO outbox (chat_id, payload, priority, batch_id, next_attempt_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', rows)
+    return len(rows)
+
+
+# Колонки outbox_batches для кожного результату доставки
+BATCH_COUNTERS = {
+    "sent": "sent",
+    DELIVERY_BLOCKED: "blocked",
+    DELIVERY_DEACTIVATED: "deactivated",
+    DELIVERY_CHAT_NOT_FOUND: "chat_not_found",
+    "failed": "failed",
+}
+
+
+class Outbox:
+    """Фоновий відправник outbox: at-least-once з експоненційним backoff
+
+    Рядок видаляється тільки після успішного надсилання (або якщо чат мертвий
+    чи спроби вичерпано), тому після перезапуску недоставлене піде знову.
+    Темп і пріоритети забезпечує outbound, тут лише паралельність.
+    """
+
+    COUNT_INTERVAL = 5  # як часто оновлювати counts під час безперервної відправки (секунди)
+
+    def __init__(self, batch_size: int = OUTBOX_BATCH_SIZE, concurrency: int = OUTBOX_CONCURRENCY):
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self._wakeup = asyncio.Event()
+        self.counts: Optional[tuple] = None  # (належні, відкладені) для /health; None -- відправник не запущений
+        self._counted_at = 0.0
+
+    def wake(self, broadcast: bool = True):
+        """Розбудити відправника; у режимі воркерів він живе лише в головному"""
+        self._wakeup.set()
+        if broadcast and not worker.is_primary:
+            worker.publish("outbox")
+
+    @observe_query
+    def _due(self, now: int) -> list:
+        rows = []
+        with get_db() as conn:
+            cursor = conn.cursor()
+            for priority in PRIORITY_NAMES:
+                cursor.execute('''
+                    SELECT id, chat_id, payload, priority, batch_id, attempts
+                    FROM outbox
+                    WHERE priority = ? AND next_attempt_at <= ?
+                    ORDER BY next_attempt_at
+                    LIMIT ?
+                ''', (priority, now, self.batch_size - len(rows)))
+                rows += cursor.fetchall()
+                if len(rows) >= self.batch_size:
+                    break
+        return rows
+
+    @observe_query
+    def _next_due_in(self) -> float:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            due = [cursor.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE priority = ?",
+                                  (priority,)).fetchone()[0] for priority in PRIORITY_NAMES]
+        due = [d for d in due if d is not None]
+        if not due:
+            return OUTBOX_IDLE_INTERVAL
+        return min(OUTBOX_IDLE_INTERVAL, max(0.5, min(due) - time.time()))
+
+    @observe_query
+    def _count(self):
+        now = int(time.time())
+        with get_db() as conn:
+            total, due = conn.execute("SELECT COUNT(*), SUM(next_attempt_at <= ?) FROM outbox",
+                                      (now,)).fetchone()
+        self.counts = (due or 0, total - (due or 0))
+        self._counted_at = time.monotonic()
+
+    async def _send(self, row) -> tuple:
+        """Надіслати один рядок -> (None, None) при успіху або (статус, текст помилки)"""
+        payload = json.loads(row["payload"])
+        with outbound_scope(row["priority"]):
+            try:
+                if payload["kind"] == "copy":
+                    await bot.copy_message(chat_id=row["chat_id"], from_chat_id=payload["from_chat_id"],
+                                           message_id=payload["message_id"])
+                else:
+                    markup = payload.get("reply_markup")
+                    await bot.send_message(
+                        row["chat_id"], payload["text"], parse_mode=payload.get("parse_mode"),
+                        reply_markup=InlineKeyboardMarkup.model_validate(markup) if markup else None
+                    )
+                return None, None
+            except Exception as e:
+                status = handle_send_error(row["chat_id"], e)
+                if status not in DEAD_DELIVERY_STATUSES:
+                    logger.warning(f"Outbox {row['id']} -> {row['chat_id']}: {e}")
+                return status, str(e)[:200]
+
+    async def drain_once(self) -> int:
+        """Надіслати одну пачку належних повідомлень -> скільки оброблено"""
+        now = int(time.time())
+        rows = self._due(now)
+        if not rows:
+            return 0
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send_one(row):
+            async with semaphore:
+                return await self._send(row)
+
+        results = await asyncio.gather(*(send_one(row) for row in rows))
+
+        done, retry = [], []
+        batch_counts = {}
+        for row, (status, error) in zip(rows, results):
+            if status is not None and status not in DEAD_DELIVERY_STATUSES:
+                if row["attempts"] + 1 < OUTBOX_MAX_ATTEMPTS:
+                    backoff = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** row["attempts"])
+                    retry.append((now + backoff, error, row["id"]))
+                    continue
+                logger.error(f"Outbox {row['id']} -> {row['chat_id']}: спроби вичерпано")
+                status = "failed"
+            done.append((row["id"],))
+            if row["batch_id"] is not None:
+                counts = batch_counts.setdefault(row["batch_id"], Counter())
+                counts[BATCH_COUNTERS[status or "sent"]] += 1
+
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.executemany("DELETE FROM outbox WHERE id = ?", done)
+            cursor.executemany('''
+                UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = ?
+                WHERE id = ?
+            ''', retry)
+            for batch_id, counts in batch_counts.items():
+                assignments = ", ".join(f"{column} = {column} + ?" for column in counts)
+                cursor.execute(f"UPDATE outbox_batches SET {assignments} WHERE id = ?",
+                               [*counts.values(), batch_id])
+            self._finish_batches(cursor, now)
+            conn.commit()
+        return len(rows)
+
+    def _finish_batches(self, cursor, now: int):
+        """Закрити пачки без залишку в outbox і поставити звіт у чергу"""
+        cursor.execute('''
+            SELECT * FROM outbox_batches b
+            WHERE finished_at IS NULL
+              AND NOT EXISTS (SELECT 1 FROM outbox o WHERE o.batch_id = b.id)
+        ''')
+        for batch in cursor.fetchall():
+            cursor.execute("UPDATE outbox_batches SET finished_at = ? WHERE id = ?", (now, batch["id"]))
+            if batch["report_chat_id"]:
+                outbox_enqueue(cursor, [(batch["report_chat_id"], text_payload(format_batch_report(batch, now)))],
+                               priority=PRIORITY_ADMIN)
+
+    @observe_query
+    def stats(self) -> dict:
+        now = int(time.time())
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT priority, COUNT(*) AS total, SUM(next_attempt_at <= ?) AS due, SUM(attempts > 0) AS retrying
+                FROM outbox GROUP BY priority
+            ''', (now,))
+            by_priority = {row["priority"]: dict(row) for row in cursor.fetchall()}
+            cursor.execute('''
+                SELECT b.id, b.title, b.total, b.total - COUNT(o.id) AS processed
+                FROM outbox_batches b LEFT JOIN outbox o ON o.batch_id = b.id
+                WHERE b.finished_at IS NULL
+                GROUP BY b.id
+            ''')
+            batches = [dict(row) for row in cursor.fetchall()]
+        return {"by_priority": by_priority, "batches": batches}
+
+    def format_stats(self) -> str:
+        stats = self.stats()
+        total = sum(row["total"] for row in stats["by_priority"].values())
+        lines = [f"📦 OUTBOX: {total} в черзі"]
+        for priority, name in PRIORITY_NAMES.items():
+            row = stats["by_priority"].get(priority)
+            if row:
+                lines.append(f"• {name}: {row['total']} (належить зараз {row['due']}, повторні {row['retrying']})")
+        for batch in stats["batches"]:
+            lines.append(f"📢 {batch['title']} #{batch['id']}: {batch['processed']}/{batch['total']}")
+        return "\n".join(lines)
+
+    async def run(self):
+        """Фоновий цикл: надсилає, поки є належні, потім спить до наступного"""
+        while True:
+            self._wakeup.clear()
+            try:
+                with timed(LOOP_SECONDS, "outbox"):
+                    drained = await self.drain_once()
+                if not drained or time.monotonic() - self._counted_at >= self.COUNT_INTERVAL:
+                    self._count()
+                if drained:
+                    continue
+                wait = self._next_due_in()
+            except Exception as e:
+                logger.error(f"Помилка outbox: {e}")
+                wait = OUTBOX_BACKOFF_BASE
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+
+def format_batch_report(batch, finished_at: int) -> str:
+    return (
+        f"✅ РОЗСИЛКА ЗАВЕРШЕНА\n\n"
+        f"⏱️ Час: {finished_at - batch['created_at']}с\n"
+        f"📨 Надіслано: {batch['sent']}/{batch['total']}\n"
+        f"🚫 Заблокували бота: {batch['blocked']}\n"
+        f"👻 Видалені акаунти: {batch['deactivated']}\n"
+        f"❓ Чат не знайдено: {batch['chat_not_found']}\n"
+        f"❌ Помилок: {batch['failed']}"
+    )
+
+
+outbox = TenantLocal("outbox")
+
+# ═══════════════════════════════════════════════════════════
+# MIDDLEWARE
+# ═══════════════════════════════════════════════════════════
+
+async def send_payment_message(message: Message):
+    """Повідомлення про оплату для користувача без доступу"""
+    payment_msg = get_payment_message(message.from_user.id)
+    builder = InlineKeyboardBuilder()
+    builder.button(text="📞 Зв'язатися", url=f"https://t.me/{tenant().payment_contact.replace('@', '')}")
+    builder.button(text="🔄 Перевірити доступ", callback_data="check_access")
+    builder.adjust(1)
+    await message.answer(payment_msg, reply_markup=builder.as_markup(), parse_mode="Markdown")
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """Визначає користувача один раз на апдейт і перевіряє доступ
+
+    Профіль (читання, upsert лише при змінах) передається в обробники як user_profile,
+    доступ перевіряється через кеш access_control.
+    """
+
+    PUBLIC_COMMANDS = ("/start",)
+    PUBLIC_CALLBACKS = ("check_access",)
+
+    def _is_public(self, event) -> bool:
+        if isinstance(event, Message):
+            text = (event.text or "").split(maxsplit=1)
+            return bool(text) and text[0].split("@")[0] in self.PUBLIC_COMMANDS
+        if isinstance(event, CallbackQuery):
+            return event.data in self.PUBLIC_CALLBACKS
+        return False
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or user.is_bot:
+            return await handler(event, data)
+
+        data["user_profile"] = get_or_create_user(
+            user.id, user.username or "Unknown", user.first_name or "User"
+        )
+
+        if not is_user_whitelisted(user.id) and not self._is_public(event):
+            if isinstance(event, CallbackQuery):
+                await event.answer("❌ Доступ не надано. Звертайся до адміна.", show_alert=True)
+            elif isinstance(event, Message):
+                await send_payment_message(event)
+            return None
+
+        return await handler(event, data)
+
+
+# ═══════════════════════════════════════════════════════════
+# ЗВЕДЕННЯ ДЛЯ АДМІНА
+# ═══════════════════════════════════════════════════════════
+
+class AdminDigest:
+    """Буфер подій відповідей для адміна
+
+    Обробник відповіді лише додає подію в пам'ять; раз на вікно фонова
+    задача збирає події по користувачах в одне повідомлення. З кількома
+    воркерами зведення надсилає лише головний, решта пересилають йому свої
+    події через канал фронта -- адмін отримує одне зведення на вікно.
+    """
+
+    FORWARD_INTERVAL = 5  # як часто неголовні воркери пересилають події (секунди)
+    MAX_DETAILS = 3
+    MAX_MESSAGE_LENGTH = 4000
+    KIND_EMOJI = {"correct": "✅", "wrong": "❌", "timeout": "⏰"}
+
+    def __init__(self, interval: int):
+        self.interval = interval
+        self._events: Dict[int, dict] = {}
+        self._window_start = time.time()
+
+    def record(self, user_id: int, name: str, kind: str, detail: str = "",
+               response_time: Optional[float] = None):
+        """Додати подію (correct / wrong / timeout) -- без I/O"""
+        entry = self._events.get(user_id)
+        if entry is None:
+            entry = self._events[user_id] = {
+                "name": name, "correct": 0, "wrong": 0, "timeout": 0,
+                "time_sum": 0.0, "time_count": 0, "details": []
+            }
+        entry["name"] = name or entry["name"]
+        entry[kind] += 1
+        if response_time is not None:
+            entry["time_sum"] += response_time
+            entry["time_count"] += 1
+        if detail and kind != "correct":
+            entry["details"].append(f"{self.KIND_EMOJI[kind]} {detail}")
+            del entry["details"][:-self.MAX_DETAILS]
+
+    @property
+    def pending(self) -> int:
+        return len(self._events)
+
+    def merge(self, events: Dict[int, dict]):
+        """Додати події, зібрані іншим воркером"""
+        for user_id, incoming in events.items():
+            entry = self._events.get(user_id)
+            if entry is None:
+                self._events[user_id] = incoming
+                continue
+            entry["name"] = incoming["name"] or entry["name"]
+            for field in ("correct", "wrong", "timeout", "time_sum", "time_count"):
+                entry[field] += incoming[field]
+            entry["details"].extend(incoming["details"])
+            del entry["details"][:-self.MAX_DETAILS]
+
+    def drain(self) -> tuple:
+        events, self._events = self._events, {}
+        window = time.time() - self._window_start
+        self._window_start = time.time()
+        return events, window
+
+    def format(self, events: Dict[int, dict], window: float) -> List[str]:
+        """Зведення, розбите на повідомлення до MAX_MESSAGE_LENGTH"""
+        header = f"📬 АКТИВНІСТЬ ЗА {max(1, round(window / 60))} ХВ\n"
+        messages, current = [], header
+        for entry in sorted(events.values(), key=lambda e: -(e["correct"] + e["wrong"] + e["timeout"])):
+            block = f"\n👤 {entry['name']}: ✅ {entry['correct']} | ❌ {entry['wrong']} | ⏰ {entry['timeout']}"
+            if entry["time_count"]:
+                block += f" | ⏱️ {entry['time_sum'] / entry['time_count']:.1f}с"
+            for detail in entry["details"]:
+                block += f"\n   {detail}"
+            if len(current) + len(block) > self.MAX_MESSAGE_LENGTH:
+                messages.append(current)
+                current = header
+            current += block
+        messages.append(current)
+        return messages
+
+    async def flush(self):
+        events, window = self.drain()
+        events = {uid: e for uid, e in events.items() if is_admin_notif_enabled(uid)}
+        if not events:
+            return
+        for text in self.format(events, window):
+            try:
+                await bot.send_message(tenant().admin_id, text)
+            except Exception as e:
+                logger.error(f"Помилка надсилання зведення адміну: {e}")
+
+    async def run(self):
+        """Фоновий цикл надсилання зведень (на неголовному воркері -- пересилання подій)"""
+        if not worker.is_primary:
+            while True:
+                await asyncio.sleep(min(self.interval, self.FORWARD_INTERVAL))
+                events, _ = self.drain()
+                if events:
+                    worker.forward_digest(events)
+        outbound_priority.set(PRIORITY_ADMIN)
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                with timed(LOOP_SECONDS, "admin_digest"):
+                    await self.flush()
+            except Exception as e:
+                logger.error(f"Помилка зведення для адміна: {e}")
+
+
+admin_digest = TenantLocal("admin_digest")
+
+
+class Tenant:
+    """Один бот (школа): токен, адмін, БД, ціни, вайтліст і власні кеші
+
+    Обробники, рушії питань, outbound і пул воркерів спільні для всіх
+    тенантів; усе, що тримає дані користувачів, живе тут.
+    """
+
+    def __init__(self, name: str, token: str, admin_id: int, db_name: str,
+                 payment_contact: str = PAYMENT_CONTACT, monthly_price: int = MONTHLY_PRICE,
+                 full_code_price: int = FULL_CODE_PRICE, whitelist: List[int] = (),
+                 log_dir: Optional[str] = None, db_shards: int = DB_SHARDS,
+                 storage: str = STORAGE_BACKEND):
+        self.name = name
+        self.admin_id = admin_id
+        self.db_name = db_name
+        self.db_shards = db_shards
+        self.payment_contact = payment_contact
+        self.monthly_price = monthly_price
+        self.full_code_price = full_code_price
+
+        self.bot = Bot(token=token)
+        self.bot.session.middleware(outbound)
+        self.repository = create_repository(storage)
+        self.access_control = AccessControl(whitelist)
+        self.admin_notif_prefs = AdminNotifPrefs()
+        self.notif_page_cache = PageCache()
+        self.response_sketches = ResponseSketchStore()
+        self.answer_event_log = AnswerEventLog(log_dir or os.path.join(ANSWER_LOG_DIR, name), ANSWER_LOG_SEGMENT_SIZE)
+        self.outbox = Outbox()
+        self.admin_digest = AdminDigest(ADMIN_DIGEST_INTERVAL)
+
+    def user_db_name(self, user_id: int) -> str:
+        """Файл БД з даними користувача"""
+        if not self.db_shards:
+            return self.db_name
+        return shard_db_name(self.db_name, user_id % self.db_shards)
+
+    def user_db_names(self) -> List[str]:
+        """Усі файли з даними користувачів (для запитів по всіх шардах)"""
+        if not self.db_shards:
+            return [self.db_name]
+        return [shard_db_name(self.db_name, index) for index in range(self.db_shards)]
+
+
+def load_tenants() -> List[Tenant]:
+    """Тенанти з BOTS; без BOTS -- один бот з верхньорівневих налаштувань"""
+    if not BOTS:
+        return [Tenant("default", BOT_TOKEN, ADMIN_ID, DB_NAME, whitelist=WHITELIST, log_dir=ANSWER_LOG_DIR)]
+    return [Tenant(**config) for config in BOTS]
+
+
+tenants = load_tenants()
+tenants_by_bot_id = {t.bot.id: t for t in tenants}
+tenants_by_name = {t.name: t for t in tenants}
+current_tenant.set(tenants[0])  # за замовчуванням (один бот, скрипти) -- перший
+
+
+class TenantMiddleware(BaseMiddleware):
+    """Outer middleware оновлень: обробник працює в контексті свого бота"""
+
+    async def __call__(self, handler, event, data: dict):
+        with tenant_scope(tenants_by_bot_id[data["bot"].id]):
+            return await handler(event, data)
+
+
 # ═══════════════════════════════════════════════════════════
 # ЩОДЕННІ НАГАДУВАННЯ
 # ═══════════════════════════════════════════════════════════
 
 async def send_daily_reminders():
-    """Надсилає нагадування у визначені години"""
-    last_reminder_hour = -1  # Для відстеження останньої години нагадування
+    """Ставить нагадування в outbox у визначені години
 
+    Оброблена година зберігається в bot_settings у тій самій транзакції,
+    що й нагадування, тож після перезапуску вони не губляться і не дублюються.
+    """
     while True:
+        started = None
         try:
             now = datetime.now()
             current_hour = now.hour
+            slot = int(now.strftime("%Y%m%d%H"))
 
-            if current_hour in REMINDER_HOURS and current_hour != last_reminder_hour:
-                logger.info(f"⏰ Надсилаємо нагадування о {current_hour}:00")
-
+            if current_hour in REMINDER_HOURS:
+                started = time.perf_counter()
                 with get_db() as conn:
                     cursor = conn.cursor()
-                    today = now.date()
+                    cursor.execute("SELECT value FROM bot_settings WHERE name = 'reminder_last_slot'")
+                    row = cursor.fetchone()
+                    if row is not None and row[0] == slot:
+                        await asyncio.sleep(60)
+                        continue
 
-                    # Знаходимо користувачів для нагадування
-                    cursor.execute('''
-                        SELECT user_id, first_name, custom_name, last_activity
-                        FROM users
-                        WHERE reminder_enabled = 1
-                    ''')
+                    logger.info(f"⏰ Надсилаємо нагадування о {current_hour}:00")
 
-                    users = cursor.fetchall()
-                    sent_count = 0
+                    # Знаходимо користувачів для нагадування
+                    users = repository.reminder_candidates()
+                    reminders = []
 
                     for user in users:
                         user_id = user['user_id']
@@ -862,29 +4629,24 @@ async def send_daily_reminders():
                         builder.button(text="🔕 Вимкнути нагадування", callback_data="disable_reminders")
                         builder.adjust(1, 1, 1, 1)
 
-                        try:
-                            await bot.send_message(
-                                user_id,
-                                reminder_text,
-                                reply_markup=builder.as_markup()
-                            )
-                            sent_count += 1
-                            await asyncio.sleep(0.1)
-                        except Exception as e:
-                            logger.error(f"Помилка нагадування для {user_id}: {e}")
-
-                logger.info(f"✅ Надіслано {sent_count} нагадувань о {current_hour}:00")
+                        reminders.append((user_id, text_payload(reminder_text, reply_markup=builder.as_markup())))
 
-                last_reminder_hour = current_hour
-                await asyncio.sleep(60)
+                    outbox_enqueue(cursor, reminders)
+                    cursor.execute('''
+                        INSERT INTO bot_settings (name, value) VALUES ('reminder_last_slot', ?)
+                        ON CONFLICT(name) DO UPDATE SET value = excluded.value
+                    ''', (slot,))
+                    conn.commit()
+                outbox.wake()
+                LOOP_SECONDS.observe(time.perf_counter() - started, "reminders", "ok")
 
-            else:
-                await asyncio.sleep(60)
+                logger.info(f"✅ У черзі {len(reminders)} нагадувань о {current_hour}:00")
 
-                if current_hour != last_reminder_hour and current_hour not in REMINDER_HOURS:
-                    last_reminder_hour = -1
+            await asyncio.sleep(60)
 
         except Exception as e:
+            if started is not None:
+                LOOP_SECONDS.observe(time.perf_counter() - started, "reminders", "error")
             logger.error(f"Помилка в циклі нагадувань: {e}")
             await asyncio.sleep(60)
 
@@ -895,31 +4657,27 @@ async def send_daily_reminders():
 # ═══════════════════════════════════════════════════════════
 
 @router.message(Command("start"))
-async def cmd_start(message: Message, state: FSMContext):
+async def cmd_start(message: Message, state: FSMContext, user_profile: dict):
     """Обробник команди /start"""
     user_id = message.from_user.id
     
     # Перевірка доступу
     if not is_user_whitelisted(user_id):
-        payment_msg = get_payment_message(user_id)
-        builder = InlineKeyboardBuilder()
-        builder.button(text="📞 Зв'язатися", url=f"https://t.me/{PAYMENT_CONTACT.replace('@', '')}")
-        builder.button(text="🔄 Перевірити доступ", callback_data="check_access")
-        builder.adjust(1)
-        await message.answer(payment_msg, reply_markup=builder.as_markup(), parse_mode="Markdown")
+        await send_payment_message(message)
         return
     
-    username = message.from_user.username or "Unknown"
-    first_name = message.from_user.first_name or "User"
+    username = user_profile.get('username') or "Unknown"
+    first_name = user_profile.get('first_name') or "User"
     
-    user = get_or_create_user(user_id, username, first_name)
+    user = user_profile
     display_name = user.get('custom_name') or first_name
     
     if user['total_questions'] == 0:
         log_msg = f"🆕 Новий користувач!\n👤 ID: {user_id}\n📝 @{username}\n👨‍💼 {first_name}\n⏰ {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
         try:
             if is_admin_notif_enabled(user_id):
-                await bot.send_message(ADMIN_ID, log_msg)
+                with outbound_scope(PRIORITY_ADMIN):
+                    await bot.send_message(tenant().admin_id, log_msg)
         except:
             pass
     
@@ -951,10 +4709,9 @@ async def cmd_start(message: Message, state: FSMContext):
 
 
 @router.message(Command("stats"))
-async def cmd_stats(message: Message):
+async def cmd_stats(message: Message, user_profile: dict):
     """Статистика користувача"""
-    user_id = message.from_user.id
-    stats = get_user_stats(user_id)
+    stats = user_profile
     
     if not stats or stats['total_questions'] == 0:
         await message.answer("❌ У тебе ще немає статистики!")
@@ -986,7 +4743,7 @@ async def cmd_stats(message: Message):
 
 
 @router.callback_query(F.data == "check_access")
-async def check_access_callback(callback: CallbackQuery):
+async def check_access_callback(callback: CallbackQuery, user_profile: dict):
     """Перевірка доступу користувача"""
     user_id = callback.from_user.id
     
@@ -1002,7 +4759,7 @@ async def check_access_callback(callback: CallbackQuery):
             from_user=callback.from_user
         )
         # Просто відправляємо нове повідомлення
-        display_name = get_display_name(user_id)
+        display_name = user_profile.get('custom_name') or user_profile.get('first_name') or 'User'
         welcome_text = f"""
 🎓 Привіт, {display_name}!
 
@@ -1029,135 +4786,312 @@ async def check_access_callback(callback: CallbackQuery):
         await callback.answer("❌ Доступ не надано. Звертайся до адміна.", show_alert=True)
 
 
+def whitelist_add(user_id: int, days: Optional[int] = None) -> tuple:
+    """Додати/продовжити доступ -> (був_новим, час_закінчення); новому -- сповіщення через outbox"""
+    was_new = user_id not in access_control.ids
+    return was_new, access_control.grant(user_id, days, announce=access_granted_payload())
+
+
+def whitelist_remove(user_id: int) -> bool:
+    """Видалити з вайтліста; False, якщо його там не було"""
+    return access_control.revoke(user_id, announce=access_revoked_payload())
+
+
+ACCESS_GRANTED_TEXT = (
+    "🎉 **ДОСТУП НАДАНО!**\n\n"
+    "Вітаємо! Тепер у тебе є повний доступ до бота! 🚀\n\n"
+    "Використовуй /start щоб почати!"
+)
+
+
+def access_granted_payload() -> dict:
+    return text_payload(ACCESS_GRANTED_TEXT, parse_mode="Markdown")
+
+
+def access_revoked_payload() -> dict:
+    return text_payload(
+        f"🔒 **ДОСТУП СКАСОВАНО**\n\n"
+        f"Термін підписки закінчився.\n\n"
+        f"Для відновлення доступу звертайся: {tenant().payment_contact}",
+        parse_mode="Markdown"
+    )
+
+
+BULK_CSV_MAX_SIZE = 1024 * 1024
+_DAYS_TOKEN_RE = re.compile(r"^(\d+)[dдD]$")
+
+
+def parse_whitelist_args(tokens: List[str]) -> tuple:
+    """Аргументи /addwhite, /removewhite -> (ids, днів або None, некоректні)"""
+    ids, invalid, days = [], [], None
+    for token in tokens:
+        token = token.strip().strip(",;")
+        if not token:
+            continue
+        match = _DAYS_TOKEN_RE.match(token)
+        if match:
+            days = int(match.group(1))
+        elif token.isdigit():
+            ids.append(int(token))
+        else:
+            invalid.append(token)
+    return ids, days, invalid
+
+
+async def read_ids_from_csv(message: Message) -> tuple:
+    """ID з CSV-документа: перше числове поле кожного рядка -> (ids, пропущено)"""
+    document = message.document
+    if document.file_size and document.file_size > BULK_CSV_MAX_SIZE:
+        raise ValueError("файл завеликий (максимум 1 МБ)")
+    buffer = await bot.download(document)
+    content = buffer.read().decode("utf-8-sig", errors="replace")
+    ids, skipped = [], 0
+    for row in csv.reader(io.StringIO(content)):
+        value = next((cell.strip() for cell in row if cell.strip().isdigit()), None)
+        if value is None:
+            skipped += 1 if any(cell.strip() for cell in row) else 0
+        else:
+            ids.append(int(value))
+    return ids, skipped
+
+
+async def collect_whitelist_ids(message: Message) -> tuple:
+    """ID з тексту команди та/або прикріпленого CSV"""
+    text = message.text or message.caption or ""
+    ids, days, invalid = parse_whitelist_args(text.split()[1:])
+    skipped = len(invalid)
+    if message.document:
+        csv_ids, csv_skipped = await read_ids_from_csv(message)
+        ids += csv_ids
+        skipped += csv_skipped
+    return list(dict.fromkeys(ids)), days, skipped
+
+
 @router.message(Command("addwhite"))
 async def cmd_add_to_whitelist(message: Message):
-    """Адмін-команда: додати користувача до вайтліста"""
-    if message.from_user.id != ADMIN_ID:
+    """Адмін-команда: додати користувачів до вайтліста (по ID або з CSV)"""
+    if message.from_user.id != tenant().admin_id:
         await message.answer("❌ Тільки для адміна!")
         return
     
     try:
-        parts = message.text.strip().split()
-        if len(parts) != 2:
-            await message.answer("❌ Формат: /addwhite USER_ID")
-            return
-        
-        user_id = int(parts[1])
-        
-        if user_id in WHITELIST:
-            await message.answer(f"ℹ️ Користувач {user_id} вже у вайтлісті!")
+        ids, days, skipped = await collect_whitelist_ids(message)
+        if not ids:
+            default_term = (f"{SUBSCRIPTION_DAYS} днів, 0d -- безстроково" if SUBSCRIPTION_DAYS
+                            else "безстроково, 30d -- підписка на 30 днів")
+            await message.answer(
+                "❌ Формат: /addwhite USER_ID [USER_ID ...] [30d]\n\n"
+                f"Без терміну -- {default_term}.\n"
+                "Можна надіслати CSV-файл з ID і підписом /addwhite"
+            )
             return
         
-        WHITELIST.append(user_id)
-        
-        # Зберігаємо в БД
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE users SET is_whitelisted = 1 WHERE user_id = ?", (user_id,))
-            conn.commit()
+        days = SUBSCRIPTION_DAYS if days is None else days
+        new_ids = [uid for uid in ids if uid not in access_control.ids]
+        # Сповіщення новим користувачам пишуться в outbox у тій самій транзакції
+        expires = access_control.grant_many(ids, days, announce=access_granted_payload())
         
-        await message.answer(f"✅ Користувача {user_id} додано до вайтліста!")
+        if len(ids) == 1:
+            user_id = ids[0]
+            if new_ids:
+                await message.answer(f"✅ Користувача {user_id} додано до вайтліста {format_expiry(expires[user_id])}!")
+            elif expires[user_id] is None and days:
+                await message.answer(f"ℹ️ Користувач {user_id} вже має безстроковий доступ, нічого не змінено")
+            else:
+                await message.answer(f"ℹ️ Користувач {user_id} вже у вайтлісті, доступ продовжено {format_expiry(expires[user_id])}")
         
-        # Повідомляємо користувача
-        try:
-            await bot.send_message(
-                user_id,
-                "🎉 **ДОСТУП НАДАНО!**\n\n"
-                "Вітаємо! Тепер у тебе є повний доступ до бота! 🚀\n\n"
-                "Використовуй /start щоб почати!",
-                parse_mode="Markdown"
+        if len(ids) > 1:
+            permanent = sum(1 for uid in ids if uid not in new_ids and expires[uid] is None) if days else 0
+            await message.answer(
+                f"✅ ВАЙТЛІСТ ОНОВЛЕНО\n\n"
+                f"➕ Додано: {len(new_ids)}\n"
+                f"🔁 Продовжено: {len(ids) - len(new_ids) - permanent}\n"
+                f"♾️ Вже безстроково, без змін: {permanent}\n"
+                f"⚠️ Пропущено рядків: {skipped}\n"
+                f"📅 Термін: {format_expiry(int(time.time()) + days * 86400) if days else 'безстроково'}\n\n"
+                f"📨 Сповіщень у черзі: {len(new_ids)}"
             )
-        except:
-            pass
             
-    except ValueError:
-        await message.answer("❌ USER_ID має бути числом!")
+    except ValueError as e:
+        await message.answer(f"❌ Помилка: {e}")
     except Exception as e:
         await message.answer(f"❌ Помилка: {e}")
 
 
 @router.message(Command("removewhite"))
 async def cmd_remove_from_whitelist(message: Message):
-    """Адмін-команда: видалити користувача з вайтліста"""
-    if message.from_user.id != ADMIN_ID:
+    """Адмін-команда: видалити користувачів з вайтліста (по ID або з CSV)"""
+    if message.from_user.id != tenant().admin_id:
         await message.answer("❌ Тільки для адміна!")
         return
     
     try:
-        parts = message.text.strip().split()
-        if len(parts) != 2:
-            await message.answer("❌ Формат: /removewhite USER_ID")
-            return
-        
-        user_id = int(parts[1])
-        
-        if user_id not in WHITELIST:
-            await message.answer(f"ℹ️ Користувач {user_id} не у вайтлісті!")
+        ids, _, skipped = await collect_whitelist_ids(message)
+        if not ids:
+            await message.answer("❌ Формат: /removewhite USER_ID [USER_ID ...]\n\nАбо CSV-файл з підписом /removewhite")
             return
         
-        WHITELIST.remove(user_id)
-        
-        # Видаляємо з БД
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE users SET is_whitelisted = 0 WHERE user_id = ?", (user_id,))
-            conn.commit()
+        removed = access_control.revoke_many(ids, announce=access_revoked_payload())
         
-        await message.answer(f"✅ Користувача {user_id} видалено з вайтліста!")
+        if len(ids) == 1:
+            if removed:
+                await message.answer(f"✅ Користувача {ids[0]} видалено з вайтліста!")
+            else:
+                await message.answer(f"ℹ️ Користувач {ids[0]} не у вайтлісті!")
         
-        # Повідомляємо користувача
-        try:
-            await bot.send_message(
-                user_id,
-                f"🔒 **ДОСТУП СКАСОВАНО**\n\n"
-                f"Термін підписки закінчився.\n\n"
-                f"Для відновлення доступу звертайся: {PAYMENT_CONTACT}",
-                parse_mode="Markdown"
+        if len(ids) > 1:
+            await message.answer(
+                f"✅ ВАЙТЛІСТ ОНОВЛЕНО\n\n"
+                f"➖ Видалено: {len(removed)}\n"
+                f"ℹ️ Не були у вайтлісті: {len(ids) - len(removed)}\n"
+                f"⚠️ Пропущено рядків: {skipped}\n\n"
+                f"📨 Сповіщень у черзі: {len(removed)}"
             )
-        except:
-            pass
             
-    except ValueError:
-        await message.answer("❌ USER_ID має бути числом!")
     except Exception as e:
         await message.answer(f"❌ Помилка: {e}")
 
 
+def render_whitelist_page(after: int = 0) -> tuple:
+    """Текст і клавіатура сторінки вайтліста"""
+    page = get_whitelist_page(after)
+    if not page["users"]:
+        return "📋 Вайтліст порожній!", None
+
+    text = "📋 ВАЙТЛІСТ КОРИСТУВАЧІВ:\n\n"
+    for user in page["users"]:
+        name = user["custom_name"] or user["first_name"] or "не реєстрований"
+        username = f" @{user['username']}" if user["username"] else ""
+        text += f"• {name}{username} (ID: {user['user_id']}) -- {format_expiry(user['subscription_expires'])}\n"
+    text += f"\nВсього: {page['total']} користувачів"
+
+    builder = InlineKeyboardBuilder()
+    if after:
+        builder.button(text="⏮ На початок", callback_data="wl_page_0")
+    if page["has_next"]:
+        builder.button(text="➡️ Далі", callback_data=f"wl_page_{page['users'][-1]['user_id']}")
+    return text, builder.as_markup() if (after or page["has_next"]) else None
+
+
 @router.message(Command("whitelist"))
 async def cmd_show_whitelist(message: Message):
     """Адмін-команда: показати вайтліст"""
-    if message.from_user.id != ADMIN_ID:
+    if message.from_user.id != tenant().admin_id:
         await message.answer("❌ Тільки для адміна!")
         return
-    
-    if not WHITELIST:
-        await message.answer("📋 Вайтліст порожній!")
+    if not repository.uses_catalog:
+        await message.answer(CATALOG_ONLY_TEXT)
         return
     
-    whitelist_text = "📋 **ВАЙТЛІСТ КОРИСТУВАЧІВ:**\n\n"
-    
-    for idx, user_id in enumerate(WHITELIST, 1):
-        # Отримуємо інфо про користувача
-        stats = get_user_stats(user_id)
-        if stats:
-            name = stats.get("custom_name") or stats.get("first_name", "Unknown")
-            whitelist_text += f"{idx}. {name} (ID: `{user_id}`)\n"
+    text, markup = render_whitelist_page()
+    await message.answer(text, reply_markup=markup)
+
+
+@router.callback_query(F.data.startswith("wl_page_"))
+async def whitelist_page_cb(callback: CallbackQuery):
+    if callback.from_user.id != tenant().admin_id:
+        await callback.answer("❌ Тільки для адміна!", show_alert=True)
+        return
+    await callback.answer()
+    text, markup = render_whitelist_page(int(callback.data.split("_")[2]))
+    await callback.message.edit_text(text, reply_markup=markup)
+
+
+def render_find_results(query: str) -> tuple:
+    """Результати /find з кнопками дій"""
+    users = search_users(query)
+    if not users:
+        return f"🔍 За запитом «{query}» нікого не знайдено.", None
+
+    text = f"🔍 ЗНАЙДЕНО ({len(users)}):\n\n"
+    builder = InlineKeyboardBuilder()
+    for idx, user in enumerate(users, 1):
+        name = user["custom_name"] or user["first_name"] or "User"
+        username = f" @{user['username']}" if user["username"] else ""
+        lock = "🔓" if user["is_whitelisted"] else "🔒"
+        text += f"{idx}. {lock} {name}{username}\n   ID: {user['user_id']} | питань: {user['total_questions']}\n"
+        if user["is_whitelisted"]:
+            builder.button(text=f"➖ {idx}. {name}", callback_data=f"find_rm_{user['user_id']}")
         else:
-            whitelist_text += f"{idx}. ID: `{user_id}` (не реєстрований)\n"
-    
-    whitelist_text += f"\n**Всього: {len(WHITELIST)} користувачів**"
-    
-    await message.answer(whitelist_text, parse_mode="Markdown")
+            builder.button(text=f"➕ {idx}. {name}", callback_data=f"find_add_{user['user_id']}")
+        builder.button(text=f"✏️ Ім'я {idx}", callback_data=f"find_name_{user['user_id']}")
+    builder.adjust(2)
+    return text, builder.as_markup()
+
+
+@router.message(Command("find"))
+async def cmd_find_user(message: Message, state: FSMContext):
+    """Адмін-команда: пошук користувача за іменем, username або ID"""
+    if message.from_user.id != tenant().admin_id:
+        await message.answer("❌ Тільки для адміна!")
+        return
+    if not repository.uses_catalog:
+        await message.answer(CATALOG_ONLY_TEXT)
+        return
+
+    parts = message.text.strip().split(maxsplit=1)
+    if len(parts) != 2:
+        await message.answer("❌ Формат: /find ім'я, @username або ID")
+        return
+
+    query = parts[1].lstrip("@")
+    await state.update_data(find_query=query)
+    text, markup = render_find_results(query)
+    await message.answer(text, reply_markup=markup)
+
+
+@router.callback_query(F.data.startswith("find_add_") | F.data.startswith("find_rm_"))
+async def find_whitelist_cb(callback: CallbackQuery, state: FSMContext):
+    """Додати/видалити з вайтліста з результатів пошуку"""
+    if callback.from_user.id != tenant().admin_id:
+        await callback.answer("❌ Тільки для адміна!", show_alert=True)
+        return
+    _, action, uid = callback.data.split("_")
+    user_id = int(uid)
+
+    if action == "add":
+        changed, expires = whitelist_add(user_id, SUBSCRIPTION_DAYS)
+        if changed:
+            await callback.answer(f"✅ Додано до вайтліста {format_expiry(expires)}")
+        elif expires is None:
+            await callback.answer("ℹ️ Вже у вайтлісті безстроково")
+        else:
+            await callback.answer(f"ℹ️ Вже у вайтлісті, доступ продовжено {format_expiry(expires)}")
+    else:
+        changed = whitelist_remove(user_id)
+        await callback.answer("✅ Видалено з вайтліста" if changed else "ℹ️ Не у вайтлісті")
+
+    query = (await state.get_data()).get("find_query")
+    if query:
+        text, markup = render_find_results(query)
+        try:
+            await callback.message.edit_text(text, reply_markup=markup)
+        except:
+            pass
+
+
+@router.callback_query(F.data.startswith("find_name_"))
+async def find_setname_cb(callback: CallbackQuery, state: FSMContext):
+    """Встановити ім'я користувачу з результатів пошуку"""
+    if callback.from_user.id != tenant().admin_id:
+        await callback.answer("❌ Тільки для адміна!", show_alert=True)
+        return
+    await callback.answer()
+    user_id = int(callback.data.split("_")[2])
+    await state.update_data(setname_target=user_id)
+    await state.set_state(QuizStates.admin_set_name)
+    await callback.message.answer(f"👤 Надішли нове ім'я для {get_display_name(user_id)} (ID: {user_id})")
 
 
 @router.message(Command("setname"))
 async def cmd_admin_setname(message: Message, state: FSMContext):
     """Команда адміна - встановити ім'я"""
-    if message.from_user.id != ADMIN_ID:
+    if message.from_user.id != tenant().admin_id:
         await message.answer("❌ Тільки для адміна!")
         return
     
     await message.answer("👤 Надішли: ID ім'я\n\nПриклад: 12345 Максим")
+    await state.update_data(setname_target=None)
     await state.set_state(QuizStates.admin_set_name)
 
 
@@ -1165,13 +5099,19 @@ async def cmd_admin_setname(message: Message, state: FSMContext):
 async def process_admin_setname(message: Message, state: FSMContext):
     """Обробка встановлення імені"""
     try:
-        parts = message.text.strip().split(maxsplit=1)
-        if len(parts) != 2:
-            await message.answer("❌ Формат: ID ім'я")
-            return
-        
-        user_id = int(parts[0])
-        custom_name = parts[1]
+        target = (await state.get_data()).get("setname_target")
+        if target:
+            # Ціль уже обрана через /find -- чекаємо тільки ім'я
+            user_id = target
+            custom_name = message.text.strip()
+        else:
+            parts = message.text.strip().split(maxsplit=1)
+            if len(parts) != 2:
+                await message.answer("❌ Формат: ID ім'я")
+                return
+            
+            user_id = int(parts[0])
+            custom_name = parts[1]
         
         stats = get_user_stats(user_id)
         if not stats:
@@ -1191,21 +5131,143 @@ async def process_admin_setname(message: Message, state: FSMContext):
         await message.answer("❌ ID має бути числом!")
 
 @router.message(Command("notif"))
-async def notif_menu(message: Message):
-    if message.from_user.id != ADMIN_ID:
+async def notif_menu(message: Message, state: FSMContext):
+    if message.from_user.id != tenant().admin_id:
         await message.answer("❌ Команда тільки для адміна!")
         return
-    text = "🔔 КЕРУВАННЯ СПОВІЩЕННЯМИ АДМІНУ\n\nОбирай від кого отримувати повідомлення:"
-    kb = create_admin_notif_menu()
+    if not repository.uses_catalog:
+        await message.answer(CATALOG_ONLY_TEXT)
+        return
+    # /notif ім'я -- фільтр за ім'ям
+    parts = message.text.strip().split(maxsplit=1)
+    query = parts[1].strip() if len(parts) > 1 else ""
+    await state.update_data(notif_query=query)
+    text = NOTIF_MENU_TEXT
+    if query:
+        text += f"\n\n🔍 Пошук: {query}"
+    kb = create_admin_notif_menu(query=query)
     await message.answer(text, reply_markup=kb.as_markup())
 
 
+@router.message(Command("speed"))
+async def cmd_speed(message: Message):
+    """Адмін-команда: порівняння швидкості відповідей когорт"""
+    if message.from_user.id != tenant().admin_id:
+        await message.answer("❌ Тільки для адміна!")
+        return
+
+    parts = message.text.strip().split()[1:]
+    text = "⏱️ ШВИДКІСТЬ ВІДПОВІДЕЙ (p50 / p90)\n\n"
+
+    if parts:
+        # /speed ID1 ID2 ... -- порівняння конкретних користувачів
+        text += "👥 Користувачі:\n"
+        for part in parts:
+            if not part.lstrip('-').isdigit():
+                text += f"• {part}: некоректний ID\n"
+                continue
+            uid = int(part)
+            text += format_speed_line(f"{get_display_name(uid)} ({uid})", repository.speed_sketch("user", uid)) + "\n"
+        text += "\n"
+
+    text += format_speed_line("🌍 Всі", repository.speed_sketch("global", "all")) + "\n\n🎮 Режими:\n"
+    for mode, sketch in sorted(repository.speed_sketches("mode").items()):
+        text += format_speed_line(mode, sketch) + "\n"
+    text += "\n⭐ Рівні:\n"
+    for level, sketch in sorted(repository.speed_sketches("level").items()):
+        text += format_speed_line(f"Рівень {level}", sketch) + "\n"
+
+    await message.answer(text)
+
+
+@router.message(Command("eventlog"))
+async def cmd_eventlog(message: Message):
+    """Адмін-команда: звіт по журналу подій відповідей"""
+    if message.from_user.id != tenant().admin_id:
+        await message.answer("❌ Тільки для адміна!")
+        return
+
+    try:
+        report = await asyncio.to_thread(build_answer_log_report, answer_event_log.directory)
+    except Exception as e:
+        await message.answer(f"❌ Помилка: {e}")
+        return
+    await message.answer(report)
+
+
+@router.message(Command("queue"))
+async def cmd_queue(message: Message):
+    """Адмін-команда: стан черги вихідних повідомлень"""
+    if message.from_user.id != tenant().admin_id:
+        await message.answer("❌ Тільки для адміна!")
+        return
+
+    await message.answer(f"{outbound.format_stats()}\n\n{outbox.format_stats()}")
+
+
+@router.message(Command("metrics"))
+async def cmd_metrics(message: Message):
+    """Адмін-команда: латентність обробників, запитів і фонових циклів"""
+    if message.from_user.id != tenant().admin_id:
+        await message.answer("❌ Тільки для адміна!")
+        return
+
+    await message.answer(format_metrics_summary())
+
+
+@router.message(Command("health"))
+async def cmd_health(message: Message):
+    """Адмін-команда: затримка event loop, блокування, задачі й черги"""
+    if message.from_user.id != tenant().admin_id:
+        await message.answer("❌ Тільки для адміна!")
+        return
+
+    await message.answer(format_health_report())
+
+
+@router.message(Command("profile"))
+async def cmd_profile(message: Message):
+    """Адмін-команда: семплювальний профіль event loop на N секунд"""
+    if message.from_user.id != tenant().admin_id:
+        await message.answer("❌ Тільки для адміна!")
+        return
+
+    parts = message.text.strip().split()[1:]
+    seconds = PROFILE_DEFAULT_SECONDS
+    if parts:
+        if len(parts) != 1 or not parts[0].isdigit():
+            await message.answer(f"❌ Формат: /profile [секунди, до {PROFILE_MAX_SECONDS}]")
+            return
+        seconds = min(max(int(parts[0]), 1), PROFILE_MAX_SECONDS)
+    if profiler.running:
+        await message.answer("⏳ Профілювання вже триває, дочекайтесь результату")
+        return
+
+    async def send_report(stacks: Counter):
+        if not stacks:
+            await message.answer("🔥 Профіль порожній")
+            return
+        filename = f"profile-{datetime.now():%Y%m%d-%H%M%S}.folded"
+        await message.answer_document(
+            BufferedInputFile(collapse_stacks(stacks).encode(), filename=filename),
+            caption=format_profile_report(stacks, seconds),
+        )
+
+    # Не чекаємо тут: апдейти одного чату обробляються по черзі, і адмін
+    # інакше не міг би нічого робити до кінця збору
+    profiler.start(seconds, send_report)
+    await message.answer(f"🔥 Профілювання запущено на {seconds}с, файл надішлю після завершення")
+
+
 @router.message(Command("panel"))
 async def cmd_admin_panel(message: Message, state: FSMContext):
     """Адмін-панель для розсилок"""
-    if message.from_user.id != ADMIN_ID:
+    if message.from_user.id != tenant().admin_id:
         await message.answer("❌ Тільки для адміна!")
         return
+    if not repository.uses_catalog:
+        await message.answer(CATALOG_ONLY_TEXT)
+        return
     
     await show_admin_panel(message, state)
 
@@ -1213,11 +5275,11 @@ async def cmd_admin_panel(message: Message, state: FSMContext):
 async def show_admin_panel(message: Message, state: FSMContext):
     """Відображення адмін-панелі (внутрішня функція)"""
     await state.clear()
-    # Default filter
-    await state.update_data(broadcast_filter="whitelist")
+    # Default segment
+    await state.update_data(broadcast_segment=DEFAULT_SEGMENT)
     
-    text = "📢 **АДМІН-ПАНЕЛЬ: РОЗСИЛКА**\n\nНалаштування аудиторії та створення повідомлень."
-    builder = create_broadcast_menu("whitelist")
+    text = broadcast_panel_text(DEFAULT_SEGMENT)
+    builder = create_broadcast_menu(DEFAULT_SEGMENT)
     
     # Перевіряємо, чи це нове повідомлення чи редагування
     try:
@@ -1226,18 +5288,28 @@ async def show_admin_panel(message: Message, state: FSMContext):
         await message.answer(text, reply_markup=builder.as_markup(), parse_mode="Markdown")
 
 
-@router.callback_query(F.data.startswith("filter_"))
-async def broadcast_filter_callback(callback: CallbackQuery, state: FSMContext):
-    """Вибір фільтру аудиторії"""
-    filter_type = callback.data.split("_")[1]
-    await state.update_data(broadcast_filter=filter_type)
+@router.callback_query(F.data.startswith("seg_"))
+async def broadcast_segment_callback(callback: CallbackQuery, state: FSMContext):
+    """Перемикання умови сегмента аудиторії"""
+    key = callback.data[len("seg_"):]
+    data = await state.get_data()
+    segment = normalize_segment(data.get("broadcast_segment"))
+    
+    if key == "reset":
+        segment = dict(DEFAULT_SEGMENT)
+    elif key in SEGMENT_OPTIONS:
+        values = [option for option, _ in SEGMENT_OPTIONS[key]]
+        current = values.index(segment[key]) if segment[key] in values else -1
+        segment[key] = values[(current + 1) % len(values)]
     
-    builder = create_broadcast_menu(filter_type)
+    await state.update_data(broadcast_segment=segment)
+    
+    builder = create_broadcast_menu(segment)
     try:
-        await callback.message.edit_reply_markup(reply_markup=builder.as_markup())
+        await callback.message.edit_text(broadcast_panel_text(segment), reply_markup=builder.as_markup(), parse_mode="Markdown")
     except:
         pass
-    await callback.answer(f"Фільтр: {filter_type}")
+    await callback.answer()
 
 
 @router.callback_query(F.data == "create_broadcast")
@@ -1271,7 +5343,7 @@ async def process_broadcast_message(message: Message, state: FSMContext):
     )
     
     data = await state.get_data()
-    filter_type = data.get("broadcast_filter", "whitelist")
+    segment = normalize_segment(data.get("broadcast_segment"))
     
     # Попередній перегляд
     await message.answer("👁️ **ПОПЕРЕДНІЙ ПЕРЕГЛЯД:**", parse_mode="Markdown")
@@ -1281,12 +5353,13 @@ async def process_broadcast_message(message: Message, state: FSMContext):
         await message.answer(f"❌ Помилка попереднього перегляду: {e}")
         return
 
-    count = get_audience_count(filter_type)
+    count = count_segment(segment)
     
     text = f"""
 📢 **ПІДТВЕРДЖЕННЯ РОЗСИЛКИ**
 
-🎯 Аудиторія: `{filter_type}`
+🎯 Аудиторія:
+{describe_segment(segment)}
 👥 Отримувачів: ~{count}
 
 Надіслати всім?
@@ -1307,51 +5380,58 @@ async def confirm_broadcast_callback(callback: CallbackQuery, state: FSMContext)
     data = await state.get_data()
     msg_id = data.get("broadcast_msg_id")
     chat_id = data.get("broadcast_chat_id")
-    filter_type = data.get("broadcast_filter", "whitelist")
+    segment = normalize_segment(data.get("broadcast_segment"))
     
     if not msg_id:
         await callback.answer("❌ Помилка: немає повідомлення")
         return
+    if not repository.uses_catalog:
+        await callback.answer(CATALOG_ONLY_TEXT, show_alert=True)
+        return
     
-    await callback.message.edit_text("⏳ **Розсилка почалася...**", parse_mode="Markdown")
-    
-    # Отримуємо користувачів
-    users = get_audience_users(filter_type)
-    
-    sent = 0
-    blocked = 0
-    errors = 0
-    
-    start_time = time.time()
-    
-    for user_id in users:
-        try:
-            await bot.copy_message(chat_id=user_id, from_chat_id=chat_id, message_id=msg_id)
-            sent += 1
-            await asyncio.sleep(0.05) # Ліміт телеграм
-        except Exception as e:
-            err_str = str(e)
-            if "blocked" in err_str.lower():
-                blocked += 1
-            else:
-                errors += 1
-    
-    duration = time.time() - start_time
+    # Уся аудиторія потрапляє в outbox одним INSERT ... SELECT, без списку ID у Python
+    where, params = compile_segment(segment)
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO outbox_batches (title, report_chat_id, created_at) VALUES ('Розсилка', ?, ?)",
+            (callback.from_user.id, int(time.time()))
+        )
+        batch_id = cursor.lastrowid
+        cursor.execute(f'''
+            INSERT INTO outbox (chat_id, payload, priority, batch_id, next_attempt_at)
+            SELECT user_id, ?, ?, ?, ? FROM users WHERE {where}
+        ''', [json.dumps(copy_payload(chat_id, msg_id)), PRIORITY_BACKGROUND, batch_id, int(time.time()), *params])
+        total = cursor.rowcount
+        cursor.execute("UPDATE outbox_batches SET total = ? WHERE id = ?", (total, batch_id))
+        if not total:
+            cursor.execute("UPDATE outbox_batches SET finished_at = created_at WHERE id = ?", (batch_id,))
+        conn.commit()
+    outbox.wake()
     
-    report = f"""
-✅ **РОЗСИЛКА ЗАВЕРШЕНА**
-
-⏱️ Час: {duration:.1f}с
-📨 Надіслано: {sent}
-🚫 Заблоковано: {blocked}
-❌ Помилок: {errors}
-"""
-    await callback.message.answer(report, parse_mode="Markdown")
+    await callback.message.edit_text(
+        f"⏳ **Розсилку #{batch_id} поставлено в чергу**\n\n"
+        f"👥 Отримувачів: {total}\n"
+        f"Звіт прийде після завершення, прогрес -- /queue",
+        parse_mode="Markdown"
+    )
     await state.clear()
     await show_admin_panel(callback.message, state)
 
 
 
+@router.my_chat_member(ChatMemberUpdatedFilter(member_status_changed=KICKED))
+async def bot_blocked_by_user(event: ChatMemberUpdated):
+    """Користувач заблокував бота -- одразу виключаємо чат"""
+    set_delivery_status(event.chat.id, DELIVERY_BLOCKED)
+
+
+@router.my_chat_member(ChatMemberUpdatedFilter(member_status_changed=MEMBER))
+async def bot_unblocked_by_user(event: ChatMemberUpdated):
+    """Користувач розблокував бота -- чат знову живий"""
+    set_delivery_status(event.chat.id, None)
+
+
 # ═══════════════════════════════════════════════════════════
 # ОБРОБНИКИ CALLBACK
 # ═══════════════════════════════════════════════════════════
@@ -1552,11 +5632,10 @@ async def show_hint(callback: CallbackQuery):
 
 
 @router.callback_query(F.data == "my_stats")
-async def show_stats(callback: CallbackQuery):
+async def show_stats(callback: CallbackQuery, user_profile: dict):
     """Показати статистику"""
     await callback.answer()
-    user_id = callback.from_user.id
-    stats = get_user_stats(user_id)
+    stats = user_profile
     
     if not stats or stats['total_questions'] == 0:
         await callback.message.edit_text("❌ Немає статистики!", reply_markup=create_main_menu().as_markup())
@@ -1584,10 +5663,49 @@ async def show_stats(callback: CallbackQuery):
 {AIAssistant.get_motivational_message(accuracy, stats['current_streak'])}
 """
     builder = InlineKeyboardBuilder()
+    builder.button(text="⏱️ Швидкість відповідей", callback_data="speed_stats")
     builder.button(text="🔙 Головне меню", callback_data="back_main")
+    builder.adjust(1)
     await callback.message.edit_text(stats_text, reply_markup=builder.as_markup())
 
 
+@router.callback_query(F.data == "speed_stats")
+async def show_speed_stats(callback: CallbackQuery):
+    """Швидкість відповідей (p50/p90)"""
+    await callback.answer()
+    user_id = callback.from_user.id
+    own = repository.speed_sketch("user", user_id)
+
+    if own.count == 0:
+        text = "⏱️ ШВИДКІСТЬ ВІДПОВІДЕЙ\n\nПоки немає даних."
+    else:
+        overall = repository.speed_sketch("global", "all")
+        p50 = own.quantile(0.5)
+        p90 = own.quantile(0.9)
+        text = f"""
+⏱️ ШВИДКІСТЬ ВІДПОВІДЕЙ
+
+👤 Твій час:
+• Медіана (p50): {p50:.1f}с
+• 90% відповідей (p90): до {p90:.1f}с
+• Відповідей враховано: {own.count}
+
+🌍 Усі відповіді всіх гравців:
+• p50: {overall.quantile(0.5):.1f}с
+• p90: {overall.quantile(0.9):.1f}с
+"""
+        if p50 <= overall.quantile(0.5):
+            text += "\n⚡ Твоя медіана краща за медіану всіх відповідей!"
+        else:
+            text += "\n💪 Тренуйся в режимі Блискавка, щоб стати швидшим!"
+
+    builder = InlineKeyboardBuilder()
+    builder.button(text="🔙 Статистика", callback_data="my_stats")
+    builder.button(text="🏠 Головне меню", callback_data="back_main")
+    builder.adjust(1)
+    await callback.message.edit_text(text, reply_markup=builder.as_markup())
+
+
 @router.callback_query(F.data == "ai_analysis")
 async def ai_analysis(callback: CallbackQuery):
     """AI-аналіз"""
@@ -1601,33 +5719,98 @@ async def ai_analysis(callback: CallbackQuery):
     await callback.message.edit_text(analysis, reply_markup=builder.as_markup())
 
 
+def activity_emoji(count: int) -> str:
+    """Колір клітинки календаря"""
+    return "⬜" if count == 0 else "🟩" if count < 10 else "🟨" if count < 20 else "🟥"
+
+
+def format_activity_summary(bitmap: ActivityBitmap, today) -> str:
+    """Серії та активні дні місяця"""
+    today_day = today.toordinal()
+    month_start = today.replace(day=1).toordinal()
+    return (
+        f"🔥 Поточна серія: {bitmap.current_streak(today_day)} дн.\n"
+        f"🏆 Найдовша серія: {bitmap.longest_streak()} дн.\n"
+        f"📆 Активних днів цього місяця: {bitmap.active_days(month_start, today_day)}"
+    )
+
+
 @router.callback_query(F.data == "activity_calendar")
 async def activity_calendar(callback: CallbackQuery):
     """Календар активності"""
     await callback.answer()
     user_id = callback.from_user.id
-    calendar_data = get_activity_calendar(user_id, 30)
+    bitmap = get_activity_calendar(user_id)
+    today = datetime.now().date()
+    start_day = today.toordinal() - 29
     
-    if not calendar_data:
+    if bitmap is None or bitmap.active_days(start_day, today.toordinal()) == 0:
         text = "📅 КАЛЕНДАР АКТИВНОСТІ\n\nПоки немає даних."
+        if bitmap is not None:
+            text += f"\n\n{format_activity_summary(bitmap, today)}"
     else:
         text = "📅 КАЛЕНДАР (30 днів)\n\n"
-        today = datetime.now().date()
         for i in range(29, -1, -1):
             date = today - timedelta(days=i)
-            count = calendar_data.get(str(date), 0)
-            emoji = "⬜" if count == 0 else "🟩" if count < 10 else "🟨" if count < 20 else "🟥"
+            emoji = activity_emoji(bitmap.count(date.toordinal()))
             if i % 7 == 6:
                 text += f"\n{date.strftime('%d.%m')} {emoji}"
             else:
                 text += f" {emoji}"
         
-        total_days = len(calendar_data)
-        total_questions = sum(calendar_data.values())
-        text += f"\n\n📊 Підсумки:\n• Активних днів: {total_days}\n• Питань: {total_questions}\n\n⬜ 0 | 🟩 1-9 | 🟨 10-19 | 🟥 20+"
+        total_days = bitmap.active_days(start_day, today.toordinal())
+        total_questions = bitmap.questions(start_day, today.toordinal())
+        text += f"\n\n📊 Підсумки:\n• Активних днів: {total_days}\n• Питань: {total_questions}\n\n"
+        text += f"{format_activity_summary(bitmap, today)}\n\n⬜ 0 | 🟩 1-9 | 🟨 10-19 | 🟥 20+"
     
     builder = InlineKeyboardBuilder()
+    builder.button(text="🗓 За рік", callback_data="activity_year")
+    builder.button(text="🔙 Головне меню", callback_data="back_main")
+    builder.adjust(1)
+    await callback.message.edit_text(text, reply_markup=builder.as_markup())
+
+
+@router.callback_query(F.data == "activity_year")
+async def activity_year(callback: CallbackQuery):
+    """Теплова карта активності за 12 місяців"""
+    await callback.answer()
+    bitmap = get_activity_calendar(callback.from_user.id)
+    today = datetime.now().date()
+
+    if bitmap is None:
+        text = "🗓 АКТИВНІСТЬ ЗА РІК\n\nПоки немає даних."
+    else:
+        text = "🗓 АКТИВНІСТЬ ЗА РІК\n"
+        year, month = today.year, today.month
+        months = []
+        for _ in range(12):
+            months.append((year, month))
+            year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+
+        for year, month in reversed(months):
+            first = datetime(year, month, 1).date()
+            next_first = datetime(year + month // 12, month % 12 + 1, 1).date()
+            last_day = min(next_first.toordinal() - 1, today.toordinal())
+            cells = "".join(
+                activity_emoji(bitmap.count(day))
+                for day in range(first.toordinal(), last_day + 1)
+            )
+            active = bitmap.active_days(first.toordinal(), last_day)
+            text += f"\n{first.strftime('%m.%y')} {cells} {active}"
+
+        year_start = months[-1]
+        year_start_day = datetime(year_start[0], year_start[1], 1).date().toordinal()
+        text += (
+            f"\n\n📊 За 12 місяців:\n"
+            f"• Активних днів: {bitmap.active_days(year_start_day, today.toordinal())}\n"
+            f"• Питань: {bitmap.questions(year_start_day, today.toordinal())}\n\n"
+            f"{format_activity_summary(bitmap, today)}\n\n⬜ 0 | 🟩 1-9 | 🟨 10-19 | 🟥 20+"
+        )
+
+    builder = InlineKeyboardBuilder()
+    builder.button(text="📅 30 днів", callback_data="activity_calendar")
     builder.button(text="🔙 Головне меню", callback_data="back_main")
+    builder.adjust(1)
     await callback.message.edit_text(text, reply_markup=builder.as_markup())
 
 
@@ -1636,14 +5819,7 @@ async def leaderboard(callback: CallbackQuery):
     """Рейтинг"""
     await callback.answer()
     
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT first_name, custom_name, correct_answers, total_questions, best_streak
-            FROM users WHERE total_questions > 0
-            ORDER BY correct_answers DESC, best_streak DESC LIMIT 10
-        ''')
-        top_users = cursor.fetchall()
+    top_users = repository.leaderboard(10)
     
     if not top_users:
         text = "🏆 РЕЙТИНГ\n\nПоки порожній."
@@ -1686,11 +5862,11 @@ async def info(callback: CallbackQuery):
 
 
 @router.callback_query(F.data == "back_main")
-async def back_main(callback: CallbackQuery, state: FSMContext):
+async def back_main(callback: CallbackQuery, state: FSMContext, user_profile: dict):
     """Назад до головного меню"""
     await callback.answer()
     await state.clear()
-    display_name = get_display_name(callback.from_user.id)
+    display_name = user_profile.get('custom_name') or user_profile.get('first_name') or 'User'
     text = f"🎓 Привіт, {display_name}!\n\nОбирай режим:"
     builder = create_main_menu()
     await callback.message.edit_text(text, reply_markup=builder.as_markup())
@@ -1710,10 +5886,7 @@ async def back_mode(callback: CallbackQuery, state: FSMContext):
 async def disable_reminders(callback: CallbackQuery):
     """Вимкнути нагадування"""
     user_id = callback.from_user.id
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET reminder_enabled = 0 WHERE user_id = ?', (user_id,))
-        conn.commit()
+    repository.set_reminders(user_id, False)
     await callback.answer("🔕 Нагадування вимкнено!")
     await callback.message.edit_text("🔕 Нагадування вимкнено.", reply_markup=create_main_menu().as_markup())
 
@@ -1725,23 +5898,17 @@ async def snooze_reminder_callback(callback: CallbackQuery):
     user_id = callback.from_user.id
     display_name = get_display_name(user_id)
     
-    # Через годину надсилаємо повторне нагадування
-    async def send_snooze_reminder():
-        await asyncio.sleep(3600)  # 1 година
-        
-        try:
-            text = f"⏰ {display_name}, минула година!\n\n📚 Готовий до тренування?"
-            builder = InlineKeyboardBuilder()
-            builder.button(text="🚀 Почати!", callback_data="start_quiz")
-            builder.button(text="🔕 Вимкнути нагадування", callback_data="disable_reminders")
-            builder.adjust(1)
-            
-            await bot.send_message(user_id, text, reply_markup=builder.as_markup())
-        except Exception as e:
-            logger.error(f"Помилка відкладеного нагадування: {e}")
+    # Через годину надсилаємо повторне нагадування (outbox переживає перезапуск)
+    text = f"⏰ {display_name}, минула година!\n\n📚 Готовий до тренування?"
+    builder = InlineKeyboardBuilder()
+    builder.button(text="🚀 Почати!", callback_data="start_quiz")
+    builder.button(text="🔕 Вимкнути нагадування", callback_data="disable_reminders")
+    builder.adjust(1)
     
-    # Запускаємо асинхронну задачу
-    asyncio.create_task(send_snooze_reminder())
+    with get_db() as conn:
+        outbox_enqueue(conn.cursor(), [(user_id, text_payload(text, reply_markup=builder.as_markup()))], delay=3600)
+        conn.commit()
+    outbox.wake()
     
     # Видаляємо попереднє повідомлення
     try:
@@ -1750,39 +5917,58 @@ async def snooze_reminder_callback(callback: CallbackQuery):
         pass
 
 @router.callback_query(F.data.startswith("toggle_notif_"))
-async def toggle_notif_cb(callback: CallbackQuery):
-    if callback.from_user.id != ADMIN_ID:
+async def toggle_notif_cb(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id != tenant().admin_id:
         await callback.answer("❌ Тільки для адміна!", show_alert=True)
         return
-    uid = int(callback.data.split("_")[-1])
+    parts = callback.data.split("_")
+    uid = int(parts[2])
+    after = int(parts[3]) if len(parts) > 3 else 0
     current = is_admin_notif_enabled(uid)
     set_admin_notif_enabled(uid, not current)
     await callback.answer("Оновлено!")
-    # Миттєво оновлюємо меню:
-    text = "🔔 КЕРУВАННЯ СПОВІЩЕННЯМИ АДМІНУ\n\nОбирай від кого отримувати повідомлення:"
-    kb = create_admin_notif_menu()
-    await callback.message.edit_text(text, reply_markup=kb.as_markup())
+    # Перемальовуємо лише поточну сторінку (користувачі беруться з кешу)
+    query = (await state.get_data()).get("notif_query", "")
+    kb = create_admin_notif_menu(after, query)
+    try:
+        await callback.message.edit_reply_markup(reply_markup=kb.as_markup())
+    except:
+        pass
+
+@router.callback_query(F.data.startswith("notif_next_") | F.data.startswith("notif_prev_"))
+async def notif_page_cb(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id != tenant().admin_id:
+        await callback.answer("❌ Тільки для адміна!", show_alert=True)
+        return
+    await callback.answer()
+    parts = callback.data.split("_")
+    query = (await state.get_data()).get("notif_query", "")
+    kb = create_admin_notif_menu(int(parts[2]), query, backwards=parts[1] == "prev")
+    try:
+        await callback.message.edit_reply_markup(reply_markup=kb.as_markup())
+    except:
+        pass
 
 @router.callback_query(F.data == "notif_all_enable")
-async def notif_all_enable_cb(callback: CallbackQuery):
-    if callback.from_user.id != ADMIN_ID:
+async def notif_all_enable_cb(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id != tenant().admin_id:
         await callback.answer("❌ Тільки для адміна!", show_alert=True)
         return
     set_admin_notif_all(True)
     await callback.answer("Увімкнено від всіх!")
     text = "🔔 ВІД ВСІХ користувачів — отримуватимете сповіщення."
-    kb = create_admin_notif_menu()
+    kb = create_admin_notif_menu(query=(await state.get_data()).get("notif_query", ""))
     await callback.message.edit_text(text, reply_markup=kb.as_markup())
 
 @router.callback_query(F.data == "notif_all_disable")
-async def notif_all_disable_cb(callback: CallbackQuery):
-    if callback.from_user.id != ADMIN_ID:
+async def notif_all_disable_cb(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id != tenant().admin_id:
         await callback.answer("❌ Тільки для адміна!", show_alert=True)
         return
     set_admin_notif_all(False)
     await callback.answer("Вимкнено від всіх!")
     text = "🔕 ВІД ВСІХ користувачів — не отримуватимете сповіщення."
-    kb = create_admin_notif_menu()
+    kb = create_admin_notif_menu(query=(await state.get_data()).get("notif_query", ""))
     await callback.message.edit_text(text, reply_markup=kb.as_markup())
 
 
@@ -1900,15 +6086,10 @@ async def question_timer(message: Message, state: FSMContext, time_limit: int, t
         else:
             question = f"{num1} × {num2}"
         
-        save_answer_history(user_id, question, "standard", 0, correct, False, time_limit, data.get('level', 1), mode)
+        save_answer_history(user_id, num1, num2, data.get('question_type', 'standard'), 0, correct, False, time_limit, data.get('level', 1), mode, timed_out=True,
+                            equation=data.get('question_text') if mode == "find_x" else None)
         
-        display_name = get_display_name(user_id)
-        log_msg = f"⏰ Таймаут!\n👤 {display_name}\n❓ {question}\n✅ {correct}"
-        try:
-            if is_admin_notif_enabled(user_id):
-              await bot.send_message(ADMIN_ID, log_msg)
-        except:
-            pass
+        admin_digest.record(user_id, get_display_name(user_id), "timeout", f"{question} → ✅ {correct}")
         
         if mode == "find_x":
              timeout_text = f"⏰ ЧАС ВИЧЕРПАНО!\n\n❌ {data.get('question_text')}\n✅ Правильна відповідь: x = {correct}\n\n⏳ Наступне питання..."
@@ -1942,7 +6123,7 @@ async def question_timer(message: Message, state: FSMContext, time_limit: int, t
 
 
 @router.message(StateFilter(QuizStates.waiting_answer))
-async def process_answer(message: Message, state: FSMContext):
+async def process_answer(message: Message, state: FSMContext, user_profile: dict):
     """Обробка відповіді"""
     user_id = message.from_user.id
     await state.update_data(consecutive_timeouts=0)  # Скидаємо лічильник таймаутів
@@ -1995,17 +6176,13 @@ async def process_answer(message: Message, state: FSMContext):
              question_log = f"{num1} × {num2}"
              response_text_q = f"{num1} × {num2} = {correct}"
 
-        save_answer_history(user_id, question_log, "standard", user_answer, correct, True, elapsed_time, data.get('level', 1), mode)
+        save_answer_history(user_id, num1, num2, data.get('question_type', 'standard'), user_answer, correct, True, elapsed_time, data.get('level', 1), mode,
+                            equation=data.get('question_text') if mode == "find_x" else None)
         
-        stats = get_user_stats(user_id)
+        stats = apply_result(user_profile, is_correct=True)
         display_name = stats.get('custom_name') or stats.get('first_name')
         
-        log_msg = f"✅ Правильно!\n👤 {display_name}\n❓ {question_log}\n✅ {correct}\n⏱️ {elapsed_time:.1f}с"
-        try:
-          if is_admin_notif_enabled(user_id):
-            await bot.send_message(ADMIN_ID, log_msg)
-        except:
-            pass
+        admin_digest.record(user_id, display_name, "correct", response_time=elapsed_time)
         
         mode_bonus = {'lightning': ' ⚡', 'sniper': ' 🎯', 'training': ' 🎓', 'find_x': ' 🔍'}.get(mode, '')
         
@@ -2054,17 +6231,12 @@ async def process_answer(message: Message, state: FSMContext):
                 question_log = f"{num1} × {num2}"
                 track_weak_spot(user_id, num1, num2)
 
-            save_answer_history(user_id, question_log, "standard", user_answer, correct, False, elapsed_time, data.get('level', 1), mode)
+            save_answer_history(user_id, num1, num2, data.get('question_type', 'standard'), user_answer, correct, False, elapsed_time, data.get('level', 1), mode,
+                                equation=data.get('question_text') if mode == "find_x" else None)
             
-            stats = get_user_stats(user_id)
-            display_name = stats.get('custom_name') or stats.get('first_name')
+            display_name = user_profile.get('custom_name') or user_profile.get('first_name')
             
-            log_msg = f"❌ Помилка\n👤 {display_name}\n❓ {question_log}\n💬 {user_answer}\n✅ {correct}"
-            try:
-                if is_admin_notif_enabled(user_id):
-                    await bot.send_message(ADMIN_ID, log_msg)
-            except:
-                pass
+            admin_digest.record(user_id, display_name, "wrong", f"{question_log} → {user_answer} (✅ {correct})", elapsed_time)
             
             if mode == "find_x":
                 explanation = data.get('explanation', '')
@@ -2115,34 +6287,455 @@ async def finish_quiz(callback: CallbackQuery, state: FSMContext):
 # ЗАПУСК БОТА
 # ═══════════════════════════════════════════════════════════
 
-async def main():
-    """Головна функція"""
+class DrainingRequestHandler(SimpleRequestHandler):
+    """Webhook-обробник, що при зупинці дочікується оновлень, які вже в обробці"""
+
+    async def close(self) -> None:
+        pending = set(self._background_feed_update_tasks)
+        if pending:
+            logger.info(f"⏳ Дочікуємо {len(pending)} оновлень перед зупинкою...")
+            done, pending = await asyncio.wait(pending, timeout=WEBHOOK_DRAIN_TIMEOUT)
+            if pending:
+                logger.warning(f"Не дочекались {len(pending)} оновлень за {WEBHOOK_DRAIN_TIMEOUT}с")
+        await super().close()
+
+
+def tenant_webhook_path(t: Tenant) -> str:
+    """Один бот -- WEBHOOK_PATH, кілька -- WEBHOOK_PATH/<назва тенанта>"""
+    return WEBHOOK_PATH if len(tenants) == 1 else f"{WEBHOOK_PATH.rstrip('/')}/{t.name}"
+
+
+async def run_webhook():
+    """Приймати оновлення через webhook (aiohttp) до SIGINT/SIGTERM
+
+    Сервер слухає WEBHOOK_HOST:WEBHOOK_PORT за reverse proxy, Telegram
+    надсилає оновлення на WEBHOOK_URL + шлях бота з секретним заголовком.
+    Без WEBHOOK_SECRET секрет генерується на кожен запуск: set_webhook
+    однаково викликається при старті, а запити без заголовка відхиляються.
+    """
+    secret = WEBHOOK_SECRET
+    if not secret:
+        secret = secrets.token_urlsafe(32)
+        logger.warning("WEBHOOK_SECRET порожній -- згенеровано випадковий секрет на цей запуск")
+    app = web.Application()
+    for t in tenants:
+        handler = DrainingRequestHandler(
+            dispatcher=dp, bot=t.bot,
+            secret_token=secret,
+            handle_in_background=True
+        )
+        handler.register(app, path=tenant_webhook_path(t))
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+
+    for t in tenants:
+        path = tenant_webhook_path(t)
+        await t.bot.set_webhook(
+            f"{WEBHOOK_URL.rstrip('/')}{path}",
+            secret_token=secret,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logger.info(f"🌐 Webhook {t.name}: {WEBHOOK_HOST}:{WEBHOOK_PORT}{path}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+    try:
+        await stop.wait()
+    finally:
+        # Спершу перестаємо приймати з'єднання, потім дочікуємо обробку (DrainingRequestHandler.close).
+        # Webhook у Telegram лишається: нові оновлення чекатимуть там до наступного запуску.
+        logger.info("⛔ Зупиняємо webhook-сервер...")
+        await runner.cleanup()
+
+
+# ═══════════════════════════════════════════════════════════
+# ВОРКЕРИ
+# ═══════════════════════════════════════════════════════════
+
+class WorkerContext:
+    """Місце поточного процесу в пулі воркерів
+
+    В одному процесі (WORKERS <= 1) це воркер 0 з 1, без каналу до фронта.
+    Воркер 0 -- головний: лише він крутить фонові цикли (outbox, нагадування,
+    підписки, згортання історії). Зміни in-memory кешів (вайтліст, налаштування
+    сповіщень) воркер публікує фронту, а той розсилає їх решті воркерів.
+    """
+
+    def __init__(self):
+        self.index = 0
+        self.count = 1
+        self.conn = None
+        self._tails: Dict[tuple, asyncio.Task] = {}
+
+    @property
+    def is_primary(self) -> bool:
+        return self.index == 0
+
+    def attach(self, index: int, count: int, conn):
+        """Налаштувати процесні синглтони під воркер index з count"""
+        self.index, self.count, self.conn = index, count, conn
+        # Кожен воркер пише свої рядки скетчів і свої сегменти журналу
+        for t in tenants:
+            t.response_sketches.part = index
+            t.answer_event_log.prefix = f"worker{index}"
+        # Ліміт Telegram на бота ділиться між процесами
+        outbound.rate = OUTBOUND_GLOBAL_RATE / count
+        outbound.reserve = OUTBOUND_RESERVE / count
+
+    def publish(self, name: str):
+        """Повідомити інші воркери, що кеш name поточного тенанта застарів"""
+        if self.conn is not None:
+            self.conn.send_bytes(b"C" + f"{tenant().name}:{name}".encode())
+
+    def forward_digest(self, events: Dict[int, dict]):
+        """Переслати події зведення поточного тенанта головному воркеру"""
+        self.conn.send_bytes(b"D" + json.dumps({"tenant": tenant().name, "events": events}).encode())
+
+    def _apply_control(self, message: str):
+        tenant_name, name = message.split(":", 1)
+        with tenant_scope(tenants_by_name[tenant_name]):
+            if name == "access":
+                access_control.load()
+                access_control._notify_changed()
+            elif name == "admin_notif":
+                admin_notif_prefs.load()
+            elif name == "outbox":
+                outbox.wake(broadcast=False)
+
+    def _on_message(self, data: bytes):
+        if data[:1] == b"C":
+            self._apply_control(data[1:].decode())
+            return
+        if data[:1] == b"D":
+            message = json.loads(data[1:])
+            with tenant_scope(tenants_by_name[message["tenant"]]):
+                admin_digest.merge({int(uid): entry for uid, entry in message["events"].items()})
+            return
+        # Оновлення одного користувача обробляються строго по черзі
+        bot_id, user_key = struct.unpack_from("<qq", data, 1)
+        target = tenants_by_bot_id[bot_id].bot
+        update = Update.model_validate_json(data[17:], context={"bot": target})
+        key = (bot_id, user_key)
+        task = asyncio.create_task(self._feed(self._tails.get(key), target, update))
+        self._tails[key] = task
+        task.add_done_callback(lambda t: self._tails.pop(key) if self._tails.get(key) is t else None)
+
+    async def _feed(self, previous: Optional[asyncio.Task], target: Bot, update: Update):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await dp.feed_update(target, update)
+        except Exception as e:
+            logger.error(f"Воркер {self.index}: помилка обробки оновлення {update.update_id}: {e}")
+
+    async def serve(self):
+        """Обробляти оновлення від фронта, доки канал не закриється"""
+        loop = asyncio.get_running_loop()
+        closed = asyncio.Event()
+
+        def reader():
+            try:
+                while True:
+                    loop.call_soon_threadsafe(self._on_message, self.conn.recv_bytes())
+            except (EOFError, OSError):
+                loop.call_soon_threadsafe(closed.set)
+
+        threading.Thread(target=reader, name=f"worker{self.index}-reader", daemon=True).start()
+        await closed.wait()
+        if self._tails:
+            await asyncio.wait(list(self._tails.values()), timeout=WEBHOOK_DRAIN_TIMEOUT)
+
+
+worker = WorkerContext()
+
+
+WORKER_BACKLOG = 10000  # оновлень у черзі до одного воркера, понад -- відкидаємо
+
+
+class WorkerPool:
+    """Фронт-процес: роздає оновлення воркерам за user_id (один користувач -- один воркер)
+
+    У канал воркера пише окремий потік з черги: повний pipe повільного
+    воркера блокує лише цей потік, а не прийом оновлень для всіх інших.
+    Якщо черга воркера переросла WORKER_BACKLOG, нові оновлення для нього
+    відкидаються з помилкою в лозі -- воркер явно завис, а пам'ять фронта не
+    безрозмірна. Службові повідомлення (кеші, зведення) не відкидаються.
+    """
+
+    def __init__(self, count: int):
+        self.count = count
+        self.context = multiprocessing.get_context("spawn")
+        self.processes = [None] * count
+        self.conns = [None] * count
+        self.queues = [None] * count
+        self.writers = [None] * count
+        self.dropped = [0] * count
+        self._loop = None
+        self._stopping = False
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        for index in range(self.count):
+            self._spawn(index)
+
+    def _spawn(self, index: int):
+        front_conn, worker_conn = self.context.Pipe()
+        process = self.context.Process(
+            target=run_worker_process, args=(index, self.count, worker_conn),
+            name=f"quiz-worker-{index}", daemon=True
+        )
+        process.start()
+        worker_conn.close()
+        self.processes[index], self.conns[index] = process, front_conn
+        self.queues[index] = queue.SimpleQueue()
+        self.writers[index] = threading.Thread(target=self._write, args=(front_conn, self.queues[index]),
+                                               name=f"front-writer-{index}", daemon=True)
+        self.writers[index].start()
+        threading.Thread(target=self._read_control, args=(index, front_conn),
+                         name=f"front-reader-{index}", daemon=True).start()
+        logger.info(f"👷 Воркер {index} запущено (pid {process.pid})")
+
+    @staticmethod
+    def _write(conn, pending: queue.SimpleQueue):
+        """Потік запису в канал воркера; None у черзі -- зупинка"""
+        while True:
+            data = pending.get()
+            if data is None:
+                return
+            try:
+                conn.send_bytes(data)
+            except OSError:
+                return  # воркер помер -- його перезапустить _on_worker_exit
+
+    def _read_control(self, index: int, conn):
+        try:
+            while True:
+                data = conn.recv_bytes()
+                self._loop.call_soon_threadsafe(self._on_control, index, data)
+        except (EOFError, OSError, TypeError):
+            # TypeError -- stop() закрив канал, поки recv_bytes чекав на дані
+            if not self._stopping:
+                self._loop.call_soon_threadsafe(self._on_worker_exit, index, conn)
+
+    def _on_control(self, sender: int, data: bytes):
+        # Події зведення -- лише головному воркеру, інвалідації кешів -- усім іншим
+        if data[:1] == b"D":
+            self._send(0, data)
+        else:
+            self._broadcast(sender, data)
+
+    def _send(self, index: int, data: bytes):
+        if self.queues[index] is not None:
+            self.queues[index].put(data)
+
+    def _broadcast(self, sender: int, data: bytes):
+        for index in range(self.count):
+            if index != sender:
+                self._send(index, data)
+
+    def _on_worker_exit(self, index: int, conn):
+        if self._stopping or self.conns[index] is not conn:
+            return
+        logger.error(f"Воркер {index} завершився, перезапускаємо")
+        self._spawn(index)
+
+    def route(self, bot_id: int, key: int, update: Update):
+        index = key % self.count
+        if self.queues[index].qsize() >= WORKER_BACKLOG:
+            self.dropped[index] += 1
+            if self.dropped[index] % 1000 == 1:
+                logger.error(f"Воркер {index} не встигає: черга {WORKER_BACKLOG}, "
+                             f"відкинуто оновлень {self.dropped[index]}")
+            return
+        data = b"U" + struct.pack("<qq", bot_id, key) + update.model_dump_json(exclude_unset=True).encode()
+        self.queues[index].put(data)
+
+    def stop(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        """Дописати черги, закрити канали (воркери дообробляють своє) і дочекатися процесів"""
+        self._stopping = True
+        deadline = time.monotonic() + timeout
+        for pending in self.queues:
+            pending.put(None)
+        for writer in self.writers:
+            writer.join(max(0.1, deadline - time.monotonic()))
+        for conn in self.conns:
+            conn.close()
+        for process in self.processes:
+            process.join(max(0.1, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+
+
+class UpdateRouterMiddleware(BaseMiddleware):
+    """Outer middleware фронта: замість обробки віддає оновлення воркеру"""
+
+    def __init__(self, pool: WorkerPool):
+        self.pool = pool
+
+    async def __call__(self, handler, event: Update, data: dict):
+        user = data.get("event_from_user")
+        chat = data.get("event_chat")
+        self.pool.route(data["bot"].id, user.id if user else chat.id if chat else 0, event)
+        return None
+
+
+def run_worker_process(index: int, count: int, conn):
+    """Точка входу процесу-воркера"""
+    # Ctrl+C отримує вся група процесів; зупинкою воркерів керує фронт
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_logging(worker_log_file(index))
+    asyncio.run(run_worker(index, count, conn))
+
+
+async def run_worker(index: int, count: int, conn):
+    worker.attach(index, count, conn)
+    watchdog.start()
+    setup_dispatcher()
+    for t in tenants:
+        with tenant_scope(t):
+            access_control.load()
+            admin_notif_prefs.load()
+            if worker.is_primary:
+                start_background_tasks()
+            else:
+                # Пересилає події зведення головному воркеру
+                asyncio.create_task(admin_digest.run())
+                # Свої сегменти журналу кожен воркер запечатує сам
+                asyncio.create_task(answer_event_log.run())
+    await start_metrics_server(METRICS_PORT + 1 + index if METRICS_PORT else 0)
+    try:
+        await worker.serve()
+    finally:
+        for t in tenants:
+            t.answer_event_log.rotate()
+            await t.bot.session.close()
 
-    migrate_database()  # Спочатку ініціалізуємо БД (де має бути виклик migrate_database)
-    load_whitelist_from_db()  # Потім завантажуємо вайтліст уже після міграції
 
+# ═══════════════════════════════════════════════════════════
+# ЗАПУСК
+# ═══════════════════════════════════════════════════════════
+
+def setup_dispatcher():
+    dp.update.outer_middleware(TenantMiddleware())
+    user_context = UserContextMiddleware()
+    dp.message.outer_middleware(user_context)
+    dp.callback_query.outer_middleware(user_context)
+    handler_metrics = HandlerMetricsMiddleware()
+    for observer in (router.message, router.callback_query, router.my_chat_member):
+        observer.middleware(handler_metrics)
     dp.include_router(router)
-    logger.info("🚀 Бот запущено!")
 
+
+def start_background_tasks():
+    """Фонові цикли поточного тенанта (задачі успадковують його контекст)"""
+    # Відправник outbox (нагадування, розсилки, сповіщення про доступ)
+    asyncio.create_task(outbox.run())
+
+    # Запускаємо нагадування
+    asyncio.create_task(send_daily_reminders())
+
+    # Зведення активності для адміна
+    asyncio.create_task(admin_digest.run())
+
+    # Добова ротація журналу подій
+    asyncio.create_task(answer_event_log.run())
+
+    # Автоматичне закінчення підписок
+    asyncio.create_task(access_control.run_expiry_scheduler())
+
+    # Переносимо стару історію відповідей у компактну схему
+    asyncio.create_task(backfill_answer_history())
+
+    # Згортаємо старі відповіді в агрегати
+    asyncio.create_task(answer_retention_loop())
+
+    # Лічильники з шардів -> каталог (рейтинг, сегменти)
+    if tenant().db_shards:
+        asyncio.create_task(catalog_sync_loop())
+
+
+async def notify_admin_startup():
+    """Повідомити адміна кожного бота про запуск"""
+    for t in tenants:
+        with tenant_scope(t):
+            await notify_tenant_admin_startup()
+
+
+async def notify_tenant_admin_startup():
     try:
-        await bot.send_message(
-            ADMIN_ID, 
-            f"🤖 Бот запущено!\n"
-            f"⏰ {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-            f"💾 БД: {DB_NAME}\n"
-            f"🔔 Нагадування: {', '.join(map(str, REMINDER_HOURS))} год\n\n"  # ← ВИПРАВЛЕНО
-            f"✅ AI активний\n"
-            f"✅ Календар\n"
-            f"✅ Аналіз слабких місць\n"
-            f"✅ Спецрежими"
-        )
+        with outbound_scope(PRIORITY_ADMIN):
+            await bot.send_message(
+                tenant().admin_id, 
+                f"🤖 Бот запущено!\n"
+                f"⏰ {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+                f"💾 БД: {tenant().db_name}"
+                f"{f' + {tenant().db_shards} шардів' if tenant().db_shards else ''}\n"
+                f"🔔 Нагадування: {', '.join(map(str, REMINDER_HOURS))} год\n"
+                f"👷 Воркерів: {max(WORKERS, 1)}\n\n"
+                f"✅ AI активний\n"
+                f"✅ Календар\n"
+                f"✅ Аналіз слабких місць\n"
+                f"✅ Спецрежими"
+            )
     except Exception as e:
         logger.error(f"Помилка: {e}")
 
-    # Запускаємо нагадування
-    asyncio.create_task(send_daily_reminders())
 
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+async def receive_updates():
+    if WEBHOOK_URL:
+        await run_webhook()
+    else:
+        # Long polling -- для розробки та запуску без публічної адреси
+        for t in tenants:
+            await t.bot.delete_webhook()
+        await dp.start_polling(*(t.bot for t in tenants), allowed_updates=dp.resolve_used_update_types())
+
+
+async def main():
+    """Головна функція"""
+    watchdog.start()
+
+    # Спочатку ініціалізуємо БД кожного бота
+    for t in tenants:
+        with tenant_scope(t):
+            migrate_database()
+
+    if WORKERS > 1:
+        # Фронт лише приймає оновлення; обробники працюють у воркерах
+        pool = WorkerPool(WORKERS)
+        pool.start()
+        dp.update.outer_middleware(UpdateRouterMiddleware(pool))
+        dp.include_router(router)  # щоб resolve_used_update_types бачив типи оновлень
+        logger.info(f"🚀 Бот запущено ({WORKERS} воркерів)!")
+        await start_metrics_server(METRICS_PORT)
+        await notify_admin_startup()
+        try:
+            await receive_updates()
+        finally:
+            pool.stop()
+        return
+
+    setup_dispatcher()
+    for t in tenants:
+        with tenant_scope(t):
+            access_control.load()  # Потім завантажуємо вайтліст уже після міграції
+            admin_notif_prefs.load()
+    logger.info(f"🚀 Бот запущено ({len(tenants)} ботів)!" if len(tenants) > 1 else "🚀 Бот запущено!")
+
+    await start_metrics_server(METRICS_PORT)
+    await notify_admin_startup()
+    for t in tenants:
+        with tenant_scope(t):
+            start_background_tasks()
+    await receive_updates()
 
 
 
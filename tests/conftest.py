@@ -0,0 +1,81 @@
+import os
+import sqlite3
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Таблиці, які створював перший реліз бота; migrate_database лише доповнює їх
+BASE_SCHEMA = '''
+CREATE TABLE users (
+    user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT,
+    total_questions INTEGER DEFAULT 0, correct_answers INTEGER DEFAULT 0,
+    wrong_answers INTEGER DEFAULT 0, current_streak INTEGER DEFAULT 0,
+    best_streak INTEGER DEFAULT 0, start_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE answer_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, question TEXT,
+    user_answer INTEGER, correct_answer INTEGER, is_correct BOOLEAN,
+    response_time REAL, level INTEGER, timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE activity_calendar (
+    user_id INTEGER, activity_date DATE, questions_count INTEGER DEFAULT 0,
+    PRIMARY KEY (user_id, activity_date)
+);
+CREATE TABLE weak_spots (
+    user_id INTEGER, number1 INTEGER, number2 INTEGER, error_count INTEGER DEFAULT 0,
+    last_error TIMESTAMP, PRIMARY KEY (user_id, number1, number2)
+);
+'''
+
+
+@pytest.fixture(scope="session")
+def main(tmp_path_factory):
+    """Модуль бота з тестовим config у тимчасовому каталозі"""
+    workdir = tmp_path_factory.mktemp("bot")
+    config = types.ModuleType("config")
+    config.__dict__.update(
+        BOT_TOKEN="123456:ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghi",
+        ADMIN_ID=1,
+        WHITELIST=[],
+        PAYMENT_CONTACT="@admin",
+        MONTHLY_PRICE=800,
+        FULL_CODE_PRICE=150,
+        DB_NAME=str(workdir / "quiz_bot.db"),
+        ANSWER_TIME_LIMITS={1: 15, 2: 20, 3: 30, 'lightning': 5},
+        REMINDER_HOURS=[],
+        REMINDER_MESSAGES=[],
+        ANSWER_LOG_DIR=str(workdir / "events"),
+        LOG_FILE=str(workdir / "bot.log"),
+    )
+    cwd = os.getcwd()
+    saved = sys.modules.get("config")
+    sys.modules["config"] = config
+    sys.path.insert(0, ROOT)
+    os.chdir(workdir)
+    try:
+        import main
+        yield main
+    finally:
+        os.chdir(cwd)
+        sys.path.remove(ROOT)
+        if saved is not None:
+            sys.modules["config"] = saved
+        else:
+            sys.modules.pop("config", None)
+
+
+@pytest.fixture(params=[0, 2], ids=["catalog", "sharded"])
+def sqlite_tenant(main, tmp_path, request):
+    """Окремий тенант на SQLite з базовою схемою і всіма міграціями"""
+    db_name = str(tmp_path / "quiz_bot.db")
+    with sqlite3.connect(db_name) as conn:
+        conn.executescript(BASE_SCHEMA)
+    tenant = main.Tenant("test", main.BOT_TOKEN, main.ADMIN_ID, db_name,
+                         log_dir=str(tmp_path / "events"), db_shards=request.param)
+    with main.tenant_scope(tenant):
+        main.migrate_database()
+    return tenant
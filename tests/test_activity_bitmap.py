@@ -0,0 +1,64 @@
+"""Календар активності: бітова упаковка, серії та збереження в рядок"""
+
+BASE = 739_000  # ordinal довільної дати
+
+
+def test_mark_packs_days_into_bits(main):
+    bitmap = main.ActivityBitmap(BASE)
+    bitmap.mark(BASE, 3)
+    bitmap.mark(BASE + 2)
+    bitmap.mark(BASE + 2)
+    assert bitmap.bits == 0b101
+    assert list(bitmap.counts) == [3, 0, 2]
+    assert bitmap.days_blob() == b"\x05"
+    # День до base_day зсуває бітмапу, а не губиться
+    bitmap.mark(BASE - 3)
+    assert bitmap.base_day == BASE - 3
+    assert bitmap.bits == 0b101001
+    assert list(bitmap.counts) == [1, 0, 0, 3, 0, 2]
+    assert bitmap.count(BASE) == 3 and bitmap.count(BASE + 10) == 0
+
+
+def test_counts_saturate_at_uint16(main):
+    bitmap = main.ActivityBitmap(BASE)
+    bitmap.mark(BASE, 0xFFFF)
+    bitmap.mark(BASE, 5)
+    assert bitmap.count(BASE) == 0xFFFF
+
+
+def test_row_round_trip_over_a_year(main):
+    bitmap = main.ActivityBitmap(BASE)
+    played = [BASE + day for day in range(0, 366, 3)]
+    for day in played:
+        bitmap.mark(day, day % 7 + 1)
+    row = {"base_day": bitmap.base_day, "days": bitmap.days_blob(), "counts": bitmap.counts.tobytes()}
+    restored = main.ActivityBitmap.from_row(row)
+    assert restored.base_day == BASE
+    assert restored.bits == bitmap.bits
+    assert restored.counts == bitmap.counts
+    assert restored.active_days(BASE, BASE + 365) == len(played)
+    assert restored.questions(BASE, BASE + 365) == sum(day % 7 + 1 for day in played)
+    # Проміжок частково до base_day і після кінця календаря
+    assert restored.active_days(BASE - 10, BASE + 5) == 2
+    assert restored.questions(BASE + 360, BASE + 400) == sum(day % 7 + 1 for day in played if day >= BASE + 360)
+
+
+def test_current_streak(main):
+    bitmap = main.ActivityBitmap(BASE)
+    for day in (0, 1, 3, 4, 5):
+        bitmap.mark(BASE + day)
+    assert bitmap.current_streak(BASE + 5) == 3
+    # Сьогодні ще не грав -- серія до вчора зберігається
+    assert bitmap.current_streak(BASE + 6) == 3
+    assert bitmap.current_streak(BASE + 7) == 0
+    assert bitmap.current_streak(BASE + 1) == 2
+    assert bitmap.current_streak(BASE - 1) == 0
+    assert main.ActivityBitmap(BASE).current_streak(BASE) == 0
+
+
+def test_longest_streak(main):
+    bitmap = main.ActivityBitmap(BASE)
+    for day in (0, 1, 3, 4, 5, 6, 10):
+        bitmap.mark(BASE + day)
+    assert bitmap.longest_streak() == 4
+    assert main.ActivityBitmap(BASE).longest_streak() == 0
@@ -0,0 +1,54 @@
+"""Журнал подій: ротація за добою і видалення старих сегментів"""
+
+import os
+import time
+
+DAY = 86400
+
+
+def names(directory):
+    return sorted(os.listdir(directory))
+
+
+def test_day_old_segment_is_sealed_and_pruned(main, tmp_path, monkeypatch):
+    log = main.AnswerEventLog(str(tmp_path), segment_size=1 << 20)
+    now = time.time()
+    monkeypatch.setattr(main.time, "time", lambda: now - DAY)
+    log.append(1, 2, 3, 6, 6, 1500, 0)
+    log.append(1, 2, 4, 8, 8, 1200, 0)
+    assert names(tmp_path) == ["segment-00000001.open"]
+    # Доба ще та сама -- сегмент лишається відкритим
+    assert not log.rotate_if_stale()
+
+    monkeypatch.setattr(main.time, "time", lambda: now)
+    assert log.rotate_if_stale()
+    assert names(tmp_path) == ["segment-00000001.seg"]
+    with main.AnswerLogReader(str(tmp_path)) as reader:
+        assert list(reader.column("user_answer")) == [6, 8]
+
+    log.append(5, 3, 3, 9, 9, 900, 0)
+    assert log.prune(int((now - DAY / 2) * 1000)) == 1
+    assert names(tmp_path) == ["segment-00000002.open"]
+    log.rotate()
+
+
+def test_append_after_midnight_starts_new_segment(main, tmp_path, monkeypatch):
+    log = main.AnswerEventLog(str(tmp_path), segment_size=1 << 20)
+    midnight = (time.time() // DAY) * DAY
+    monkeypatch.setattr(main.time, "time", lambda: midnight - 1)
+    log.append(1, 2, 3, 6, 6, 1500, 0)
+    monkeypatch.setattr(main.time, "time", lambda: midnight + 1)
+    log.append(1, 2, 3, 6, 6, 1500, 0)
+    assert names(tmp_path) == ["segment-00000001.seg", "segment-00000002.open"]
+    # Свіжий сегмент prune не чіпає, навіть якщо cutoff новіший за запечатаний
+    assert log.prune(int(midnight * 1000)) == 1
+    assert names(tmp_path) == ["segment-00000002.open"]
+    log.rotate()
+
+
+def test_segment_size_still_rotates(main, tmp_path):
+    log = main.AnswerEventLog(str(tmp_path), segment_size=main.EVENT_RECORD.size * 2)
+    for i in range(5):
+        log.append(i, 2, 3, 6, 6, 1500, 0)
+    log.rotate()
+    assert names(tmp_path) == ["segment-00000001.seg", "segment-00000002.seg", "segment-00000003.seg"]
@@ -0,0 +1,51 @@
+"""Пул з'єднань SQLite: повторне використання без протікання транзакцій"""
+
+import threading
+
+
+def test_connection_is_reused_per_path(main, tmp_path):
+    pool = main.ConnectionPool(max_idle=1)
+    first, second = str(tmp_path / "a.db"), str(tmp_path / "b.db")
+    conn = pool.acquire(first)
+    pool.release(first, conn)
+    assert pool.acquire(first) is conn
+    # Інший файл (інший тенант) -- інше з'єднання
+    other = pool.acquire(second)
+    assert other is not conn
+    pool.release(first, conn)
+    pool.release(second, other)
+    pool.close_all()
+
+
+def test_uncommitted_changes_are_rolled_back(main, tmp_path):
+    pool = main.ConnectionPool()
+    path = str(tmp_path / "a.db")
+    conn = pool.acquire(path)
+    conn.execute("CREATE TABLE t (x INTEGER)")
+    conn.commit()
+    conn.execute("INSERT INTO t VALUES (1)")
+    pool.release(path, conn)
+    conn = pool.acquire(path)
+    assert not conn.in_transaction
+    assert conn.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 0
+    pool.release(path, conn)
+    pool.close_all()
+
+
+def test_pooled_connection_works_from_other_thread(main, tmp_path):
+    pool = main.ConnectionPool()
+    path = str(tmp_path / "a.db")
+    conn = pool.acquire(path)
+    pool.release(path, conn)
+    result = []
+
+    def worker():
+        borrowed = pool.acquire(path)
+        result.append(borrowed.execute("SELECT 1").fetchone()[0])
+        pool.release(path, borrowed)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+    assert result == [1]
+    pool.close_all()
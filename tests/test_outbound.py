@@ -0,0 +1,94 @@
+"""Черга вихідних запитів: токен-бакети, резерв і паузи після RetryAfter"""
+
+import asyncio
+import time
+import types
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+
+def test_retry_after_pauses_whole_bot(main):
+    dispatcher = main.OutboundDispatcher(rate=30, reserve=0)
+    bot = types.SimpleNamespace(id=42)
+    sent = {}
+    throttled = []
+
+    async def make_request(bot, method):
+        if method.chat_id == 1 and not throttled:
+            throttled.append(time.monotonic())
+            raise TelegramRetryAfter(method, "Flood control exceeded", 1)
+        sent[method.chat_id] = time.monotonic()
+        return True
+
+    async def scenario():
+        first = asyncio.create_task(dispatcher(make_request, bot, SendMessage(chat_id=1, text="a")))
+        while not throttled:
+            await asyncio.sleep(0.01)
+        # Інший чат того ж бота теж чекає кінця паузи
+        await dispatcher(make_request, bot, SendMessage(chat_id=2, text="b"))
+        await first
+
+    asyncio.run(scenario())
+    assert sent[2] - throttled[0] >= 0.9
+    assert sent[1] - throttled[0] >= 0.9
+    assert dispatcher.bot_pauses == 1
+    assert dispatcher.retries[main.PRIORITY_INTERACTIVE] == 1
+
+
+def test_concurrent_pauses_do_not_stack(main):
+    bucket = main.TokenBucket(rate=30, capacity=30)
+    for _ in range(5):
+        bucket.pause(2)
+    assert 1.9 < bucket.paused_for() <= 2.0
+    assert bucket.delay() > 1.9
+
+
+def test_bucket_keeps_reserve(main, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    bucket = main.TokenBucket(rate=8, capacity=8)
+    for _ in range(4):
+        bucket.take()
+    # Лишилося 4 токени: фоновому запиту з резервом 4 треба ще один
+    assert bucket.delay() == 0
+    assert bucket.delay(reserve=4) == 0.125
+    now[0] += 0.125
+    assert bucket.delay(reserve=4) == 0
+    # Запас не перевищує capacity, скільки б не минуло
+    now[0] += 60
+    assert bucket.tokens <= 8 and bucket.delay(reserve=7) == 0 and bucket.delay(reserve=8) > 0
+
+
+def test_background_leaves_reserve_for_interactive(main):
+    dispatcher = main.OutboundDispatcher(rate=10, reserve=5)
+    bot = types.SimpleNamespace(id=7)
+    sent = []
+
+    async def make_request(bot, method):
+        sent.append((method.chat_id, time.monotonic()))
+        return True
+
+    async def background(chat_id):
+        with main.outbound_scope(main.PRIORITY_BACKGROUND):
+            await dispatcher(make_request, bot, SendMessage(chat_id=chat_id, text="news"))
+
+    async def scenario():
+        # Різні чати -- обмежує лише бакет бота
+        tasks = [asyncio.create_task(background(chat_id)) for chat_id in range(100, 110)]
+        await asyncio.sleep(0.05)
+        assert len(sent) == 5
+        assert dispatcher.depth()[main.PRIORITY_BACKGROUND] == 5
+        # Відповідь у квізі не чекає на розсилку: резерв її
+        started = time.monotonic()
+        for chat_id in (1, 2, 3):
+            await dispatcher(make_request, bot, SendMessage(chat_id=chat_id, text="✅"))
+        assert time.monotonic() - started < 0.05
+        assert len([chat for chat, _ in sent if chat < 100]) == 3
+        assert dispatcher.depth()[main.PRIORITY_BACKGROUND] == 5
+        await asyncio.gather(*tasks)
+        dispatcher._pump_task.cancel()
+
+    asyncio.run(scenario())
+    assert dispatcher.sent[main.PRIORITY_BACKGROUND] == 10
+    assert dispatcher.sent[main.PRIORITY_INTERACTIVE] == 3
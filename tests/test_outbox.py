@@ -0,0 +1,123 @@
+"""Outbox: доставка at-least-once, backoff повторів і лічильники пачок"""
+
+import asyncio
+import json
+import time
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramNetworkError
+from aiogram.methods import SendMessage
+
+NOW = 1_700_000_000
+ADMIN_CHAT = 900
+
+
+class FakeBot:
+    """Чат 2 заблокував бота, чат 3 недоступний через мережу, решта -- успіх"""
+
+    id = 1
+
+    def __init__(self):
+        self.delivered = []
+
+    async def send_message(self, chat_id, text, parse_mode=None, reply_markup=None):
+        method = SendMessage(chat_id=chat_id, text=text)
+        if chat_id == 2:
+            raise TelegramForbiddenError(method, "Forbidden: bot was blocked by the user")
+        if chat_id == 3:
+            raise TelegramNetworkError(method, "Request timeout error")
+        self.delivered.append((chat_id, text))
+
+    async def copy_message(self, chat_id, from_chat_id, message_id):
+        await self.send_message(chat_id, f"copy {from_chat_id}/{message_id}")
+
+
+def rows(main):
+    with main.get_db() as conn:
+        return [dict(row) for row in conn.execute(
+            "SELECT chat_id, attempts, next_attempt_at, priority FROM outbox ORDER BY id")]
+
+
+def batch(main, batch_id):
+    with main.get_db() as conn:
+        return dict(conn.execute("SELECT * FROM outbox_batches WHERE id = ?", (batch_id,)).fetchone())
+
+
+def test_backoff_and_batch_accounting(main, sqlite_tenant, monkeypatch):
+    clock = [NOW]
+    monkeypatch.setattr(main.time, "time", lambda: clock[0])
+    monkeypatch.setattr(main, "OUTBOX_MAX_ATTEMPTS", 3)
+    fake = FakeBot()
+    monkeypatch.setattr(sqlite_tenant, "bot", fake)
+
+    with main.tenant_scope(sqlite_tenant):
+        with main.get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("INSERT INTO outbox_batches (title, report_chat_id, created_at, total) "
+                           "VALUES ('Розсилка', ?, ?, 3)", (ADMIN_CHAT, NOW))
+            batch_id = cursor.lastrowid
+            main.outbox_enqueue(cursor, [(chat_id, main.copy_payload(ADMIN_CHAT, 7)) for chat_id in (1, 2, 3)],
+                                batch_id=batch_id)
+            conn.commit()
+        outbox = main.Outbox()
+
+        def drain():
+            return asyncio.run(outbox.drain_once())
+
+        assert drain() == 3
+        assert fake.delivered == [(1, f"copy {ADMIN_CHAT}/7")]
+        # Заблокований чат видалено з черги, збій мережі чекає BACKOFF_BASE
+        assert rows(main) == [{"chat_id": 3, "attempts": 1, "next_attempt_at": NOW + main.OUTBOX_BACKOFF_BASE,
+                               "priority": main.PRIORITY_BACKGROUND}]
+        progress = batch(main, batch_id)
+        assert (progress["sent"], progress["blocked"], progress["failed"]) == (1, 1, 0)
+        assert progress["finished_at"] is None
+
+        # Ще не час -- нічого не надсилаємо
+        assert drain() == 0
+
+        clock[0] += main.OUTBOX_BACKOFF_BASE
+        assert drain() == 1
+        # Друга невдача: затримка подвоюється
+        assert rows(main)[0]["next_attempt_at"] == clock[0] + 2 * main.OUTBOX_BACKOFF_BASE
+
+        clock[0] += 2 * main.OUTBOX_BACKOFF_BASE
+        assert drain() == 1
+        # Спроби вичерпано: рядок прибрано, пачка закрита, звіт адміну в черзі
+        progress = batch(main, batch_id)
+        assert (progress["sent"], progress["blocked"], progress["failed"]) == (1, 1, 1)
+        assert progress["finished_at"] == clock[0]
+        [report] = rows(main)
+        assert (report["chat_id"], report["priority"], report["attempts"]) == (ADMIN_CHAT, main.PRIORITY_ADMIN, 0)
+
+        assert drain() == 1
+        assert fake.delivered[-1][0] == ADMIN_CHAT
+        assert "Надіслано: 1/3" in fake.delivered[-1][1]
+        assert rows(main) == []
+
+
+def test_backoff_is_capped(main, sqlite_tenant, monkeypatch):
+    monkeypatch.setattr(main.time, "time", lambda: NOW)
+    monkeypatch.setattr(main, "OUTBOX_MAX_ATTEMPTS", 20)
+    monkeypatch.setattr(sqlite_tenant, "bot", FakeBot())
+    with main.tenant_scope(sqlite_tenant):
+        with main.get_db() as conn:
+            main.outbox_enqueue(conn.cursor(), [(3, main.text_payload("ping"))])
+            conn.execute("UPDATE outbox SET attempts = 15")
+            conn.commit()
+        assert asyncio.run(main.Outbox().drain_once()) == 1
+        [row] = rows(main)
+    assert (row["attempts"], row["next_attempt_at"]) == (16, NOW + main.OUTBOX_BACKOFF_MAX)
+
+
+def test_due_rows_follow_priority(main, sqlite_tenant, monkeypatch):
+    monkeypatch.setattr(main.time, "time", lambda: NOW)
+    with main.tenant_scope(sqlite_tenant):
+        with main.get_db() as conn:
+            cursor = conn.cursor()
+            main.outbox_enqueue(cursor, [(chat_id, main.text_payload("news")) for chat_id in range(10, 14)])
+            main.outbox_enqueue(cursor, [(20, main.text_payload("✅"))], priority=main.PRIORITY_INTERACTIVE)
+            main.outbox_enqueue(cursor, [(30, main.text_payload("later"))], priority=main.PRIORITY_INTERACTIVE, delay=60)
+            conn.commit()
+        due = main.Outbox(batch_size=3)._due(NOW)
+    assert [row["chat_id"] for row in due] == [20, 10, 11]
+    assert json.loads(due[0]["payload"]) == {"kind": "text", "text": "✅"}
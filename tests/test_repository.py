@@ -0,0 +1,95 @@
+"""Паритет сховищ: SqliteRepository і MemoryRepository мають поводитися однаково"""
+
+import pytest
+
+NOW = 1_700_000_000
+DAY = 86400
+
+
+def exercise(main, repo):
+    """Однаковий сценарій для обох сховищ; повертає все, що видно назовні"""
+    seen = {}
+    repo.get_or_create_user(10, "ann", "Ann")
+    repo.get_or_create_user(20, "bob", "Bob")
+    repo.set_custom_name(10, "Анна")
+    repo.set_reminders(20, False)
+    for is_correct in (True, True, False, True):
+        repo.record_result(10, is_correct)
+    repo.record_result(20, True)
+    repo.track_weak_spot(10, 3, 4)
+    repo.track_weak_spot(10, 3, 4)
+    repo.track_weak_spot(10, 6, 7)
+    repo.mark_activity(10, 100)
+    repo.mark_activity(10, 100)
+    repo.mark_activity(10, 102)
+    for i, seconds in enumerate((1.0, 2.0, 3.5)):
+        repo.save_answer(10, (NOW + i, 3, 4, 12, 12, 1, int(seconds * 1000), 1, 0, 0, None),
+                         ("normal", 1, seconds))
+    repo.save_answer(20, (NOW, 6, 7, 40, 42, 0, 800, 2, 0, 0, None), ("lightning", 2, 0.8))
+
+    if main.tenant().db_shards and repo.uses_catalog:
+        # Лічильники з шардів потрапляють у рейтинг каталогу фоновою синхронізацією
+        main.sync_user_catalog()
+
+    user = repo.get_user(10)
+    seen["user"] = {key: user[key] for key in (
+        "username", "first_name", "custom_name", "total_questions", "correct_answers",
+        "wrong_answers", "current_streak", "best_streak", "reminder_enabled")}
+    seen["leaderboard"] = repo.leaderboard(10)
+    seen["reminders"] = sorted(row["user_id"] for row in repo.reminder_candidates())
+    seen["weak_spots"] = repo.get_weak_spots(10, 5)
+    calendar = repo.get_calendar(10)
+    seen["calendar"] = (calendar.base_day, calendar.bits, list(calendar.counts))
+    seen["no_calendar"] = repo.get_calendar(20)
+    own = repo.speed_sketch("user", 10)
+    seen["speed_user"] = (own.count, round(own.quantile(0.5), 3), round(own.quantile(0.9), 3))
+    seen["speed_global"] = repo.speed_sketch("global", "all").count
+    seen["speed_modes"] = {mode: sketch.count for mode, sketch in repo.speed_sketches("mode").items()}
+    seen["speed_empty"] = repo.speed_sketch("user", 99).count
+
+    repo.set_delivery_status(20, "blocked")
+    seen["blocked"] = sorted(row["user_id"] for row in repo.reminder_candidates())
+    # Новий апдейт від користувача знімає блокування
+    repo.get_or_create_user(20, "bob", "Bob")
+    seen["unblocked"] = sorted(row["user_id"] for row in repo.reminder_candidates())
+
+    repo.set_admin_notif_default(False)
+    repo.set_admin_notif(10, True, False)
+    repo.set_admin_notif(20, False, False)
+    seen["admin_notif"] = repo.load_admin_notif()
+
+    # Вайтліст: сід не повертає відкликаний доступ, безстроковий не стає підпискою
+    repo.seed_whitelist([30, 40])
+    repo.revoke_access([40])
+    repo.seed_whitelist([30, 40])
+    seen["seeded"] = repo.whitelisted_ids()
+    seen["granted"] = repo.grant_access([10, 30], 30, NOW)
+    seen["extended"] = repo.grant_access([10], 10, NOW + DAY)
+    seen["next_expiry"] = repo.next_expiry()
+    seen["expired_early"] = repo.expire_due(NOW + 39 * DAY)
+    seen["expired"] = repo.expire_due(NOW + 40 * DAY)
+    seen["whitelist"] = repo.whitelisted_ids()
+    seen["after_expiry"] = repo.next_expiry()
+    return seen
+
+
+def test_backends_match(main, sqlite_tenant):
+    with main.tenant_scope(sqlite_tenant):
+        from_sqlite = exercise(main, main.SqliteRepository())
+        from_memory = exercise(main, main.MemoryRepository())
+    assert from_sqlite == from_memory
+    assert from_sqlite["whitelist"] == {30}
+    assert from_sqlite["granted"] == {10: NOW + 30 * DAY, 30: None}
+    assert from_sqlite["speed_modes"] == {"normal": 3, "lightning": 1}
+
+
+def test_repository_is_abstract(main):
+    with pytest.raises(TypeError):
+        main.Repository()
+
+    class Partial(main.Repository):
+        def get_user(self, user_id):
+            return {}
+
+    with pytest.raises(TypeError):
+        Partial()
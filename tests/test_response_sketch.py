@@ -0,0 +1,62 @@
+"""Скетчі часу відповіді: точність квантилів, злиття і серіалізація"""
+
+import random
+
+import pytest
+
+
+def response_times(seed, n=20_000):
+    """Логнормальний розподіл з медіаною ~3 с -- схоже на реальні відповіді"""
+    rng = random.Random(seed)
+    return [rng.lognormvariate(1.1, 0.6) for _ in range(n)]
+
+
+def exact_quantile(values, q):
+    ordered = sorted(values)
+    return ordered[int(q * (len(ordered) - 1))]
+
+
+@pytest.mark.parametrize("q", [0.5, 0.9, 0.99])
+def test_quantiles_within_relative_accuracy(main, q):
+    values = response_times(1)
+    sketch = main.ResponseTimeSketch()
+    for value in values:
+        sketch.add(value)
+    expected = exact_quantile(values, q)
+    assert sketch.quantile(q) == pytest.approx(expected, rel=main.ResponseTimeSketch.RELATIVE_ACCURACY)
+
+
+def test_merge_equals_single_sketch(main):
+    fast, slow = response_times(2), [value * 4 for value in response_times(3)]
+    left, right, whole = main.ResponseTimeSketch(), main.ResponseTimeSketch(), main.ResponseTimeSketch()
+    for value in fast:
+        left.add(value)
+        whole.add(value)
+    for value in slow:
+        right.add(value)
+        whole.add(value)
+    merged = main.ResponseTimeSketch().merge(left).merge(right)
+    assert merged.count == whole.count == len(fast) + len(slow)
+    assert merged.bins == whole.bins
+    for q in (0.5, 0.9):
+        assert merged.quantile(q) == pytest.approx(exact_quantile(fast + slow, q), rel=0.02)
+
+
+def test_zero_bucket_and_empty_sketch(main):
+    sketch = main.ResponseTimeSketch()
+    assert sketch.quantile(0.5) is None
+    for value in (0.0, 0.005, 0.0, 2.0):
+        sketch.add(value)
+    assert sketch.zero_count == 3
+    assert sketch.quantile(0.5) == 0.0
+    assert sketch.quantile(1.0) == pytest.approx(2.0, rel=0.02)
+
+
+def test_bytes_round_trip(main):
+    sketch = main.ResponseTimeSketch()
+    for value in response_times(4, 1000) + [0.0, 0.0]:
+        sketch.add(value)
+    restored = main.ResponseTimeSketch.from_bytes(sketch.to_bytes())
+    assert restored.bins == sketch.bins
+    assert (restored.zero_count, restored.count) == (2, 1002)
+    assert main.ResponseTimeSketch.from_bytes(main.ResponseTimeSketch().to_bytes()).count == 0
@@ -0,0 +1,72 @@
+"""Сегменти розсилки: compile_segment дає ту саму аудиторію в обох схемах"""
+
+import time
+
+import pytest
+
+SEGMENTS = [
+    ({}, {10, 20}),
+    ({"blocked": None}, {10, 20, 30}),
+    ({"whitelist": None}, {10, 20, 40}),
+    ({"whitelist": 0}, {40}),
+    ({"activity": 7}, {10}),
+    ({"activity": -7}, {20}),
+    ({"accuracy": [80, 101], "whitelist": None}, {10, 40}),
+    ({"accuracy": [50, 80]}, {20}),
+    ({"accuracy": [0, 50], "blocked": None}, {30}),
+    ({"level": 2, "blocked": None}, {20, 30}),
+    ({"level": 3}, set()),
+    ({"level": 3, "whitelist": None}, {40}),
+    ({"reminders": 0, "whitelist": None}, {40}),
+    ({"activity": 30, "accuracy": [80, 101], "level": 1}, {10}),
+]
+
+
+def answer(level, is_correct):
+    """Рядок answer_history без user_id (answered_at ... equation)"""
+    return (int(time.time()), 3, 4, 12 if is_correct else 11, 12, int(is_correct), 1500, level, 0, 0, None)
+
+
+@pytest.fixture
+def audience(main, sqlite_tenant):
+    """10 -- відмінник, 20 -- неактивний, 30 -- заблокував бота, 40 -- без доступу"""
+    with main.tenant_scope(sqlite_tenant):
+        repo = main.SqliteRepository()
+        results = {10: [(1, True)] * 4, 20: [(2, True), (2, False)], 30: [(2, False)], 40: [(3, True)]}
+        for user_id, answers in results.items():
+            repo.get_or_create_user(user_id, f"u{user_id}", f"U{user_id}")
+            for level, is_correct in answers:
+                repo.record_result(user_id, is_correct)
+                repo.save_answer(user_id, answer(level, is_correct))
+        repo.grant_access([10, 20, 30], None, int(time.time()))
+        repo.set_delivery_status(30, "blocked")
+        repo.set_reminders(40, False)
+        if sqlite_tenant.db_shards:
+            main.sync_user_catalog()
+        with main.get_db() as conn:
+            conn.execute("UPDATE users SET last_activity = datetime('now', '-10 days') WHERE user_id = 20")
+            conn.commit()
+        yield sqlite_tenant
+
+
+@pytest.mark.parametrize("segment,expected", SEGMENTS)
+def test_segment_selects_expected_users(main, audience, segment, expected):
+    with main.tenant_scope(audience):
+        where, params = main.compile_segment(segment)
+        with main.get_db() as conn:
+            rows = conn.execute(f"SELECT user_id FROM users WHERE {where}", params).fetchall()
+        assert {row[0] for row in rows} == expected
+        assert main.count_segment(segment) == len(expected)
+
+
+def test_default_segment_uses_reachable_index(main, audience):
+    with main.tenant_scope(audience):
+        where, params = main.compile_segment({})
+        with main.get_db() as conn:
+            plan = conn.execute(f"EXPLAIN QUERY PLAN SELECT COUNT(*) FROM users WHERE {where}", params).fetchall()
+    assert any("idx_users_reachable" in row[-1] for row in plan)
+
+
+def test_empty_conditions_match_everyone(main):
+    segment = {key: None for key in main.SEGMENT_OPTIONS}
+    assert main.compile_segment(segment) == ("1", [])